@@ -0,0 +1 @@
+from .database import get_database
@@ -0,0 +1,10 @@
+from collections.abc import AsyncIterator
+
+from fastapi import Request
+
+from app.database.clusters import DataBase
+
+
+async def get_database(request: Request) -> AsyncIterator[DataBase]:
+    async with DataBase(request.app.state.db_engine) as db:
+        yield db
@@ -0,0 +1,64 @@
+import csv
+import io
+import json
+from collections.abc import AsyncIterator
+
+from fastapi.responses import StreamingResponse
+
+from app.database.clusters import DataBase
+from app.database.connection import AsyncConnection
+
+"""
+Description: Stream big query results to the client without holding them in memory.
+The connection is borrowed inside the generator, because dependencies with yield
+are finished before the body of StreamingResponse is sent.
+
+Example of usage:
+>>> @router.get("/report")
+... async def report(request: Request):
+...     return ndjson_response(request.app.state.db_engine, "SELECT * FROM report")
+"""
+
+
+async def _stream_batches(
+    engine: AsyncConnection, sql: str, args: tuple, batch_size: int
+) -> AsyncIterator[list]:
+    async with DataBase(engine) as db:
+        async for batch in db.stream_batches(sql, *args, batch_size=batch_size):
+            yield batch
+
+
+async def _ndjson(batches: AsyncIterator[list]) -> AsyncIterator[str]:
+    async for batch in batches:
+        yield "".join(json.dumps(row, ensure_ascii=False, default=str) + "\n" for row in batch)
+
+
+async def _csv(batches: AsyncIterator[list]) -> AsyncIterator[str]:
+    buffer = io.StringIO()
+    writer = None
+    async for batch in batches:
+        if writer is None:
+            writer = csv.DictWriter(buffer, fieldnames=list(batch[0]))
+            writer.writeheader()
+        writer.writerows(batch)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def ndjson_response(
+    engine: AsyncConnection, sql: str, *args, batch_size: int = 1000
+) -> StreamingResponse:
+    batches = _stream_batches(engine, sql, args, batch_size)
+    return StreamingResponse(_ndjson(batches), media_type="application/x-ndjson")
+
+
+def csv_response(
+    engine: AsyncConnection, sql: str, *args, batch_size: int = 1000, filename: str = "export.csv"
+) -> StreamingResponse:
+    batches = _stream_batches(engine, sql, args, batch_size)
+    return StreamingResponse(
+        _csv(batches),
+        media_type="text/csv",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
@@ -1,2 +1,2 @@
 from .logger import get_logger
-from .settings import get_appsettings, get_database_settings
+from .settings import get_appsettings, get_database_settings, get_http_client_settings
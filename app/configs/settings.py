@@ -3,6 +3,7 @@ from dotenv import load_dotenv
 from app.core.configs import (
     AppSettings,
     DataBaseSettings,
+    HttpClientSettings,
     set_appname,
     set_appversion,
     set_debug_level,
@@ -16,6 +17,7 @@ set_appname(_app_settings.appname_log)  # ty: ignore
 set_appversion(_app_settings.appversion)
 
 _database_settings = DataBaseSettings()  # ty: ignore
+_http_client_settings = HttpClientSettings()
 
 
 def get_appsettings():
@@ -24,3 +26,7 @@ def get_appsettings():
 
 def get_database_settings():
     return _database_settings
+
+
+def get_http_client_settings():
+    return _http_client_settings
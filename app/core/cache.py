@@ -0,0 +1,158 @@
+import asyncio
+import sys
+import time
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable, Hashable
+from dataclasses import dataclass
+from typing import Any
+
+"""
+Description: Building blocks for in-process caches
+TTLCache - LRU with TTL, entries count and memory caps
+SingleFlight - coalesces concurrent calls with the same key into one call
+
+Example of usage:
+>>> cache = TTLCache(max_entries=1000, max_bytes=64 * 2**20, ttl=30)
+>>> flight = SingleFlight()
+>>> async def load(key):
+...     if (value := cache.get(key)) is not None:
+...         return value
+...     value, shared = await flight.do(key, lambda: fetch(key))
+...     cache.set(key, value)
+...     return value
+"""
+
+
+def sizeof(value: Any, depth: int = 3) -> int:
+    """Approximate size of the value and its items, enough for the memory cap"""
+    size = sys.getsizeof(value)
+    if depth <= 0:
+        return size
+    if isinstance(value, dict):
+        size += sum(sizeof(k, depth - 1) + sizeof(v, depth - 1) for k, v in value.items())
+    elif isinstance(value, list | tuple | set | frozenset):
+        size += sum(sizeof(item, depth - 1) for item in value)
+    return size
+
+
+@dataclass(slots=True)
+class _Entry:
+    value: Any
+    expires_at: float
+    size: int
+
+
+class TTLCache:
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        max_bytes: int | None = None,
+        ttl: float = 60,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self._entries: OrderedDict[Hashable, _Entry] = OrderedDict()
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        self._clock = clock
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        entry = self._entries.get(key)
+        return entry is not None and entry.expires_at > self._clock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        if entry.expires_at <= self._clock():
+            self.pop(key)
+            self.misses += 1
+            return default
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry.value
+
+    def expires_in(self, key: Hashable) -> float:
+        entry = self._entries.get(key)
+        return entry.expires_at - self._clock() if entry else 0.0
+
+    def set(
+        self, key: Hashable, value: Any, ttl: float | None = None, size: int | None = None
+    ) -> None:
+        if size is None:
+            size = sizeof(value) if self._max_bytes else 0
+        if self._max_bytes and size > self._max_bytes:
+            return
+
+        self.pop(key)
+        ttl = self._ttl if ttl is None else ttl
+        self._entries[key] = _Entry(value, self._clock() + ttl, size)
+        self.bytes += size
+        while len(self._entries) > self._max_entries or (
+            self._max_bytes and self.bytes > self._max_bytes
+        ):
+            _, entry = self._entries.popitem(last=False)
+            self.bytes -= entry.size
+            self.evictions += 1
+
+    def pop(self, key: Hashable) -> Any:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        self.bytes -= entry.size
+        return entry.value
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.bytes = 0
+
+
+class SingleFlight:
+    """
+    Coalesces the concurrent calls with the same key into one call. When the caller
+    running the call is cancelled, one of the callers waiting for it runs its own fn,
+    the others wait for that one: they are never cancelled along with it.
+    """
+
+    def __init__(self) -> None:
+        self._calls: dict[Hashable, asyncio.Future] = {}
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> tuple[Any, bool]:
+        """The result and whether it was shared from the call of another caller"""
+        while (future := self._calls.get(key)) is not None:
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(future), True
+            except asyncio.CancelledError:
+                if future.cancelled() and not asyncio.current_task().cancelling():
+                    # The running caller was cancelled, its call is taken over
+                    continue
+                raise
+
+        future = asyncio.get_running_loop().create_future()
+        self._calls[key] = future
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Nobody may wait for the future, don't warn about the unretrieved exception
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            self._calls.pop(key, None)
@@ -5,4 +5,4 @@ from .log_settings import (
     set_appversion,
     set_debug_level,
 )
-from .settings import AppSettings, DataBaseSettings
+from .settings import AppSettings, DataBaseSettings, HttpClientSettings
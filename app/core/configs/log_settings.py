@@ -1,11 +1,23 @@
+import itertools
 import json
 import logging.config
 import logging.handlers
+import operator
+import os
 import queue
 import re
+import time
 import uuid
+import weakref
+from collections.abc import Callable
 from contextvars import ContextVar
 from logging import Logger
+from typing import ClassVar
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
 
 """
 Description: Log settings
@@ -51,38 +63,123 @@ def set_appversion(version: str):
     _version = version
 
 
+class LogSequence:
+    """
+    log_id of the records: pid and a counter, unique across the worker processes
+    and ordered inside one. next() of itertools.count is atomic, no lock is needed.
+    The counter starts again in a forked child, with its own pid.
+    """
+
+    def __init__(self) -> None:
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self) -> None:
+        self.pid = os.getpid()
+        self._counter = itertools.count(1)
+
+    def __next__(self) -> str:
+        return f"{self.pid}-{next(self._counter)}"
+
+
+LOG_SEQUENCE = LogSequence()
+
+
+def _json_encoder() -> Callable[[dict], str]:
+    """orjson if it is installed, else the stdlib encoder built once, not per record"""
+    if orjson is not None:
+        return lambda message: orjson.dumps(message).decode()
+    return json.JSONEncoder(ensure_ascii=False).encode
+
+
+# Attributes of every LogRecord, the formatter sets message and req_id itself
+_RECORD_ATTRIBUTES = frozenset(logging.makeLogRecord({}).__dict__) | {"message", "req_id"}
+
+
 class JSONFormatter(logging.Formatter):
+    """
+    The fields of the format are parsed once, the values are taken from the record
+    with one itemgetter call. The formatted time is cached for the current second.
+    encoder is any callable dict -> str, orjson is used if it is installed.
+
+    >>> "()": JSONFormatter, "format": "%(process)d::%(message)s", "encoder": json.dumps
+    """
+
     _pattern = re.compile(r"%\((\w+)\)s")
-    COUNTER = 0
     _req_id = ContextVar("req_id", default=uuid.uuid4().hex[:10])
 
+    def __init__(
+        self,
+        fmt=None,
+        datefmt=None,
+        style="%",
+        validate=True,
+        *,
+        defaults=None,
+        encoder: Callable[[dict], str] | None = None,
+    ):
+        super().__init__(fmt, datefmt, style, validate, defaults=defaults)
+        self._encode = encoder or _json_encoder()
+        # Unique fields in the order of the format, the missing ones are None
+        self._fields = tuple(dict.fromkeys(self._pattern.findall(self._fmt)))
+        self._extra_fields = tuple(name for name in self._fields if name not in _RECORD_ATTRIBUTES)
+        self._get_fields = operator.itemgetter(*self._fields) if self._fields else None
+        self._uses_asctime = "asctime" in self._fields
+        self._time_cache: tuple[int, str | None, str] = (-1, None, "")
+
+    def formatTime(self, record, datefmt=None) -> str:
+        # One tuple, so the threads sharing the formatter see a consistent pair
+        second, cached_datefmt, formatted = self._time_cache
+        if second != int(record.created) or cached_datefmt != datefmt:
+            second = int(record.created)
+            formatted = time.strftime(
+                datefmt or self.default_time_format, self.converter(record.created)
+            )
+            self._time_cache = (second, datefmt, formatted)
+        if datefmt or not self.default_msec_format:
+            return formatted
+        return self.default_msec_format % (formatted, record.msecs)
+
+    def format(self, record) -> str:
+        """One JSON object per record, the traceback is inside it"""
+        record.message = record.getMessage()
+        return self.formatMessage(record)
+
     def formatMessage(self, record) -> str:
-        global _appname
-        global _version
-        ready_message: dict = {}
         values = record.__dict__
-
-        self.COUNTER += 1
-        logger_name: str = values["name"]
-        ready_message["app.name"] = _appname
-        ready_message["app.version"] = _version
-        ready_message["app.logger"] = logger_name
-        ready_message["time"] = self.formatTime(record, self.datefmt)
-        ready_message["level"] = values.get("levelname")
-        ready_message["log_id"]: int = self.COUNTER
-        ready_message["message"] = str(values["message"])
-
         if not values.get("req_id"):
             values["req_id"] = self._req_id.get()
 
+        # Stamped by BatchingQueueListener in the order of the queue
+        log_id = values.get("log_id") or next(LOG_SEQUENCE)
+        logger_name: str = values["name"]
+        time_text = self.formatTime(record, self.datefmt)
+        ready_message: dict = {
+            "app.name": _appname,
+            "app.version": _version,
+            "app.logger": logger_name,
+            "time": time_text,
+            "level": values["levelname"],
+            "log_id": log_id,
+            "message": values["message"],
+        }
+
         if record.exc_info:
             ready_message["exc_text"] = self.formatException(record.exc_info)
         if record.stack_info:
             ready_message["stack"] = self.formatStack(record.stack_info)
 
-        for value_name in self._pattern.findall(self._fmt):
-            value = values.get(value_name)
-            ready_message.update({value_name: value})
+        if self._get_fields is not None:
+            if self._uses_asctime:
+                values["asctime"] = time_text
+            for name in self._extra_fields:
+                if name not in values:
+                    values[name] = None
+            field_values = self._get_fields(values)
+            if len(self._fields) == 1:
+                ready_message[self._fields[0]] = field_values
+            else:
+                ready_message.update(zip(self._fields, field_values, strict=True))
 
         if logger_name.startswith("uvicorn") and record.args and len(record.args) == 5:
             ready_message.pop("message", None)
@@ -92,7 +189,7 @@ class JSONFormatter(logging.Formatter):
             ready_message["http_version"] = record.args[3]
             ready_message["status"] = record.args[4]
 
-        return json.dumps(ready_message, ensure_ascii=False)
+        return self._encode(ready_message)
 
 
 class RouterFilter(logging.Filter):
@@ -105,11 +202,139 @@ class RouterFilter(logging.Filter):
 
 
 class AutoStartQueueListener(logging.handlers.QueueListener):
+    """
+    The thread of the listener does not survive fork(): the running listeners are
+    started again in the child. The records queued by the parent are left to the parent.
+    """
+
+    _running: ClassVar[weakref.WeakSet] = weakref.WeakSet()
+    _forking: ClassVar[list] = []
+
     def __init__(self, queue, *handlers, respect_handler_level=False):
         super().__init__(queue, *handlers, respect_handler_level=respect_handler_level)
         # Start the listener immediately.
         self.start()
 
+    def start(self) -> None:
+        super().start()
+        self._running.add(self)
+
+    def stop(self) -> None:
+        self._running.discard(self)
+        super().stop()
+
+    @classmethod
+    def _before_fork(cls) -> None:
+        # No listener thread holds the lock of its queue at the moment of the fork
+        cls._forking = list(cls._running)
+        for listener in cls._forking:
+            if mutex := getattr(listener.queue, "mutex", None):
+                mutex.acquire()
+
+    @classmethod
+    def _after_fork_in_parent(cls) -> None:
+        for listener in cls._forking:
+            if mutex := getattr(listener.queue, "mutex", None):
+                mutex.release()
+        cls._forking = []
+
+    @classmethod
+    def _after_fork_in_child(cls) -> None:
+        for listener in cls._forking:
+            if mutex := getattr(listener.queue, "mutex", None):
+                listener.queue.queue.clear()
+                listener.queue.unfinished_tasks = 0
+                mutex.release()
+            listener._thread = None
+            listener.start()
+        cls._forking = []
+
+
+os.register_at_fork(
+    before=AutoStartQueueListener._before_fork,
+    after_in_parent=AutoStartQueueListener._after_fork_in_parent,
+    after_in_child=AutoStartQueueListener._after_fork_in_child,
+)
+
+
+class BatchStreamHandler(logging.StreamHandler):
+    """StreamHandler writing a batch of records with one write and one flush"""
+
+    def emit_batch(self, records: list[logging.LogRecord]) -> None:
+        try:
+            lines = [self.format(record) + self.terminator for record in records]
+            self.stream.write("".join(lines))
+            self.flush()
+        except RecursionError:
+            raise
+        except Exception:
+            for record in records:
+                self.handleError(record)
+
+    def handle_batch(self, records: list[logging.LogRecord]) -> None:
+        accepted = []
+        for record in records:
+            if result := self.filter(record):
+                accepted.append(result if isinstance(result, logging.LogRecord) else record)
+        if accepted:
+            with self.lock:
+                self.emit_batch(accepted)
+
+
+class BatchingQueueListener(AutoStartQueueListener):
+    """
+    Drains the queue in chunks of up to max_batch records: it waits only for the first
+    one and takes the rest already queued. The handlers with handle_batch get the chunk
+    at once, the others record by record. The records are stamped with LOG_SEQUENCE.
+    """
+
+    max_batch = 512
+
+    def handle_batch(self, records: list[logging.LogRecord]) -> None:
+        records = [self.prepare(record) for record in records]
+        for record in records:
+            if not getattr(record, "log_id", None):
+                record.log_id = next(LOG_SEQUENCE)
+        for handler in self.handlers:
+            batch = records
+            if self.respect_handler_level:
+                batch = [record for record in records if record.levelno >= handler.level]
+            if not batch:
+                continue
+            if hasattr(handler, "handle_batch"):
+                handler.handle_batch(batch)
+            else:
+                for record in batch:
+                    handler.handle(record)
+
+    def _monitor(self):
+        q = self.queue
+        has_task_done = hasattr(q, "task_done")
+        stopped = False
+        while not stopped:
+            try:
+                record = self.dequeue(True)
+            except queue.Empty:
+                break
+            records = []
+            while True:
+                if record is self._sentinel:
+                    # stop() puts the sentinel, the records before it are written
+                    stopped = True
+                    break
+                records.append(record)
+                if len(records) >= self.max_batch:
+                    break
+                try:
+                    record = self.dequeue(False)
+                except queue.Empty:
+                    break
+            if records:
+                self.handle_batch(records)
+            if has_task_done:
+                for _ in range(len(records) + stopped):
+                    q.task_done()
+
 
 class RequestIdFilter(logging.Filter):
     def __init__(self, name=""):
@@ -167,7 +392,7 @@ LogConfig = {
             "filters": ["router"],
         },
         "json": {
-            "class": "logging.StreamHandler",
+            "class": BatchStreamHandler,
             "level": "DEBUG",
             "stream": "ext://sys.stderr",
             "formatter": "json",
@@ -180,7 +405,7 @@ LogConfig = {
                 "maxsize": -1,
             },
             "level": "DEBUG",
-            "listener": AutoStartQueueListener,
+            "listener": BatchingQueueListener,
             "handlers": ["json"],
         },
         # 'handlers': ['cfg://handlers.json', 'cfg://handlers.console'],
@@ -24,6 +24,34 @@ class DataBaseSettings(BaseSettings):
     password: str
     engine: str | None = "psycopg"
 
+    pool_min_size: int = 1
+    pool_max_size: int = 10
+    pool_max_idle: float = 600
+    pool_max_lifetime: float = 3600
+    pool_timeout: float = 30
+    pool_max_waiting: int = 0
+    prepared_cache_size: int = 100
+
+    # "host:port" of the nodes, e.g. PG_REPLICAS='["replica1:5432", "replica2:5432"]'
+    replicas: list[str] = []
+    shards: list[str] = []
+    replica_max_lag: float = 10
+    replica_check_interval: float = 5
+
     @computed_field(return_type=str)
     def pg_dsn(self):
-        return f"postgresql://{self.user}:{self.password}@{self.host}:{self.port}/{self.dbname}"
+        return self.node_dsn(f"{self.host}:{self.port}")
+
+    def node_dsn(self, address: str) -> str:
+        return f"postgresql://{self.user}:{self.password}@{address}/{self.dbname}"
+
+
+class HttpClientSettings(BaseSettings):
+    model_config = SettingsConfigDict(env_prefix="HTTP_")
+
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    keepalive_expiry: float = 30
+    http2: bool = False  # needs httpx[http2]
+    timeout: float = 10
+    connect_timeout: float = 5
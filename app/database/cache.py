@@ -0,0 +1,338 @@
+import asyncio
+import hashlib
+import logging
+import os
+import pickle
+import re
+import time
+from abc import ABC, abstractmethod
+from collections import namedtuple
+from functools import lru_cache
+from pathlib import Path
+from typing import NamedTuple
+
+from app.core.cache import SingleFlight, TTLCache
+
+from .clusters import DataBase, is_read_only
+from .connection import AsyncConnection, RowMode, Rows
+from .metrics import QUERY_CACHE_COALESCED, QUERY_CACHE_HITS, QUERY_CACHE_MISSES
+
+logger = logging.getLogger("stdout")
+
+# The whole FROM list: "FROM users u, groups AS g, roles"
+_READ_TABLES = re.compile(
+    r"\b(?:FROM|JOIN)\s+((?:[\w.\"]+(?:\s+(?:AS\s+)?\w+)?\s*,\s*)*[\w.\"]+)", re.IGNORECASE
+)
+_WRITE_TABLES = re.compile(
+    # UPDATE, but not the row locks FOR UPDATE / FOR NO KEY UPDATE
+    r"\b(?:INSERT\s+INTO|(?<!FOR\s)(?<!KEY\s)UPDATE|DELETE\s+FROM|TRUNCATE(?:\s+TABLE)?"
+    r"|MERGE\s+INTO)\s+([\w.\"]+)",
+    re.IGNORECASE,
+)
+
+
+def _table_name(name: str) -> str:
+    return name.replace('"', "").rsplit(".", 1)[-1].lower()
+
+
+def read_tags(sql: str) -> frozenset[str]:
+    """
+    >>> sorted(read_tags("SELECT * FROM users u, groups g WHERE g.id = u.group_id"))
+    ['groups', 'users']
+    """
+    return frozenset(
+        _table_name(item.split()[0])
+        for tables in _READ_TABLES.findall(sql)
+        for item in tables.split(",")
+    )
+
+
+def write_tags(sql: str) -> frozenset[str]:
+    return frozenset(map(_table_name, _WRITE_TABLES.findall(sql)))
+
+
+class CacheBackend(ABC):
+    """Second tier, shared between processes (local files, shared memory, ...)"""
+
+    @abstractmethod
+    async def get(self, key: str) -> tuple[bytes, float] | None:
+        """The value and the seconds left to its expiry"""
+
+    @abstractmethod
+    async def set(self, key: str, value: bytes, ttl: float, tags: frozenset[str]) -> None:
+        pass
+
+    @abstractmethod
+    async def invalidate(self, tags: frozenset[str]) -> None:
+        pass
+
+
+class FileCacheBackend(CacheBackend):
+    """
+    Entry file keeps (expires_at, created_at, tags, value).
+    Tag file keeps the time of the last invalidation of the tag, entries created
+    before it are stale. Stale entries are removed when they are read and by the sweep,
+    which runs on set at most once per sweep_interval seconds.
+    """
+
+    def __init__(self, directory: str | Path, sweep_interval: float = 60) -> None:
+        self._directory = Path(directory)
+        (self._directory / "tags").mkdir(parents=True, exist_ok=True)
+        self._sweep_interval = sweep_interval
+        self._swept_at = time.monotonic()
+
+    def _invalidated_at(self, tag: str) -> float:
+        try:
+            return float((self._directory / "tags" / tag).read_text())
+        except (FileNotFoundError, ValueError):
+            return 0.0
+
+    def _is_stale(self, expires_at: float, created_at: float, tags: frozenset[str]) -> bool:
+        if expires_at <= time.time():
+            return True
+        return any(self._invalidated_at(tag) >= created_at for tag in tags)
+
+    def _get(self, key: str) -> tuple[bytes, float] | None:
+        path = self._directory / key
+        try:
+            expires_at, created_at, tags, value = pickle.loads(path.read_bytes())
+        except FileNotFoundError:
+            return None
+        if self._is_stale(expires_at, created_at, tags):
+            path.unlink(missing_ok=True)
+            return None
+        return value, expires_at - time.time()
+
+    def _set(self, key: str, value: bytes, ttl: float, tags: frozenset[str]) -> None:
+        now = time.time()
+        tmp = self._directory / f"{key}.{os.getpid()}.tmp"
+        tmp.write_bytes(pickle.dumps((now + ttl, now, tags, value)))
+        tmp.replace(self._directory / key)
+        if time.monotonic() - self._swept_at >= self._sweep_interval:
+            self._sweep()
+
+    def _sweep(self) -> int:
+        """Removes the expired and invalidated entries, returns the number of removed files"""
+        self._swept_at = time.monotonic()
+        removed = 0
+        for path in self._directory.iterdir():
+            if not path.is_file():
+                continue
+            try:
+                if path.suffix == ".tmp":
+                    # Left by a writer which has died before the rename
+                    stale = path.stat().st_mtime < time.time() - self._sweep_interval
+                else:
+                    stale = self._is_stale(*pickle.loads(path.read_bytes())[:3])
+            except FileNotFoundError:
+                continue
+            except Exception as e:
+                logger.warning(f"Query cache file {path} is broken: {e}")
+                stale = True
+            if stale:
+                path.unlink(missing_ok=True)
+                removed += 1
+        return removed
+
+    def _invalidate(self, tags: frozenset[str]) -> None:
+        now = str(time.time())
+        for tag in tags:
+            (self._directory / "tags" / tag).write_text(now)
+
+    async def get(self, key: str) -> tuple[bytes, float] | None:
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key: str, value: bytes, ttl: float, tags: frozenset[str]) -> None:
+        await asyncio.to_thread(self._set, key, value, ttl, tags)
+
+    async def invalidate(self, tags: frozenset[str]) -> None:
+        await asyncio.to_thread(self._invalidate, tags)
+
+    async def sweep(self) -> int:
+        return await asyncio.to_thread(self._sweep)
+
+
+@lru_cache(maxsize=512)
+def _record_type(names: tuple[str, ...]) -> type:
+    return namedtuple("Row", names, rename=True)
+
+
+class CachedColumn(NamedTuple):
+    """Picklable copy of a psycopg Column, cached with the rows"""
+
+    name: str
+    type_code: int | None = None
+    display_size: int | None = None
+    internal_size: int | None = None
+    precision: int | None = None
+    scale: int | None = None
+    null_ok: bool | None = None
+
+
+class QueryCache:
+    """
+    Long-lived cache of read-only query results: one instance per process.
+    Values are kept pickled, every caller gets its own copy of the result.
+
+    >>> cache = QueryCache(max_entries=10_000, max_bytes=256 * 2**20, ttl=30)
+    >>> async with CachedDataBase(engine, cache) as db:
+    ...     await db.fetchall("SELECT * FROM users WHERE id = %s", 1)  # database
+    ...     await db.fetchall("SELECT * FROM users WHERE id = %s", 1)  # cache
+    ...     await db.execute("UPDATE users SET name = %s", "name")  # drops "users" entries
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        max_bytes: int | None = 64 * 2**20,
+        ttl: float = 60,
+        backend: CacheBackend | None = None,
+    ) -> None:
+        self._local = TTLCache(max_entries=max_entries, max_bytes=max_bytes, ttl=ttl)
+        self._max_entries = max_entries
+        self._backend = backend
+        self._flight = SingleFlight()
+        self._ttl = ttl
+        self._tags: dict[str, set[str]] = {}
+        self._generations: dict[str, int] = {}
+
+    @staticmethod
+    def key(sql: str, args: tuple, row_mode: RowMode | None) -> str:
+        return hashlib.sha1(pickle.dumps((sql, args, row_mode))).hexdigest()
+
+    def _generation(self, tags: frozenset[str]) -> tuple[int, ...]:
+        return tuple(self._generations.get(tag, 0) for tag in sorted(tags))
+
+    def _remember(self, key: str, data: bytes, ttl: float, tags: frozenset[str]) -> None:
+        self._local.set(key, data, ttl, size=len(data))
+        for tag in tags:
+            keys = self._tags.setdefault(tag, set())
+            keys.add(key)
+            if len(keys) > 2 * self._max_entries:
+                # Forget the keys already evicted from the local cache
+                self._tags[tag] = {key for key in keys if key in self._local}
+
+    async def get_or_load(self, key: str, load, ttl: float | None, tags: frozenset[str]):
+        data = self._local.get(key)
+        if data is not None:
+            QUERY_CACHE_HITS.labels(tier="local").inc()
+            return pickle.loads(data)
+
+        async def load_shared() -> bytes:
+            ttl_ = self._ttl if ttl is None else ttl
+            if self._backend and (entry := await self._backend.get(key)) is not None:
+                QUERY_CACHE_HITS.labels(tier="backend").inc()
+                data, expires_in = entry
+                self._remember(key, data, min(ttl_, expires_in), tags)
+                return data
+
+            QUERY_CACHE_MISSES.inc()
+            generation = self._generation(tags)
+            data = pickle.dumps(await load())
+            if generation != self._generation(tags):
+                # The tables were written while the query was running, the result may be stale
+                return data
+            self._remember(key, data, ttl_, tags)
+            if self._backend:
+                await self._backend.set(key, data, ttl_, tags)
+            return data
+
+        data, shared = await self._flight.do(key, load_shared)
+        if shared:
+            QUERY_CACHE_COALESCED.inc()
+        return pickle.loads(data)
+
+    async def invalidate(self, tags: frozenset[str]) -> None:
+        if not tags:
+            return
+        for tag in tags:
+            self._generations[tag] = self._generations.get(tag, 0) + 1
+            for key in self._tags.pop(tag, ()):
+                self._local.pop(key)
+        if self._backend:
+            await self._backend.invalidate(tags)
+        logger.debug(f"Query cache invalidated for {tags=}")
+
+
+class CachedDataBase(DataBase):
+    """
+    DataBase with cached fetchall of the read-only queries, the others run uncached
+    and are handled as writes. Tags are the tables of the query (FROM/JOIN),
+    writes through execute/executemany/copy_in drop the entries of the written tables
+    right away and once more after the commit. Until the commit the queries on the
+    written tables bypass the cache: their results may hold the uncommitted writes.
+    """
+
+    def __init__(
+        self, engine: AsyncConnection, cache: QueryCache, row_mode: RowMode = RowMode.DICT
+    ) -> None:
+        super().__init__(engine, row_mode)
+        self._cache = cache
+        self._written: set[str] = set()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            await super().__aexit__(exc_type, exc, tb)
+        finally:
+            await self._cache.invalidate(frozenset(self._written))
+            self._written.clear()
+
+    async def commit(self) -> None:
+        try:
+            await super().commit()
+        finally:
+            await self._cache.invalidate(frozenset(self._written))
+            self._written.clear()
+
+    async def _invalidate(self, tags: frozenset[str]) -> None:
+        self._written.update(tags)
+        await self._cache.invalidate(tags)
+
+    async def fetchall(
+        self,
+        sql: str,
+        *args,
+        row_mode: RowMode | None = None,
+        ttl: float | None = None,
+        tags: frozenset[str] | None = None,
+    ) -> list | dict:
+        if not is_read_only(sql):
+            # INSERT ... RETURNING, SELECT ... FOR UPDATE, nextval(): run every time
+            rows = await super().fetchall(sql, *args, row_mode=row_mode)
+            await self._invalidate(write_tags(sql))
+            return rows
+
+        tags = read_tags(sql) if tags is None else frozenset(tags)
+        if not self._written.isdisjoint(tags):
+            return await super().fetchall(sql, *args, row_mode=row_mode)
+
+        row_mode = row_mode or self._row_mode
+
+        async def load():
+            rows = await super(CachedDataBase, self).fetchall(sql, *args, row_mode=row_mode)
+            if row_mode == RowMode.RECORD:
+                # The record classes are made on the fly and are not picklable
+                rows = [tuple(row) for row in rows]
+            return [CachedColumn(*column) for column in self._description], rows
+
+        key = self._cache.key(sql, args, row_mode)
+        self._description, rows = await self._cache.get_or_load(key, load, ttl, tags)
+        if row_mode == RowMode.RECORD:
+            record = _record_type(self.column_names)
+            return [record._make(row) for row in rows]
+        return rows
+
+    async def execute(self, sql, *args) -> None:
+        await super().execute(sql, *args)
+        await self._invalidate(write_tags(sql))
+
+    async def executemany(self, sql: str, rows: Rows, batch_size: int = 1000) -> None:
+        await super().executemany(sql, rows, batch_size=batch_size)
+        await self._invalidate(write_tags(sql))
+
+    async def copy_in(
+        self, table: str, rows: Rows, columns=None, binary: bool = False, types=None
+    ) -> int:
+        count = await super().copy_in(table, rows, columns=columns, binary=binary, types=types)
+        await self._invalidate(frozenset([_table_name(table)]))
+        return count
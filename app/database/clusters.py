@@ -1,10 +1,36 @@
+import asyncio
 import logging
+import re
+from contextlib import asynccontextmanager, suppress
 
-from .connection import AsyncConnection
+from app.core.configs import DataBaseSettings
 
+from .connection import ROW_FACTORIES, AsyncConnection, RowMode, Rows
+from .pool import PsycopgPoolConnection
 
 logger = logging.getLogger("stdout")
 
+_COMMENTS = re.compile(r"--[^\n]*|/\*.*?\*/", re.DOTALL)
+_READ_STATEMENTS = ("SELECT", "WITH", "VALUES", "TABLE", "SHOW")
+# Writes, SELECT ... INTO, row locks and sequences; a false positive only costs a primary read
+_WRITE_KEYWORDS = re.compile(
+    r"\b(?:INSERT|UPDATE|DELETE|MERGE|TRUNCATE|CREATE|ALTER|DROP|GRANT|REVOKE|COPY|CALL"
+    r"|LOCK|INTO|SHARE|NEXTVAL|SETVAL)\b",
+    re.IGNORECASE,
+)
+
+
+def is_read_only(sql: str) -> bool:
+    """
+    >>> is_read_only("SELECT * FROM users")
+    True
+    >>> is_read_only("WITH moved AS (DELETE FROM jobs RETURNING *) SELECT * FROM moved")
+    False
+    """
+    statement = _COMMENTS.sub(" ", sql).lstrip(" \t\n(")
+    keyword = statement.split(None, 1)[0].upper() if statement else ""
+    return keyword in _READ_STATEMENTS and not _WRITE_KEYWORDS.search(statement)
+
 
 class DataBase:
     """
@@ -12,20 +38,38 @@ class DataBase:
     >>> async with DataBase(engine) as db:
     ...     await db.execute("SELECT pump_data();")
     ...     await db.fetchall("SELECT 1")
+
+    Hot endpoints can skip the dict per row:
+    >>> async with DataBase(engine, row_mode=RowMode.TUPLE) as db:
+    ...     rows = await db.fetchall("SELECT id, name FROM users")
+    ...     db.column_names  # ('id', 'name')
     """
 
-    def __init__(self, engine: AsyncConnection) -> None:
+    def __init__(self, engine: AsyncConnection, row_mode: RowMode = RowMode.DICT) -> None:
         self._engine = engine
         self._connection = None
+        self._description = None
+        self._row_mode = row_mode
+        # Open server-side cursors, they are closed before the commit
+        self._streams = set()
 
     async def connect(self):
         self._connection = await self._engine.get_connection()
         return self
 
+    async def _close_streams(self):
+        """A stream left by the consumer still holds its cursor and transaction"""
+        while self._streams:
+            await self._streams.pop().aclose()
+
     async def close(self):
         if not self._connection:
             raise RuntimeError("You must use the .connect() first")
-        await self._connection.close()
+        try:
+            await self._close_streams()
+        finally:
+            await self._engine.release(self._connection)
+            self._connection = None
 
     async def __aenter__(self):
         await self.connect()
@@ -33,20 +77,272 @@ class DataBase:
 
     async def __aexit__(self, exc_type, exc, tb):
         try:
-            await self._connection.commit()
+            await self.commit()
         except Exception as e:
             logger.error(e)
         finally:
             await self.close()
 
+    async def commit(self) -> None:
+        """
+        The errors are raised, unlike the ones of the commit on exit.
+        >>> async with DataBase(engine) as db:
+        ...     await db.execute("UPDATE users SET name = %s", "name")
+        ...     await db.commit()  # the caller must know the update is saved
+        """
+        if not self._connection:
+            raise RuntimeError("You must use the .connect() first")
+        await self._close_streams()
+        await self._connection.commit()
+
     async def execute(self, sql, *args) -> None:
         if not self._connection:
             raise RuntimeError("You must use the .connect() first")
         await self._engine.execute(self._connection, sql, *args)
 
-    async def fetchall(self, sql: str, *args) -> list:
-        return await self._engine.fetchall(self._connection, sql, *args)
+    async def executemany(self, sql: str, rows: Rows, batch_size: int = 1000) -> None:
+        if not self._connection:
+            raise RuntimeError("You must use the .connect() first")
+        await self._engine.executemany(self._connection, sql, rows, batch_size=batch_size)
+
+    async def copy_in(
+        self, table: str, rows: Rows, columns=None, binary: bool = False, types=None
+    ) -> int:
+        """
+        Bulk load through COPY. Rows may be a generator or an async generator,
+        they are never collected in memory.
+        >>> async with DataBase(engine) as db:
+        ...     await db.copy_in("public.users", produce_rows(), columns=["id", "name"])
+        ...     await db.copy_in("users", rows, columns=["id"], binary=True, types=["int8"])
+        """
+        if not self._connection:
+            raise RuntimeError("You must use the .connect() first")
+        return await self._engine.copy_in(
+            self._connection, table, rows, columns=columns, binary=binary, types=types
+        )
+
+    async def copy_out(self, query: str, binary: bool = False):
+        if not self._connection:
+            raise RuntimeError("You must use the .connect() first")
+        async for data in self._engine.copy_out(self._connection, query, binary=binary):
+            yield data
+
+    async def fetchall(self, sql: str, *args, row_mode: RowMode | None = None) -> list | dict:
+        """COLUMNAR mode returns one list per column: {"id": [1, 2], "name": ["a", "b"]}"""
+        if not self._connection:
+            raise RuntimeError("You must use the .connect() first")
+        row_mode = row_mode or self._row_mode
+        cursor = await self._engine.cursor(
+            self._connection, sql, *args, row_factory=ROW_FACTORIES[row_mode]
+        )
+        self._description = cursor.description
+        rows = await cursor.fetchall()
+        if row_mode == RowMode.COLUMNAR:
+            return self._to_columns(rows)
+        return rows
+
+    def _to_columns(self, rows: list[tuple]) -> dict[str, list]:
+        columns = zip(*rows, strict=True) if rows else ([] for _ in self.column_names)
+        return dict(zip(self.column_names, map(list, columns), strict=True))
+
+    async def stream_batches(
+        self, sql: str, *args, batch_size: int = 1000, row_mode: RowMode | None = None
+    ):
+        if not self._connection:
+            raise RuntimeError("You must use the .connect() first")
+        row_mode = row_mode or self._row_mode
+        batches = self._engine.stream(
+            self._connection,
+            sql,
+            *args,
+            batch_size=batch_size,
+            row_factory=ROW_FACTORIES[row_mode],
+        )
+        self._streams.add(batches)
+        try:
+            async for batch in batches:
+                yield batch
+        finally:
+            self._streams.discard(batches)
+            await batches.aclose()
+
+    async def stream(self, sql: str, *args, batch_size: int = 1000):
+        """
+        >>> async with DataBase(engine) as db:
+        ...     async for row in db.stream("SELECT * FROM big_table", batch_size=5000):
+        ...         print(row)
+        """
+        async for batch in self.stream_batches(sql, *args, batch_size=batch_size):
+            for row in batch:
+                yield row
 
     @property
     def columns(self):
-        return self._engine.columns
+        if self._description is None:
+            raise RuntimeError("You must use the .fetchall() first")
+        return self._description
+
+    @property
+    def column_names(self) -> tuple[str, ...]:
+        return tuple(column.name for column in self.columns)
+
+
+class Node:
+    __slots__ = ("engine", "healthy", "lag", "name", "outstanding")
+
+    def __init__(self, name: str, engine: AsyncConnection) -> None:
+        self.name = name
+        self.engine = engine
+        self.outstanding = 0
+        self.lag = 0.0
+        self.healthy = True
+
+    def __repr__(self):
+        return (
+            f"Node({self.name}, outstanding={self.outstanding}, lag={self.lag}, "
+            f"healthy={self.healthy})"
+        )
+
+
+class DataBaseCluster:
+    """
+    Primary for writes, replicas for reads, shards for fan-out queries.
+    Read-only statements go to the replica with the least outstanding requests, others
+    (INSERT ... RETURNING, SELECT ... FOR UPDATE) and primary=True go to the primary.
+    Replicas lagging more than max_lag seconds (or not answering) are excluded until
+    they catch up. When no replica is available the primary serves reads.
+
+    >>> cluster = DataBaseCluster.from_settings(get_database_settings())
+    >>> await cluster.open()
+    >>> await cluster.execute("INSERT INTO users VALUES (%s)", 1)  # primary
+    >>> await cluster.fetchall("SELECT * FROM users")  # replica
+    >>> await cluster.fetchall("SELECT * FROM users", primary=True)  # read your writes
+    >>> await cluster.gather("SELECT count(*) FROM events")  # every shard concurrently
+    >>> async with cluster.primary() as db:  # several statements in one transaction
+    ...     await db.execute("UPDATE users SET name = %s", "name")
+    >>> await cluster.close()
+    """
+
+    LAG_SQL = (
+        "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0"
+        " ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)"
+        " END AS lag"
+    )
+
+    def __init__(
+        self,
+        primary: AsyncConnection,
+        replicas: list[AsyncConnection] | tuple = (),
+        shards: list[AsyncConnection] | tuple = (),
+        max_lag: float = 10,
+        check_interval: float = 5,
+    ) -> None:
+        self._primary = Node("primary", primary)
+        self._replicas = [Node(f"replica-{i}", engine) for i, engine in enumerate(replicas)]
+        self._shards = [Node(f"shard-{i}", engine) for i, engine in enumerate(shards)]
+        self._max_lag = max_lag
+        self._check_interval = check_interval
+        self._monitor = None
+
+    @classmethod
+    def from_settings(cls, settings: DataBaseSettings):
+        def pool(name, address=None):
+            pg_dsn = settings.node_dsn(address) if address else None
+            return PsycopgPoolConnection.from_settings(settings, name=name, pg_dsn=pg_dsn)
+
+        return cls(
+            pool("primary"),
+            [pool(f"replica-{i}", address) for i, address in enumerate(settings.replicas)],
+            [pool(f"shard-{i}", address) for i, address in enumerate(settings.shards)],
+            max_lag=settings.replica_max_lag,
+            check_interval=settings.replica_check_interval,
+        )
+
+    @property
+    def nodes(self) -> list[Node]:
+        return [self._primary, *self._replicas, *self._shards]
+
+    @property
+    def engines(self) -> list[AsyncConnection]:
+        return [node.engine for node in self.nodes]
+
+    async def open(self) -> None:
+        await asyncio.gather(*(engine.open() for engine in self.engines))
+        if self._replicas:
+            await self.check_replicas()
+            self._monitor = asyncio.create_task(self._monitor_replicas())
+
+    async def close(self) -> None:
+        if self._monitor:
+            self._monitor.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._monitor
+        await asyncio.gather(*(engine.close() for engine in self.engines))
+
+    async def _check_replica(self, node: Node) -> None:
+        try:
+            # Not through _borrow: the probe doesn't count as outstanding reads
+            async with DataBase(node.engine, RowMode.TUPLE) as db:
+                rows = await db.fetchall(self.LAG_SQL)
+            node.lag = float(rows[0][0])
+            node.healthy = node.lag <= self._max_lag
+        except Exception as e:
+            logger.error(f"Replica {node.name} is unavailable: {e}")
+            node.healthy = False
+
+        if not node.healthy:
+            logger.warning(f"{node} is excluded from reads")
+
+    async def check_replicas(self) -> None:
+        await asyncio.gather(*(self._check_replica(node) for node in self._replicas))
+
+    async def _monitor_replicas(self) -> None:
+        while True:
+            await asyncio.sleep(self._check_interval)
+            await self.check_replicas()
+
+    def _pick_replica(self) -> Node:
+        healthy = [node for node in self._replicas if node.healthy]
+        if not healthy:
+            return self._primary
+        return min(healthy, key=lambda node: node.outstanding)
+
+    @asynccontextmanager
+    async def _borrow(self, node: Node, row_mode: RowMode = RowMode.DICT):
+        node.outstanding += 1
+        try:
+            async with DataBase(node.engine, row_mode) as db:
+                yield db
+        finally:
+            node.outstanding -= 1
+
+    def primary(self, row_mode: RowMode = RowMode.DICT):
+        return self._borrow(self._primary, row_mode)
+
+    def replica(self, row_mode: RowMode = RowMode.DICT):
+        return self._borrow(self._pick_replica(), row_mode)
+
+    async def execute(self, sql: str, *args) -> None:
+        async with self.primary() as db:
+            await db.execute(sql, *args)
+
+    async def fetchall(
+        self, sql: str, *args, row_mode: RowMode | None = None, primary: bool = False
+    ) -> list | dict:
+        borrow = self.primary if primary or not is_read_only(sql) else self.replica
+        async with borrow() as db:
+            return await db.fetchall(sql, *args, row_mode=row_mode)
+
+    async def _fetch_node(self, node: Node, sql: str, args: tuple, row_mode: RowMode | None):
+        async with self._borrow(node) as db:
+            return await db.fetchall(sql, *args, row_mode=row_mode)
+
+    async def gather(
+        self, sql: str, *args, row_mode: RowMode | None = None, return_exceptions: bool = False
+    ) -> list:
+        """Run the query on every shard concurrently, results are in the order of shards"""
+        nodes = self._shards or [self._primary]
+        return await asyncio.gather(
+            *(self._fetch_node(node, sql, args, row_mode) for node in nodes),
+            return_exceptions=return_exceptions,
+        )
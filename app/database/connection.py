@@ -1,7 +1,14 @@
+import uuid
 from abc import ABC, abstractmethod
+from collections.abc import AsyncIterable, AsyncIterator, Iterable, Sequence
+from enum import StrEnum
+from itertools import islice
 
 import psycopg
-from psycopg.rows import dict_row
+from psycopg import sql as psql
+from psycopg.rows import dict_row, namedtuple_row, tuple_row
+
+from .statements import PreparedStatements
 
 # class AsyncDataBase:
 #     def __init__(self, pg_dsn: str) -> None:
@@ -28,11 +35,71 @@ from psycopg.rows import dict_row
 #         await self
 
 
+CONN_ARGS = {
+    "keepalives": 1,
+    "keepalives_idle": 30,
+    "keepalives_interval": 5,
+    "keepalives_count": 5,
+    "connect_timeout": 600,
+}
+
+
+Rows = Iterable[Sequence] | AsyncIterable[Sequence]
+
+
+async def _aiter_rows(rows: Rows) -> AsyncIterator[Sequence]:
+    if isinstance(rows, AsyncIterable):
+        async for row in rows:
+            yield row
+    else:
+        for row in rows:
+            yield row
+
+
+async def _chunks(rows: Rows, size: int) -> AsyncIterator[list[Sequence]]:
+    if not isinstance(rows, AsyncIterable):
+        iterator = iter(rows)
+        while chunk := list(islice(iterator, size)):
+            yield chunk
+        return
+
+    chunk = []
+    async for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class RowMode(StrEnum):
+    DICT = "dict"
+    TUPLE = "tuple"
+    RECORD = "record"
+    COLUMNAR = "columnar"
+
+
+ROW_FACTORIES = {
+    RowMode.DICT: dict_row,
+    RowMode.TUPLE: tuple_row,
+    RowMode.RECORD: namedtuple_row,
+    RowMode.COLUMNAR: tuple_row,
+}
+
+
 class AsyncConnection(ABC):
     @abstractmethod
     async def get_connection(self):
         pass
 
+    async def release(self, connection) -> None:
+        await connection.close()
+
+    @abstractmethod
+    async def cursor(self, connection, sql, *args, row_factory=None):
+        pass
+
     @abstractmethod
     async def execute(self, connection, sql) -> None:
         pass
@@ -41,6 +108,26 @@ class AsyncConnection(ABC):
     async def fetchall(self, connection, sql) -> list:
         pass
 
+    @abstractmethod
+    def stream(
+        self, connection, sql, *args, batch_size: int, row_factory=None
+    ) -> AsyncIterator[list]:
+        pass
+
+    @abstractmethod
+    async def executemany(self, connection, sql, rows: Rows, batch_size: int) -> None:
+        pass
+
+    @abstractmethod
+    async def copy_in(
+        self, connection, table: str, rows: Rows, columns=None, binary=False, types=None
+    ) -> int:
+        pass
+
+    @abstractmethod
+    def copy_out(self, connection, query: str, binary=False) -> AsyncIterator[bytes]:
+        pass
+
     @property
     @abstractmethod
     def columns(self) -> list:
@@ -48,35 +135,88 @@ class AsyncConnection(ABC):
 
 
 class PsycopgAsyncConnection(AsyncConnection):
-    __slots__ = ("_connect", "_pg_dsn", "_cursor")
+    __slots__ = ("_connect", "_cursor", "_pg_dsn", "_statements")
 
-    def __init__(self, pg_dsn: str) -> None:
+    def __init__(self, pg_dsn: str, prepared_cache_size: int = 100) -> None:
         self._connect = psycopg.AsyncConnection
         self._pg_dsn = pg_dsn
         self._cursor = None
+        self._statements = PreparedStatements(prepared_cache_size)
         self._connect.autocommit = True
 
     async def get_connection(self):
-        conn_args = {
-            "keepalives": 1,
-            "keepalives_idle": 30,
-            "keepalives_interval": 5,
-            "keepalives_count": 5,
-            "connect_timeout": 600,
-        }
         return await self._connect.connect(
             conninfo=self._pg_dsn,
             row_factory=dict_row,
-            **conn_args,
+            **CONN_ARGS,
         )
 
+    def register_statements(self, *statements: str) -> None:
+        """Hot statements prepared on their first run, the others on the second one"""
+        self._statements.register(*statements)
+
+    async def cursor(self, connection, sql, *args, row_factory=None):
+        prepare = self._statements.prepare(connection, sql)
+        return await connection.cursor(row_factory=row_factory).execute(sql, args, prepare=prepare)
+
     async def execute(self, connection, sql, *args):
-        await connection.execute(sql, args)
+        await self.cursor(connection, sql, *args)
 
     async def fetchall(self, connection, sql, *args):
-        self._cursor = await connection.execute(sql, args)
+        self._cursor = await self.cursor(connection, sql, *args)
         return await self._cursor.fetchall()
 
+    async def stream(self, connection, sql, *args, batch_size: int = 1000, row_factory=None):
+        # Named cursor lives on the server, so only one batch is held in memory
+        async with connection.transaction():
+            async with connection.cursor(
+                name=f"stream_{uuid.uuid4().hex}", row_factory=row_factory
+            ) as cursor:
+                await cursor.execute(sql, args)
+                while batch := await cursor.fetchmany(batch_size):
+                    yield batch
+
+    async def executemany(self, connection, sql, rows: Rows, batch_size: int = 1000) -> None:
+        # psycopg sends every executemany() batch in the pipeline mode: one round-trip per batch
+        async with connection.cursor() as cursor:
+            async for chunk in _chunks(rows, batch_size):
+                await cursor.executemany(sql, chunk)
+
+    @staticmethod
+    def _copy_statement(table: str, columns, direction: str, binary: bool) -> psql.Composed:
+        statement = psql.SQL("COPY {table}").format(table=psql.Identifier(*table.split(".")))
+        if columns:
+            names = psql.SQL(", ").join(map(psql.Identifier, columns))
+            statement += psql.SQL(" ({})").format(names)
+        statement += psql.SQL(f" {direction}")
+        if binary:
+            statement += psql.SQL(" (FORMAT BINARY)")
+        return statement
+
+    async def copy_in(
+        self, connection, table: str, rows: Rows, columns=None, binary=False, types=None
+    ) -> int:
+        """Rows are pulled from the producer only when the copy buffer has room for them"""
+        count = 0
+        statement = self._copy_statement(table, columns, "FROM STDIN", binary)
+        async with connection.cursor() as cursor:
+            async with cursor.copy(statement) as copy:
+                if types:
+                    copy.set_types(types)
+                async for row in _aiter_rows(rows):
+                    await copy.write_row(row)
+                    count += 1
+        return count
+
+    async def copy_out(self, connection, query: str, binary=False):
+        statement = psql.SQL("COPY ({query}) TO STDOUT").format(query=psql.SQL(query))
+        if binary:
+            statement += psql.SQL(" (FORMAT BINARY)")
+        async with connection.cursor() as cursor:
+            async with cursor.copy(statement) as copy:
+                async for data in copy:
+                    yield bytes(data)
+
     @property
     def columns(self) -> list:
         if not self._cursor:
@@ -0,0 +1,29 @@
+from prometheus_client import Counter, Gauge, Histogram
+
+POOL_IN_USE = Gauge("db_pool_connections_in_use", "Connections borrowed from the pool", ["pool"])
+POOL_IDLE = Gauge("db_pool_connections_idle", "Idle connections kept by the pool", ["pool"])
+POOL_WAITERS = Gauge("db_pool_requests_waiting", "Clients waiting for a connection", ["pool"])
+POOL_CHECKOUT_LATENCY = Histogram(
+    "db_pool_checkout_duration_seconds",
+    "Time spent waiting for a connection from the pool",
+    ["pool"],
+)
+
+PREPARED_HITS = Counter("db_prepared_statements_hits_total", "Statements reused from the cache")
+PREPARED_MISSES = Counter("db_prepared_statements_misses_total", "Statements prepared anew")
+PREPARED_EVICTIONS = Counter(
+    "db_prepared_statements_evictions_total", "Statements evicted from the cache"
+)
+
+QUERY_CACHE_HITS = Counter("db_query_cache_hits_total", "Query results served from cache", ["tier"])
+QUERY_CACHE_MISSES = Counter("db_query_cache_misses_total", "Query results loaded from database")
+QUERY_CACHE_COALESCED = Counter(
+    "db_query_cache_coalesced_total", "Concurrent misses served by one database query"
+)
+
+
+def update_pool_metrics(engine) -> None:
+    stats = engine.stats()
+    POOL_IN_USE.labels(pool=engine.name).set(stats["pool_size"] - stats["pool_available"])
+    POOL_IDLE.labels(pool=engine.name).set(stats["pool_available"])
+    POOL_WAITERS.labels(pool=engine.name).set(stats.get("requests_waiting", 0))
@@ -0,0 +1,75 @@
+import sys
+from collections import OrderedDict
+from collections.abc import Iterable
+from weakref import WeakKeyDictionary
+
+from .metrics import PREPARED_EVICTIONS, PREPARED_HITS, PREPARED_MISSES
+
+
+class PreparedStatements:
+    """
+    Per-connection LRU of prepared statements keyed by the SQL text.
+    Only the registered statements and the ones run again on the same connection are
+    prepared, DDL and one-off queries don't churn the LRU. Behind pgbouncer in the
+    transaction mode set the size to 0: nothing is prepared.
+
+    psycopg keeps the real statements (and DEALLOCATEs the evicted ones) in its
+    own LRU of the same size; here we only mirror it to count hits/misses/evictions.
+    Automatic preparing is switched off, so psycopg's LRU holds only our statements.
+    Caches are held by weak references: a connection recycled by the pool is a new
+    object and starts with an empty cache.
+    """
+
+    def __init__(self, size: int = 100, statements: Iterable[str] = ()) -> None:
+        self._size = size
+        self._registered = set(statements)
+        self._caches: WeakKeyDictionary = WeakKeyDictionary()
+        # Statements run once and not prepared, bounded like the cache
+        self._seen: WeakKeyDictionary = WeakKeyDictionary()
+
+    def register(self, *statements: str) -> None:
+        """The statements are prepared on their first run"""
+        self._registered.update(statements)
+
+    def configure(self, connection) -> None:
+        connection.prepared_max = self._size
+        connection.prepare_threshold = sys.maxsize
+        self._caches[connection] = OrderedDict()
+        self._seen[connection] = OrderedDict()
+
+    def _repeated(self, connection, sql: str) -> bool:
+        seen = self._seen[connection]
+        if sql in seen:
+            del seen[sql]
+            return True
+        seen[sql] = None
+        if len(seen) > self._size:
+            seen.popitem(last=False)
+        return False
+
+    def prepare(self, connection, sql) -> bool:
+        if self._size <= 0 or not isinstance(sql, str):
+            return False
+
+        cache = self._caches.get(connection)
+        if cache is None:
+            self.configure(connection)
+            cache = self._caches[connection]
+
+        if sql in cache:
+            cache.move_to_end(sql)
+            PREPARED_HITS.inc()
+            return True
+        if sql not in self._registered and not self._repeated(connection, sql):
+            return False
+
+        PREPARED_MISSES.inc()
+        cache[sql] = None
+        if len(cache) > self._size:
+            cache.popitem(last=False)
+            PREPARED_EVICTIONS.inc()
+        return True
+
+    def invalidate(self, connection) -> None:
+        self._caches.pop(connection, None)
+        self._seen.pop(connection, None)
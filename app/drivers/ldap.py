@@ -1,6 +1,25 @@
-from typing import Self, Protocol
+import logging
+import threading
+import time
+from collections import deque
+from collections.abc import Callable, Generator
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Protocol, Self
 
-from ldap3 import AUTO_BIND_NO_TLS, NTLM, SAFE_SYNC, Connection, Server
+from ldap3 import (
+    AUTO_BIND_NO_TLS,
+    BASE,
+    NTLM,
+    ROUND_ROBIN,
+    SAFE_SYNC,
+    Connection,
+    Server,
+    ServerPool,
+)
+from ldap3.core.exceptions import LDAPCommunicationError, LDAPException
+
+logger = logging.getLogger("app.drivers.ldap")
 
 
 class LdapException(Exception):
@@ -14,18 +33,33 @@ class LdapConfig(Protocol):
 
     user: str | None = None
     password: str | None = None
+    # Additional domain controllers for round-robin and failover
+    hosts: list[str] | None = None
 
     @property
     def username(self):
         return f"{self.dc}\\{self.user}"
 
 
+def create_server(settings: LdapConfig, exhaust: int = 60) -> Server | ServerPool:
+    hosts = [settings.host, *(getattr(settings, "hosts", None) or [])]
+    if len(hosts) == 1:
+        return Server(settings.host, settings.port, use_ssl=True)
+    # Dead controllers are skipped for `exhaust` seconds
+    return ServerPool(
+        [Server(host, settings.port, use_ssl=True) for host in hosts],
+        ROUND_ROBIN,
+        active=True,
+        exhaust=exhaust,
+    )
+
+
 # For ldap3 library must be installed the pycryptodome library!
 class LdapConnection:
     __slots__ = ("connection", "server")
 
-    def __init__(self, settings: LdapConfig):
-        self.server = Server(settings.host, settings.port, use_ssl=True)
+    def __init__(self, settings: LdapConfig, server: Server | ServerPool | None = None):
+        self.server = server or create_server(settings)
         self.connection = Connection(
             self.server,
             settings.username,
@@ -41,3 +75,231 @@ class LdapConnection:
 
     def __exit__(self, exc_type, exc_value, traceback):
         return self.connection.__exit__(exc_type, exc_value, traceback)
+
+
+@dataclass(slots=True)
+class _Pooled:
+    ldap: LdapConnection
+    released_at: float
+    checked_at: float
+
+
+class LdapPool:
+    """
+    Thread-safe pool of bound connections.
+    Idle connections older than idle_timeout are closed, the ones idle longer than
+    probe_interval are probed by a rootDSE read before use and rebound if it fails.
+    The idle connections are reused newest first, so the oldest ones at the other end
+    are evicted on release and by maintain(), which also refills the pool to min_size.
+    maintain() runs in a background thread every maintenance_interval seconds.
+    The unbinds and binds are done outside of the lock.
+
+    >>> pool = LdapPool(settings, min_size=2, max_size=8)
+    >>> with pool.connection() as ldap:
+    ...     ldap.connection.search(...)
+    >>> pool.close()
+    """
+
+    def __init__(
+        self,
+        settings: LdapConfig,
+        min_size: int = 1,
+        max_size: int = 8,
+        idle_timeout: float = 300,
+        probe_interval: float = 30,
+        timeout: float = 10,
+        maintenance_interval: float | None = 60,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self._settings = settings
+        self._server = create_server(settings)
+        self._min_size = min_size
+        self._max_size = max_size
+        self._idle_timeout = idle_timeout
+        self._probe_interval = probe_interval
+        self._timeout = timeout
+        self._clock = clock
+        self._idle: deque[_Pooled] = deque()
+        self._pooled: dict[int, _Pooled] = {}
+        # Bound connections plus the slots reserved for the binds in progress
+        self._size = 0
+        self._condition = threading.Condition()
+        self._closed = threading.Event()
+        self._refill()
+        self._maintenance = None
+        if maintenance_interval:
+            self._maintenance = threading.Thread(
+                target=self._maintain_every,
+                args=(maintenance_interval,),
+                name="ldap-pool",
+                daemon=True,
+            )
+            self._maintenance.start()
+
+    def _open(self) -> LdapConnection:
+        return LdapConnection(self._settings, self._server)
+
+    def _connect(self) -> _Pooled:
+        """Binds a connection in the slot reserved by the caller, the slot is freed on error"""
+        try:
+            now = self._clock()
+            pooled = _Pooled(self._open(), now, now)
+        except Exception:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+        with self._condition:
+            self._pooled[id(pooled.ldap)] = pooled
+        return pooled
+
+    def _forget(self, pooled: _Pooled) -> None:
+        """Under the lock: the connection leaves the pool and frees its slot"""
+        self._pooled.pop(id(pooled.ldap), None)
+        self._size -= 1
+        self._condition.notify()
+
+    @staticmethod
+    def _unbind(pooled: _Pooled) -> None:
+        try:
+            pooled.ldap.connection.unbind()
+        except LDAPException as e:
+            logger.debug(f"Unbind is failed: {e}")
+
+    @staticmethod
+    def _alive(ldap: LdapConnection) -> bool:
+        connection = ldap.connection
+        if connection.closed or not connection.bound:
+            return False
+        try:
+            status, *_ = connection.search(
+                "", "(objectClass=*)", search_scope=BASE, attributes=["currentTime"]
+            )
+            return bool(status)
+        except LDAPException:
+            return False
+
+    def _evict_idle(self) -> list[_Pooled]:
+        """Under the lock: forgets the connections idle longer than idle_timeout"""
+        expired = []
+        now = self._clock()
+        while self._idle and now - self._idle[0].released_at > self._idle_timeout:
+            pooled = self._idle.popleft()
+            self._forget(pooled)
+            expired.append(pooled)
+        return expired
+
+    def _refill(self) -> None:
+        with self._condition:
+            missing = 0 if self._closed.is_set() else self._min_size - self._size
+            self._size += max(0, missing)
+        for reserved in range(missing, 0, -1):
+            try:
+                pooled = self._connect()
+            except Exception:
+                # The slot of the failed bind is freed by _connect, the rest are here
+                with self._condition:
+                    self._size -= reserved - 1
+                    self._condition.notify_all()
+                raise
+            self.release(pooled.ldap)
+
+    def maintain(self) -> None:
+        """Closes the expired idle connections and opens new ones up to min_size"""
+        with self._condition:
+            expired = self._evict_idle()
+        for pooled in expired:
+            self._unbind(pooled)
+        try:
+            self._refill()
+        except Exception as e:
+            logger.warning(f"LDAP pool refill is failed: {e}")
+
+    def _maintain_every(self, interval: float) -> None:
+        while not self._closed.wait(interval):
+            try:
+                self.maintain()
+            except Exception as e:
+                logger.error(f"LDAP pool maintenance is failed: {e}")
+
+    def acquire(self) -> LdapConnection:
+        deadline = self._clock() + self._timeout
+        expired = []
+        with self._condition:
+            while True:
+                if self._closed.is_set():
+                    raise LdapException("Pool is closed")
+                expired += self._evict_idle()
+                if self._idle:
+                    pooled = self._idle.pop()
+                    break
+                if self._size < self._max_size:
+                    # The slot is reserved, the bind is done outside of the lock
+                    self._size += 1
+                    pooled = None
+                    break
+                remaining = deadline - self._clock()
+                if remaining <= 0 or not self._condition.wait(remaining):
+                    raise LdapException(f"No free LDAP connection in {self._timeout}s")
+        for stale in expired:
+            self._unbind(stale)
+
+        if pooled is not None:
+            if self._clock() - pooled.checked_at <= self._probe_interval:
+                return pooled.ldap
+            if self._alive(pooled.ldap):
+                pooled.checked_at = self._clock()
+                return pooled.ldap
+            logger.warning("LDAP connection is lost, rebinding")
+            # The slot of the lost connection is kept for the new one
+            with self._condition:
+                self._pooled.pop(id(pooled.ldap), None)
+            self._unbind(pooled)
+        return self._connect().ldap
+
+    def release(self, ldap: LdapConnection, broken: bool = False) -> None:
+        discarded = []
+        with self._condition:
+            pooled = self._pooled.get(id(ldap))
+            if pooled is None:
+                return
+            if broken or self._closed.is_set():
+                self._forget(pooled)
+                discarded.append(pooled)
+            else:
+                pooled.released_at = self._clock()
+                self._idle.append(pooled)
+                self._condition.notify()
+            discarded += self._evict_idle()
+        for pooled in discarded:
+            self._unbind(pooled)
+
+    @contextmanager
+    def connection(self) -> Generator[LdapConnection, None, None]:
+        ldap = self.acquire()
+        broken = False
+        try:
+            yield ldap
+        except LDAPCommunicationError:
+            # The server has gone away, the connection is not returned to the pool
+            broken = True
+            raise
+        finally:
+            self.release(ldap, broken)
+
+    def stats(self) -> dict[str, int]:
+        with self._condition:
+            return {"size": self._size, "idle": len(self._idle)}
+
+    def close(self) -> None:
+        with self._condition:
+            self._closed.set()
+            idle = list(self._idle)
+            self._idle.clear()
+            for pooled in idle:
+                self._forget(pooled)
+            self._condition.notify_all()
+        for pooled in idle:
+            self._unbind(pooled)
+        if self._maintenance is not None and self._maintenance is not threading.current_thread():
+            self._maintenance.join()
@@ -1,24 +1,77 @@
-import json
-from collections.abc import Callable
+import asyncio
+import logging
+import time
+from collections.abc import AsyncIterator, Callable, Iterable
+from dataclasses import dataclass, field
 from json import JSONDecodeError
-from typing import Any, TypeAlias
+from typing import Any, ClassVar, TypeAlias
 
-from httpx import AsyncClient
+from httpx import URL, Response
 
 from app.configs import get_logger
 
-from .exceptions import HTTPException
+from .cache import HttpCache
+from .client import HttpClients, http_clients
+from .codec import JsonArrayParser, JsonCodec, default_codec
+from .exceptions import CircuitOpenError, HTTPException
+from .metrics import API_CIRCUIT_REJECTED, API_HEDGE_WINS, API_HEDGED, API_LATENCY, API_RETRIES
+from .ratelimit import host_bucket
+from .resilience import (
+    BreakerPolicy,
+    HedgePolicy,
+    RetryPolicy,
+    hedge_delay,
+    host_breaker,
+    host_latencies,
+)
 
 Json: TypeAlias = str
 
 
+@dataclass(slots=True)
+class ApiRequest:
+    url: str
+    query_params: dict | None = None
+    method: str = "GET"
+    headers: dict | None = None
+    kwargs: dict = field(default_factory=dict)
+
+
+@dataclass(slots=True)
+class BatchResult:
+    """
+    results and statuses are in the order of requests, None on the place of the failed
+    results, status -1 for the network errors
+    """
+
+    results: list[dict | None]
+    errors: dict[int, HTTPException]
+    statuses: list[int] = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return not self.errors
+
+
 class BaseApi:
     logger = get_logger()
+    DEFAULT_HEADERS: ClassVar[dict[str, str]] = {"Content-Type": "application/json"}
+    # Requests per second to the host, shared by all instances; None - no limit
+    RATE_LIMIT: float | None = None
+    RATE_BURST: float | None = None
+    # Resilience of the outbound requests, None switches the feature off
+    RETRY: RetryPolicy | None = RetryPolicy()
+    CIRCUIT_BREAKER: BreakerPolicy | None = BreakerPolicy()
+    HEDGE: HedgePolicy | None = None
+    CODEC: JsonCodec = default_codec()
+    # Opt-in cache of GET responses, shared by all instances of the class
+    HTTP_CACHE: HttpCache | None = None
 
-    def __init__(self, url: str):
-        self.HEADERS = {"Content-Type": "application/json"}
+    def __init__(self, url: str, clients: HttpClients = http_clients):
+        self.HEADERS = dict(self.DEFAULT_HEADERS)
         self.URL: str = url
         self._status_code: int = -1
+        self._clients = clients
 
     @staticmethod
     def _validateJson(jsondata: Callable[[], dict[str, str]]) -> dict[str, str] | None:
@@ -31,35 +84,297 @@ class BaseApi:
         return self.URL + url
         # return urljoin(self.URL, url)
 
-    async def _request(self, url, query_params=None, method="GET", **kwargs) -> dict:
+    def _headers(self, headers: dict | None) -> dict:
+        """
+        Without headers the one-shot self.HEADERS are used and reset after the call.
+        Concurrent callers must pass headers explicitly, nothing is shared then.
+        """
+        if headers is None:
+            headers, self.HEADERS = self.HEADERS, dict(self.DEFAULT_HEADERS)
+        return headers
+
+    async def _request(
+        self, url, query_params=None, method="GET", headers: dict | None = None, **kwargs
+    ) -> dict:
+        """
+        self.status_code is the status of the latest call only,
+        concurrent callers get the status from _request_with_status
+        """
+        status_code, response_json = await self._request_with_status(
+            url, query_params, method, headers, **kwargs
+        )
+        self.status_code = status_code
+        return response_json
+
+    async def _request_with_status(
+        self, url, query_params=None, method="GET", headers: dict | None = None, **kwargs
+    ) -> tuple[int, dict]:
+        headers = self._headers(headers)
         url = self._concat_url(url)
-        self.logger.debug(f"{url}, {query_params=}, {self.HEADERS=}")
+        self.logger.debug("%s, query_params=%s, headers=%s", url, query_params, headers)
 
         try:
-            async with AsyncClient(follow_redirects=True) as client:
-                self._response = await client.request(
-                    method=method,
-                    url=url,
+            if self.HTTP_CACHE and method.upper() == "GET":
+                response = await self.HTTP_CACHE.get(
+                    self.HTTP_CACHE.key(url, query_params, headers),
+                    URL(self.URL).host,
+                    headers,
+                    lambda headers: self._send_with_retries(
+                        method, url, params=query_params, headers=headers, **kwargs
+                    ),
+                )
+            else:
+                response = await self._send_with_retries(
+                    method,
+                    url,
                     params=query_params,
-                    headers=self.HEADERS,
+                    headers=headers,
                     **kwargs,
                 )
         except Exception as e:
             self.logger.error(f"Error while request: {e=}")
             raise e
-        finally:
-            self.HEADERS = {"Content-Type": "application/json"}
 
-        self.status_code = self._response.status_code
-        self.logger.debug(self.status_code)
-        self.logger.debug(self._response.text)
-        if self._response.status_code > 300:
-            raise HTTPException(self._response.status_code, self._response.text)
+        self.logger.debug(response.status_code)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            # Don't decode the big bodies only to drop them
+            self.logger.debug(response.text)
+        if response.status_code > 300:
+            raise HTTPException(response.status_code, response.text)
 
-        response_json = self._validateJson(self._response.json)
+        response_json = self._validateJson(lambda: self.CODEC.loads(response.content))
         if response_json:
-            return response_json
-        return {"text": self._response.text}
+            return response.status_code, response_json
+        return response.status_code, {"text": response.text}
+
+    async def stream(
+        self, url, query_params=None, method="GET", headers: dict | None = None, **kwargs
+    ) -> AsyncIterator[bytes]:
+        """
+        Body of the response chunk by chunk, it is never buffered whole.
+        The stream is not retried or hedged: a part of it may be consumed already.
+
+        >>> async for chunk in api.stream("/export"):
+        ...     file.write(chunk)
+        """
+        headers = self._headers(headers)
+        url = self._concat_url(url)
+        self.logger.debug("stream %s, query_params=%s", url, query_params)
+
+        host = URL(self.URL).host
+        breaker = host_breaker(host, self.CIRCUIT_BREAKER) if self.CIRCUIT_BREAKER else None
+        request = object()
+        if breaker and not breaker.allow(request):
+            API_CIRCUIT_REJECTED.labels(host=host).inc()
+            raise CircuitOpenError(host)
+
+        client = self._clients.get(self.URL)
+        try:
+            if self.RATE_LIMIT:
+                await host_bucket(host, self.RATE_LIMIT, self.RATE_BURST).acquire()
+            async with client.stream(
+                method, url, params=query_params, headers=headers, **kwargs
+            ) as response:
+                if breaker:
+                    if response.status_code >= 500:
+                        breaker.record_failure()
+                    else:
+                        breaker.record_success()
+                if response.status_code > 300:
+                    await response.aread()
+                    raise HTTPException(response.status_code, response.text)
+                async for chunk in response.aiter_bytes():
+                    yield chunk
+        except HTTPException:
+            raise
+        except (asyncio.CancelledError, GeneratorExit):
+            # Cancelled or closed by the consumer: the probe, if it is ours, is given back
+            if breaker:
+                breaker.abandon(request)
+            raise
+        except Exception as e:
+            if breaker:
+                breaker.record_failure()
+            self.logger.error(f"Error while stream: {e=}")
+            raise e
+
+    async def stream_lines(self, url, query_params=None, **kwargs) -> AsyncIterator[Any]:
+        """NDJSON: one decoded record per line"""
+        tail = b""
+        async for chunk in self.stream(url, query_params, **kwargs):
+            lines = (tail + chunk).split(b"\n")
+            tail = lines.pop()
+            for line in lines:
+                if line.strip():
+                    yield self.CODEC.loads(line)
+        if tail.strip():
+            yield self.CODEC.loads(tail)
+
+    async def stream_items(self, url, query_params=None, **kwargs) -> AsyncIterator[Any]:
+        """Items of the top-level JSON array, parsed while the body is downloading"""
+        parser = JsonArrayParser(self.CODEC.loads)
+        async for chunk in self.stream(url, query_params, **kwargs):
+            for item in parser.feed(chunk):
+                yield item
+        for item in parser.close():
+            yield item
+
+    async def _send(self, host: str, method: str, url: str, **kwargs) -> Response:
+        """One attempt through the rate limit and the circuit breaker of the host"""
+        breaker = host_breaker(host, self.CIRCUIT_BREAKER) if self.CIRCUIT_BREAKER else None
+        request = object()
+        if breaker and not breaker.allow(request):
+            API_CIRCUIT_REJECTED.labels(host=host).inc()
+            raise CircuitOpenError(host)
+
+        try:
+            if self.RATE_LIMIT:
+                await host_bucket(host, self.RATE_LIMIT, self.RATE_BURST).acquire()
+            start_time = time.perf_counter()
+            response = await self._clients.get(self.URL).request(method=method, url=url, **kwargs)
+        except asyncio.CancelledError:
+            if breaker:
+                breaker.abandon(request)
+            raise
+        except Exception:
+            if breaker:
+                breaker.record_failure()
+            raise
+
+        latency = time.perf_counter() - start_time
+        API_LATENCY.labels(host=host, method=method).observe(latency)
+        if self.HEDGE:
+            host_latencies(host, self.HEDGE.window).add(latency)
+        if breaker:
+            if response.status_code >= 500:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+        return response
+
+    async def _send_hedged(self, host: str, method: str, url: str, **kwargs) -> Response:
+        if not self.HEDGE or method.upper() not in self.HEDGE.methods:
+            return await self._send(host, method, url, **kwargs)
+
+        first = asyncio.create_task(self._send(host, method, url, **kwargs))
+        pending = {first}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=hedge_delay(host, self.HEDGE))
+            if done:
+                return first.result()
+
+            API_HEDGED.labels(host=host).inc()
+            second = asyncio.create_task(self._send(host, method, url, **kwargs))
+            pending.add(second)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            API_HEDGE_WINS.labels(host=host).inc()
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            # The losing attempt, or both when the caller is cancelled: the connections
+            # and the probe of the breaker are given back before leaving
+            pending = {task for task in pending if not task.done()}
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending)
+
+    @staticmethod
+    def _retry_after(response: Response) -> float | None:
+        try:
+            return float(response.headers["Retry-After"])
+        except (KeyError, ValueError):
+            return None
+
+    async def _send_with_retries(self, method: str, url: str, **kwargs) -> Response:
+        host = URL(self.URL).host
+        policy = self.RETRY
+        attempt = 0
+        while True:
+            last_attempt = not policy or attempt + 1 >= policy.attempts
+            try:
+                response = await self._send_hedged(host, method, url, **kwargs)
+            except CircuitOpenError:
+                raise
+            except Exception as e:
+                if last_attempt or not policy.retryable(method):
+                    raise
+                delay = policy.delay(attempt)
+                self.logger.warning(f"Retry {method} {url} after error: {e=}")
+            else:
+                if last_attempt or not policy.retryable(method, response.status_code):
+                    return response
+                delay = policy.delay(attempt, self._retry_after(response))
+                self.logger.warning(f"Retry {method} {url} after {response.status_code}")
+
+            attempt += 1
+            API_RETRIES.labels(host=host).inc()
+            await asyncio.sleep(delay)
+
+    async def _request_one(self, index: int, request: ApiRequest, semaphore: asyncio.Semaphore):
+        async with semaphore:
+            try:
+                return index, *await self._request_with_status(
+                    request.url,
+                    request.query_params,
+                    request.method,
+                    headers={**self.DEFAULT_HEADERS, **(request.headers or {})},
+                    **request.kwargs,
+                )
+            except HTTPException as e:
+                return index, e.status_code, e
+            except Exception as e:
+                return index, -1, HTTPException(-1, f"{type(e).__name__}: {e}")
+
+    async def iter_many(
+        self, requests: Iterable[ApiRequest], concurrency: int = 10
+    ) -> AsyncIterator[tuple[int, int, dict | HTTPException]]:
+        """
+        Yields (index of the request, status, response or HTTPException) as they complete.
+        self.status_code is not touched, it would be the status of a random request.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+        tasks = [
+            asyncio.create_task(self._request_one(index, request, semaphore))
+            for index, request in enumerate(requests)
+        ]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def request_many(
+        self, requests: Iterable[ApiRequest], concurrency: int = 10
+    ) -> BatchResult:
+        """
+        >>> result = await api.request_many(
+        ...     [ApiRequest(f"/users/{user_id}") for user_id in user_ids], concurrency=20
+        ... )
+        >>> result.results  # in the order of requests
+        >>> result.errors  # {index: HTTPException}, status_code -1 for network errors
+        >>> result.statuses  # [200, 404, -1, ...]
+        """
+        requests = list(requests)
+        results: list[dict | None] = [None] * len(requests)
+        errors: dict[int, HTTPException] = {}
+        statuses = [-1] * len(requests)
+        async for index, status_code, result in self.iter_many(requests, concurrency):
+            statuses[index] = status_code
+            if isinstance(result, HTTPException):
+                errors[index] = result
+            else:
+                results[index] = result
+        if errors:
+            self.logger.warning(f"{len(errors)} of {len(requests)} requests are failed")
+        return BatchResult(results, errors, statuses)
 
     @property
     def status_code(self) -> int:
@@ -69,10 +384,10 @@ class BaseApi:
     def status_code(self, value: int) -> None:
         self._status_code = value
 
-    @staticmethod
-    def dump(data: dict) -> Json | str:
-        return json.dumps(data)
+    @classmethod
+    def dump(cls, data: dict) -> Json | str:
+        return cls.CODEC.dumps(data)
 
-    @staticmethod
-    def serialize(data: Json) -> dict[Any, Any]:
-        return json.loads(data)
+    @classmethod
+    def serialize(cls, data: Json) -> dict[Any, Any]:
+        return cls.CODEC.loads(data)
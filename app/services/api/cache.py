@@ -0,0 +1,203 @@
+import time
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+
+from httpx import QueryParams, Response
+
+from app.core.cache import SingleFlight, TTLCache
+
+from .metrics import API_CACHE_HITS, API_CACHE_MISSES, API_CACHE_REVALIDATIONS
+
+_CACHEABLE_STATUSES = frozenset({200, 203, 300, 301, 404, 410})
+# The content is stored already decoded
+_SKIP_HEADERS = frozenset({"content-encoding", "content-length", "transfer-encoding"})
+
+
+def _stored_headers(headers) -> dict[str, str]:
+    return {
+        name.lower(): value for name, value in headers.items() if name.lower() not in _SKIP_HEADERS
+    }
+
+
+@dataclass(slots=True)
+class CachedResponse:
+    status_code: int
+    headers: dict[str, str]
+    content: bytes
+    fresh_until: float
+    # Values of the request headers named by the Vary header of the response
+    vary: dict[str, str | None]
+
+    @property
+    def etag(self) -> str | None:
+        return self.headers.get("etag")
+
+    @property
+    def last_modified(self) -> str | None:
+        return self.headers.get("last-modified")
+
+    @property
+    def fresh(self) -> bool:
+        return time.time() < self.fresh_until
+
+    def matches(self, headers: dict) -> bool:
+        return self.vary == _vary_values(self.vary, headers)
+
+    def to_response(self) -> Response:
+        return Response(self.status_code, headers=self.headers, content=self.content)
+
+
+def _cache_control(headers) -> dict[str, str | None]:
+    directives = {}
+    for directive in headers.get("cache-control", "").split(","):
+        name, _, value = directive.strip().partition("=")
+        if name:
+            directives[name.lower()] = value.strip('"') or None
+    return directives
+
+
+def _vary_values(names, headers: dict) -> dict[str, str | None]:
+    headers = {name.lower(): value for name, value in headers.items()}
+    return {name: headers.get(name) for name in names}
+
+
+def _age(headers) -> float:
+    try:
+        return max(0.0, float(headers.get("age", 0)))
+    except ValueError:
+        return 0.0
+
+
+def _lifetime(headers, default_ttl: float) -> float | None:
+    directives = _cache_control(headers)
+    # The cache is keyed by Authorization, so "private" responses may be stored too
+    if "no-store" in directives:
+        return None
+    if "no-cache" in directives:
+        return 0
+    for name in ("s-maxage", "max-age"):
+        if directives.get(name):
+            try:
+                return max(0.0, float(directives[name]))
+            except ValueError:
+                return 0
+    if expires := headers.get("expires"):
+        try:
+            date = headers.get("date")
+            now = parsedate_to_datetime(date).timestamp() if date else time.time()
+            return max(0.0, parsedate_to_datetime(expires).timestamp() - now)
+        except (TypeError, ValueError):
+            return 0
+    return default_ttl
+
+
+def freshness(headers, default_ttl: float = 0) -> float | None:
+    """
+    Seconds the response stays fresh: its lifetime minus the Age it spent in the
+    upstream caches. None if it must not be stored.
+    """
+    lifetime = _lifetime(headers, default_ttl)
+    if lifetime is None:
+        return None
+    return max(0.0, lifetime - _age(headers))
+
+
+class HttpCache:
+    """
+    Cache of GET responses: honours Cache-Control/Expires, revalidates the stale
+    entries with If-None-Match/If-Modified-Since, coalesces concurrent identical
+    requests. Stale entries are kept for stale_ttl seconds to be revalidated.
+    One variant is kept per key: the entry is used only when the request headers named
+    by the Vary header of the response are the same, "Vary: *" is never stored.
+
+    >>> class ReferenceApi(BaseApi):
+    ...     HTTP_CACHE = HttpCache(max_bytes=32 * 2**20)
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        max_bytes: int = 32 * 2**20,
+        default_ttl: float = 0,
+        stale_ttl: float = 24 * 3600,
+    ) -> None:
+        self._entries = TTLCache(max_entries=max_entries, max_bytes=max_bytes, ttl=stale_ttl)
+        self._flight = SingleFlight()
+        self._default_ttl = default_ttl
+
+    @staticmethod
+    def key(url: str, params, headers: dict) -> tuple:
+        """params are anything httpx accepts: dict, list of pairs, string"""
+        params = tuple(sorted(QueryParams(params).multi_items()))
+        vary = tuple(
+            (name, value)
+            for name, value in sorted(headers.items())
+            if name.lower() in {"accept", "authorization", "accept-language"}
+        )
+        return url, params, vary
+
+    def _store(self, key: tuple, headers: dict, response: Response) -> None:
+        ttl = freshness(response.headers, self._default_ttl)
+        vary = [name.strip().lower() for name in response.headers.get("vary", "").split(",")]
+        if ttl is None or response.status_code not in _CACHEABLE_STATUSES or "*" in vary:
+            self._entries.pop(key)
+            return
+        entry = CachedResponse(
+            response.status_code,
+            _stored_headers(response.headers),
+            response.content,
+            time.time() + ttl,
+            _vary_values(filter(None, vary), headers),
+        )
+        if ttl or entry.etag or entry.last_modified:
+            self._entries.set(key, entry, size=len(entry.content) + 512)
+        else:
+            # Neither fresh nor revalidatable: the old entry must not be used either
+            self._entries.pop(key)
+
+    async def get(
+        self,
+        key: tuple,
+        host: str,
+        headers: dict,
+        send: Callable[[dict], Awaitable[Response]],
+    ) -> Response:
+        """send makes the real request with the given headers"""
+        entry = variant = self._entries.get(key)
+        if entry and not entry.matches(headers):
+            entry = None
+        if entry and entry.fresh:
+            API_CACHE_HITS.labels(host=host).inc()
+            return entry.to_response()
+
+        async def load() -> Response:
+            request_headers = dict(headers)
+            if entry and entry.etag:
+                request_headers["If-None-Match"] = entry.etag
+            if entry and entry.last_modified:
+                request_headers["If-Modified-Since"] = entry.last_modified
+
+            response = await send(request_headers)
+            if entry and response.status_code == 304:
+                API_CACHE_REVALIDATIONS.labels(host=host).inc()
+                entry.headers.pop("age", None)
+                entry.headers.update(_stored_headers(response.headers))
+                ttl = freshness(entry.headers, self._default_ttl) or 0
+                entry.fresh_until = time.time() + ttl
+                return entry.to_response()
+
+            API_CACHE_MISSES.labels(host=host).inc()
+            self._store(key, headers, response)
+            return response
+
+        # Requests for the other variants of the last response are not coalesced with it
+        if variant:
+            flight_key = (key, *sorted(_vary_values(variant.vary, headers).items()))
+        else:
+            flight_key = key
+        response, _ = await self._flight.do(flight_key, load)
+        return response
+
+    def clear(self) -> None:
+        self._entries.clear()
@@ -0,0 +1,50 @@
+import logging
+
+from httpx import AsyncClient, Limits, Timeout
+
+from app.configs import get_http_client_settings
+from app.core.configs import HttpClientSettings
+
+logger = logging.getLogger("stdout")
+
+
+class HttpClients:
+    """
+    Long-lived AsyncClient per base url: connections are kept alive between requests.
+    Clients are created on the first request and must be closed on shutdown.
+
+    >>> client = http_clients.get("https://example.com")
+    >>> await http_clients.aclose()  # in the lifespan hook
+    """
+
+    def __init__(self, settings: HttpClientSettings | None = None) -> None:
+        self._settings = settings
+        self._clients: dict[str, AsyncClient] = {}
+
+    def _create(self) -> AsyncClient:
+        settings = self._settings or get_http_client_settings()
+        return AsyncClient(
+            follow_redirects=True,
+            http2=settings.http2,
+            timeout=Timeout(settings.timeout, connect=settings.connect_timeout),
+            limits=Limits(
+                max_connections=settings.max_connections,
+                max_keepalive_connections=settings.max_keepalive_connections,
+                keepalive_expiry=settings.keepalive_expiry,
+            ),
+        )
+
+    def get(self, base_url: str) -> AsyncClient:
+        client = self._clients.get(base_url)
+        if client is None or client.is_closed:
+            client = self._clients[base_url] = self._create()
+            logger.debug(f"HTTP client for {base_url} is created")
+        return client
+
+    async def aclose(self) -> None:
+        clients, self._clients = self._clients, {}
+        for client in clients.values():
+            await client.aclose()
+
+
+http_clients = HttpClients()
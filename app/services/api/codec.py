@@ -0,0 +1,145 @@
+import codecs
+import json
+import re
+from collections.abc import Callable
+from typing import Any
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+class JsonCodec:
+    @staticmethod
+    def dumps(data: Any) -> str:
+        return json.dumps(data)
+
+    @staticmethod
+    def loads(data: str | bytes) -> Any:
+        return json.loads(data)
+
+
+class OrjsonCodec(JsonCodec):
+    """orjson.JSONDecodeError is a subclass of json.JSONDecodeError"""
+
+    @staticmethod
+    def dumps(data: Any) -> str:
+        return orjson.dumps(data).decode()
+
+    @staticmethod
+    def loads(data: str | bytes) -> Any:
+        return orjson.loads(data)
+
+
+def default_codec() -> JsonCodec:
+    return OrjsonCodec() if orjson else JsonCodec()
+
+
+class JsonArrayParser:
+    """
+    Incremental parser of the top-level JSON array: feed it chunks of bytes,
+    it returns the items completed so far. Only the unfinished item stays in memory.
+    An item is decoded once, when the "," or "]" after it arrives; the scan of the
+    unfinished item resumes where the previous chunk ended.
+
+    >>> parser = JsonArrayParser()
+    >>> parser.feed(b'[{"id": 1}, {"i')
+    [{'id': 1}]
+    >>> parser.feed(b'd": 2}]')
+    [{'id': 2}]
+    """
+
+    _structure = re.compile(r'[\[\]{}",]')
+    _string_end = re.compile(r'["\\]')
+
+    def __init__(self, loads: Callable[[str], Any] = json.loads) -> None:
+        self._loads = loads
+        self._text = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        # Where the scan of the unfinished item resumes, in the buffer
+        self._position = 0
+        self._depth = 0
+        self._in_string = False
+        self._started = False
+        self._count = 0
+        self.finished = False
+
+    def _start(self, buffer: str) -> str | None:
+        stripped = buffer.lstrip()
+        if not stripped:
+            return None
+        if stripped[0] != "[":
+            raise json.JSONDecodeError("Expecting '['", buffer, len(buffer) - len(stripped))
+        self._started = True
+        return stripped[1:]
+
+    def _item(self, buffer: str, start: int, end: int, closing: bool) -> list[Any]:
+        text = buffer[start:end]
+        if text.strip():
+            self._count += 1
+            return [self._loads(text)]
+        if closing and not self._count:
+            return []  # empty array
+        raise json.JSONDecodeError("Expecting value", buffer, end)
+
+    def feed(self, chunk: bytes) -> list[Any]:
+        buffer = self._buffer + self._text.decode(chunk)
+        if self.finished:
+            if buffer.strip():
+                raise json.JSONDecodeError("Extra data", buffer, 0)
+            return []
+        if not self._started and (buffer := self._start(buffer)) is None:
+            return []
+
+        items = []
+        start = 0
+        position = self._position
+        while True:
+            if self._in_string:
+                match = self._string_end.search(buffer, position)
+                if match is None:
+                    position = len(buffer)
+                    break
+                if match.group() == "\\":
+                    if match.end() == len(buffer):
+                        # The escaped character is in the next chunk
+                        position = match.start()
+                        break
+                    position = match.end() + 1
+                    continue
+                self._in_string = False
+                position = match.end()
+                continue
+
+            match = self._structure.search(buffer, position)
+            if match is None:
+                position = len(buffer)
+                break
+            char, position = match.group(), match.end()
+            if char == '"':
+                self._in_string = True
+            elif char in "[{":
+                self._depth += 1
+            elif self._depth:
+                if char in "]}":
+                    self._depth -= 1
+            elif char != "}":
+                # "," or "]" of the top-level array, a stray "}" is left to the decoder
+                items += self._item(buffer, start, match.start(), closing=char == "]")
+                start = position
+                if char == "]":
+                    self.finished = True
+                    if buffer[position:].strip():
+                        raise json.JSONDecodeError("Extra data", buffer, position)
+                    start = position = len(buffer)
+                    break
+        self._buffer = buffer[start:]
+        self._position = position - start
+        return items
+
+    def close(self) -> list[Any]:
+        items = self.feed(b"")
+        if not self.finished:
+            raise json.JSONDecodeError("Unterminated array", self._buffer, 0)
+        return items
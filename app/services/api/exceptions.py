@@ -6,3 +6,8 @@ class HTTPException(Exception):
 
     def __str__(self):
         return f"{self.status_code}: {self.detail}"
+
+
+class CircuitOpenError(HTTPException):
+    def __init__(self, host):
+        super().__init__(503, f"Circuit breaker is open for {host}")
@@ -0,0 +1,20 @@
+from prometheus_client import Counter, Gauge, Histogram
+
+API_LATENCY = Histogram(
+    "api_client_request_duration_seconds", "Outbound request duration", ["host", "method"]
+)
+API_RETRIES = Counter("api_client_retries_total", "Retried outbound requests", ["host"])
+API_HEDGED = Counter("api_client_hedged_total", "Hedged requests fired", ["host"])
+API_HEDGE_WINS = Counter("api_client_hedge_wins_total", "Hedged requests answered first", ["host"])
+API_CIRCUIT_STATE = Gauge(
+    "api_client_circuit_open", "1 if the circuit breaker is open (0.5 - half-open)", ["host"]
+)
+API_CIRCUIT_REJECTED = Counter(
+    "api_client_circuit_rejected_total", "Requests rejected by the open circuit", ["host"]
+)
+
+API_CACHE_HITS = Counter("api_client_cache_hits_total", "GET responses served from cache", ["host"])
+API_CACHE_MISSES = Counter("api_client_cache_misses_total", "GET responses downloaded", ["host"])
+API_CACHE_REVALIDATIONS = Counter(
+    "api_client_cache_revalidations_total", "Cached GET responses confirmed by 304", ["host"]
+)
@@ -0,0 +1,44 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """
+    rate - tokens added per second, capacity - the biggest burst.
+
+    >>> bucket = TokenBucket(rate=50, capacity=10)
+    >>> await bucket.acquire()
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None) -> None:
+        self._rate = rate
+        self._capacity = capacity or rate
+        self._tokens = self._capacity
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated_at) * self._rate)
+        self._updated_at = now
+
+    async def acquire(self) -> None:
+        # The lock keeps the waiters in FIFO order
+        async with self._lock:
+            self._refill()
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self._rate)
+                self._refill()
+            self._tokens -= 1
+
+
+_buckets: dict[tuple[str, float, float | None], TokenBucket] = {}
+
+
+def host_bucket(host: str, rate: float, capacity: float | None = None) -> TokenBucket:
+    """Buckets are shared by all BaseApi instances talking to the same host with the same limit"""
+    key = (host, rate, capacity)
+    bucket = _buckets.get(key)
+    if bucket is None:
+        bucket = _buckets[key] = TokenBucket(rate, capacity)
+    return bucket
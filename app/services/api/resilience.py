@@ -0,0 +1,161 @@
+import random
+import time
+from collections import deque
+from collections.abc import Callable
+from dataclasses import dataclass
+from enum import StrEnum
+
+from .metrics import API_CIRCUIT_STATE
+
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+
+
+@dataclass(frozen=True, slots=True)
+class RetryPolicy:
+    """Exponential backoff with full jitter, only for idempotent methods"""
+
+    attempts: int = 3
+    backoff: float = 0.1
+    max_backoff: float = 5
+    statuses: frozenset[int] = frozenset({429, 502, 503, 504})
+    methods: frozenset[str] = IDEMPOTENT_METHODS
+
+    def retryable(self, method: str, status_code: int | None = None) -> bool:
+        """status_code is None for the network errors"""
+        if method.upper() not in self.methods:
+            return False
+        return status_code is None or status_code in self.statuses
+
+    def delay(self, attempt: int, retry_after: float | None = None) -> float:
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_backoff))
+        return delay
+
+
+@dataclass(frozen=True, slots=True)
+class BreakerPolicy:
+    failure_threshold: int = 5
+    reset_timeout: float = 30
+
+
+@dataclass(frozen=True, slots=True)
+class HedgePolicy:
+    """
+    The second attempt is fired when the first one is slower than the quantile of
+    the latest latencies of the host (or the fixed delay, until enough samples).
+    """
+
+    quantile: float = 0.95
+    delay: float = 1.0
+    min_samples: int = 20
+    window: int = 200
+    methods: frozenset[str] = IDEMPOTENT_METHODS
+
+
+class CircuitState(StrEnum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """
+    CLOSED -> OPEN after failure_threshold failures in a row,
+    OPEN -> HALF_OPEN after reset_timeout: one probe request is let through,
+    HALF_OPEN -> CLOSED on its success or back to OPEN on its failure.
+    The probe is owned by the request passed to allow(), only it can abandon the probe.
+
+    >>> request = object()
+    >>> if breaker.allow(request):
+    ...     breaker.abandon(request)  # cancelled
+    """
+
+    def __init__(
+        self, host: str, policy: BreakerPolicy, clock: Callable[[], float] = time.monotonic
+    ) -> None:
+        self.host = host
+        self.state = CircuitState.CLOSED
+        self._policy = policy
+        self._clock = clock
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe: object | None = None
+
+    def _set_state(self, state: CircuitState) -> None:
+        self.state = state
+        value = {CircuitState.CLOSED: 0, CircuitState.HALF_OPEN: 0.5, CircuitState.OPEN: 1}
+        API_CIRCUIT_STATE.labels(host=self.host).set(value[state])
+
+    def allow(self, request: object = None) -> bool:
+        if self.state == CircuitState.CLOSED:
+            return True
+        if self.state == CircuitState.OPEN:
+            if self._clock() - self._opened_at < self._policy.reset_timeout:
+                return False
+            self._set_state(CircuitState.HALF_OPEN)
+        if self._probe is not None:
+            return False
+        self._probe = object() if request is None else request
+        return True
+
+    def abandon(self, request: object) -> None:
+        """The request was cancelled (e.g. lost the hedging race), the result is unknown"""
+        if self._probe is request:
+            self._probe = None
+
+    def record_success(self) -> None:
+        self._failures = 0
+        self._probe = None
+        if self.state != CircuitState.CLOSED:
+            self._set_state(CircuitState.CLOSED)
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        self._probe = None
+        if self.state == CircuitState.HALF_OPEN or self._failures >= self._policy.failure_threshold:
+            self._opened_at = self._clock()
+            self._set_state(CircuitState.OPEN)
+
+
+class LatencyTracker:
+    def __init__(self, window: int) -> None:
+        self._latencies: deque[float] = deque(maxlen=window)
+
+    def add(self, latency: float) -> None:
+        self._latencies.append(latency)
+
+    def quantile(self, quantile: float) -> float | None:
+        if not self._latencies:
+            return None
+        latencies = sorted(self._latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * quantile))]
+
+    def __len__(self) -> int:
+        return len(self._latencies)
+
+
+# Keyed by the host and the policy: BaseApi classes with their own policies don't share state
+_breakers: dict[tuple[str, BreakerPolicy], CircuitBreaker] = {}
+_latencies: dict[tuple[str, int], LatencyTracker] = {}
+
+
+def host_breaker(host: str, policy: BreakerPolicy) -> CircuitBreaker:
+    breaker = _breakers.get((host, policy))
+    if breaker is None:
+        breaker = _breakers[host, policy] = CircuitBreaker(host, policy)
+    return breaker
+
+
+def host_latencies(host: str, window: int = 200) -> LatencyTracker:
+    tracker = _latencies.get((host, window))
+    if tracker is None:
+        tracker = _latencies[host, window] = LatencyTracker(window)
+    return tracker
+
+
+def hedge_delay(host: str, policy: HedgePolicy) -> float:
+    tracker = host_latencies(host, policy.window)
+    if len(tracker) < policy.min_samples:
+        return policy.delay
+    return tracker.quantile(policy.quantile)
@@ -1,27 +1,82 @@
 import argparse
+import asyncio
 import atexit
 import logging.config
 import os
 import signal
 import sys
 import time
+from dataclasses import dataclass, field
+from typing import Any
 
-from app.configs.log_settings import LogConfig
+from app.core.configs import LogConfig
+
+from .scheduler import Job, Schedule, Scheduler
 
 logger = logging.getLogger("stdout")
 
 
+REEXEC_ENV = "DAEMON_REEXEC"
+
+
+def flush_log_handlers() -> None:
+    """
+    Stops the QueueListeners, so the records still in the queues are written,
+    and flushes the handlers. Called before the daemon exits or re-executes itself.
+    """
+    loggers = [logging.getLogger()]
+    loggers += [
+        item
+        for item in logging.Logger.manager.loggerDict.values()
+        if isinstance(item, logging.Logger)
+    ]
+    handlers = {handler for item in loggers for handler in item.handlers}
+    for handler in handlers:
+        listener = getattr(handler, "listener", None)
+        if listener is not None and getattr(listener, "_thread", None) is not None:
+            listener.stop()
+    for handler in handlers:
+        handler.flush()
+
+
 class Daemon:
-    """Class for Creating and maintaining Demon process"""
+    """
+    Class for Creating and maintaining Demon process
+    SIGTERM/SIGINT - the running function gets drain_timeout seconds to finish,
+    then it is cancelled. SIGHUP - the same drain, then the daemon re-executes itself
+    in the same process: the pid is kept, so the pidfile stays valid during the reload.
 
-    def __init__(self, filename):
-        self.pidfile = f"/var/lock/{filename}d"
+    >>> daemon = Daemon("reviewbi", drain_timeout=60)
+    >>> daemon.start(daemon.run_scheduler, scheduler)
+    """
+
+    def __init__(
+        self,
+        filename,
+        pid_dir: str = "/var/lock",
+        drain_timeout: float = 30,
+        stop_timeout: float | None = None,
+    ):
+        self.pidfile = os.path.join(pid_dir, f"{filename}d")
         self.stdin = "/dev/null"
         self.stdout = "/dev/null"
         self.stderr = "/dev/null"
+        # The daemon works in /, the re-executed command starts where it was started
+        self.workdir = os.getcwd()
+        self.drain_timeout = drain_timeout
+        # The caller of stop waits for the drain before SIGKILL
+        self.stop_timeout = drain_timeout + 5 if stop_timeout is None else stop_timeout
+        self.stopping = asyncio.Event()
+        self._reexec = False
 
-    async def demonification(self):
+    def demonification(self):
         """Fork, magic and run the function"""
+        # The loop is created after the fork, a forked child can't use the parent's loop
+        self.detach()
+        asyncio.run(self._serve())
+
+    def detach(self):
+        """Double fork, the pidfile and the standard streams of the daemon"""
         self.create_child()
         os.chdir("/")
         os.setsid()
@@ -44,13 +99,6 @@ class Daemon:
         os.dup2(so.fileno(), sys.stdout.fileno())
         os.dup2(se.fileno(), sys.stderr.fileno())
 
-        logger.debug(f"Start function {self.fn}")
-        # loop = asyncio.new_event_loop()
-        # await loop.create_task(self.fn(*self.fn_args))
-        # asyncio.set_event_loop(loop)
-        # await asyncio.gather(self.fn, *self.fn_args)
-        await self.fn(*self.fn_args)
-
     def delpid(self):
         """Only remove pidfile"""
         try:
@@ -76,53 +124,341 @@ class Daemon:
             sys.stderr.write(f"Error: {e.errno} {e.strerror}\n")
             sys.exit(1)
 
-    async def start(self, fn, *args):
+    def request_stop(self, reexec: bool = False) -> None:
+        self._reexec = self._reexec or reexec
+        if not self.stopping.is_set():
+            logger.info(f"Daemon {os.getpid()} is {'reloading' if reexec else 'stopping'}")
+            self.stopping.set()
+
+    async def _serve(self):
+        """Runs the function until it returns or a signal comes, then drains"""
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, self.request_stop)
+        loop.add_signal_handler(signal.SIGHUP, self.request_stop, True)
+
+        logger.debug(f"Start function {self.fn}")
+        task = asyncio.create_task(self.fn(*self.fn_args))
+        stopping = asyncio.create_task(self.stopping.wait())
+        await asyncio.wait((task, stopping), return_when=asyncio.FIRST_COMPLETED)
+        stopping.cancel()
+
+        if not task.done():
+            # The function sees self.stopping and finishes its work
+            _, pending = await asyncio.wait((task,), timeout=self.drain_timeout)
+            if pending:
+                logger.warning(f"Daemon is not drained in {self.drain_timeout}s, cancel it")
+                task.cancel()
+                await asyncio.wait((task,))
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Daemon function is failed: {task.exception()!r}")
+
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            loop.remove_signal_handler(signum)
+        flush_log_handlers()
+        if self._reexec:
+            self.reexec()
+
+    def reexec(self):
+        """Replaces the process with a new interpreter running the same command"""
+        os.environ[REEXEC_ENV] = str(os.getpid())
+        logger.info(f"Daemon {os.getpid()} re-executes {sys.orig_argv}")
+        # The pid and the pidfile are kept, atexit handlers don't run on exec
+        os.chdir(self.workdir)
+        os.execv(sys.executable, sys.orig_argv)
+
+    async def run_scheduler(self, scheduler: Scheduler):
+        """Function for start: runs the scheduler, on stop waits for the running jobs"""
+        scheduler.start()
+        await self.stopping.wait()
+        await scheduler.stop(wait=True)
+
+    def start(self, fn, *args):
         """You must specify a function to be called when the daemon is started"""
 
         self.fn = fn
         self.fn_args = args
-        if os.path.exists(self.pidfile):
+        if os.environ.get(REEXEC_ENV) == str(os.getpid()):
+            # Re-executed by SIGHUP: already detached and the pidfile is ours
+            del os.environ[REEXEC_ENV]
+            os.chdir("/")
+            atexit.register(self.delpid)
+            signal.signal(signal.SIGCHLD, self.handle_signal)
+            logger.info(f"Daemon {os.getpid()} is reloaded")
+            asyncio.run(self._serve())
+        elif os.path.exists(self.pidfile):
             logger.warning(f"{self.pidfile} already exists. Daemon is already running!")
-            sys.stderr.write(
-                f"{self.pidfile} already exists. Daemon is already running!\n"
-            )
+            sys.stderr.write(f"{self.pidfile} already exists. Daemon is already running!\n")
             self.stop()
         else:
             logger.debug(self.fn_args)
-            await self.demonification()
-
-    def stop(self):
-        """Stop the existing daemon"""
+            self.demonification()
 
+    def start_workers(self, jobs: list["PoolJob"], workers: int | None = None, **options):
+        """
+        Pre-fork mode: the daemon is the master of the worker processes running the jobs,
+        the pidfile holds the pid of the master. Options go to the Supervisor.
+        """
         if os.path.exists(self.pidfile):
-            try:
-                pid = int(open(self.pidfile).read())
-            except OSError as e:
-                logger.error(f"Error: {e}")
-                sys.stderr.write(f"Error: {e}\n")
-                sys.exit(1)
-        else:
+            logger.warning(f"{self.pidfile} already exists. Daemon is already running!")
+            sys.stderr.write(f"{self.pidfile} already exists. Daemon is already running!\n")
+            self.stop()
+            return
+        self.detach()
+        # The master only waits for the signals, the default SIGCHLD disposition is needed
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        sys.exit(Supervisor(jobs, workers, **options).run())
+
+    def _read_pid(self) -> int | None:
+        if not os.path.exists(self.pidfile):
             logger.warning(f"Pid file {self.pidfile} don't exist!")
             sys.stderr.write(f"Pid file {self.pidfile} don't exist!\n")
+            return None
+        try:
+            return int(open(self.pidfile).read())
+        except OSError as e:
+            logger.error(f"Error: {e}")
+            sys.stderr.write(f"Error: {e}\n")
+            sys.exit(1)
+
+    @staticmethod
+    def _wait_exit(pid: int, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                # Reaps the daemon if it is our child, a zombie still accepts signals
+                os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                pass
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+
+    def stop(self):
+        """Stop the existing daemon: SIGTERM, SIGKILL if it isn't drained in stop_timeout"""
+
+        pid = self._read_pid()
+        if pid is None:
             return -1
 
         try:
-            os.kill(pid, 15)
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            logger.warning(f"Daemon with pid {pid} is not running, remove {self.pidfile}")
+            self.delpid()
+            return -1
+
+        if self._wait_exit(pid, self.stop_timeout):
             logger.warning(f"Daemon with pid {pid} was terminated!")
             sys.stdout.write(f"Daemon with pid {pid} was terminated!\n")
-            self.delpid()
-        except OSError as e:
-            os.kill(pid, 9)
+        else:
+            os.kill(pid, signal.SIGKILL)
             logger.warning(f"Send kill -9 to process {pid}")
-            sys.stderr.write(f"Error {pid}\n")
             sys.stderr.write(f"Send kill -9 to process {pid}\n")
+            self._wait_exit(pid, 5)
+        # The drained daemon removes the pidfile itself, the killed one can't
+        if os.path.exists(self.pidfile):
             self.delpid()
-            sys.exit(1)
+
+    def reload(self):
+        """Drain and re-exec the existing daemon, it keeps the pid and the pidfile"""
+        pid = self._read_pid()
+        if pid is None:
+            return -1
+        os.kill(pid, signal.SIGHUP)
+        logger.warning(f"Daemon with pid {pid} is reloading")
+
+
+@dataclass(slots=True)
+class PoolJob:
+    """Job for a worker process, options are the ones of Scheduler.add"""
+
+    job: Job
+    schedule: Schedule
+    name: str | None = None
+    options: dict[str, Any] = field(default_factory=dict)
+
+
+@dataclass(slots=True)
+class _Worker:
+    index: int
+    pid: int | None = None
+    started_at: float = 0.0
+    failures: int = 0
+    restart_at: float | None = None
+
+
+async def _serve_jobs(jobs: list[PoolJob]) -> None:
+    """Event loop of the worker: the scheduler runs until SIGTERM, then drains"""
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stopping.set)
+
+    scheduler = Scheduler()
+    for pool_job in jobs:
+        scheduler.add(pool_job.job, pool_job.schedule, pool_job.name, **pool_job.options)
+    scheduler.start()
+    await stopping.wait()
+    logger.info(f"Worker {os.getpid()} is draining")
+    await scheduler.stop(wait=True)
+
+
+class Supervisor:
+    """
+    Pre-fork master: spawns the worker processes, the jobs are spread over them
+    round-robin, every worker runs its jobs with its own Scheduler.
+    A crashed worker is restarted after the backoff, doubled on every crash in a row
+    and reset after stable_after seconds of work.
+    SIGTERM/SIGINT - drain: the workers finish the running jobs and exit, the ones
+    still working after drain_timeout are killed. SIGHUP - rolling restart, one worker
+    at a time, so the job of the restarted worker never runs twice.
+
+    >>> Supervisor([PoolJob(DirectorySyncJob(search, engine), Every(600))], workers=4).run()
+    """
+
+    SIGNALS = (signal.SIGCHLD, signal.SIGTERM, signal.SIGINT, signal.SIGHUP)
+
+    def __init__(
+        self,
+        jobs: list[PoolJob],
+        workers: int | None = None,
+        backoff: float = 1,
+        max_backoff: float = 60,
+        stable_after: float = 30,
+        drain_timeout: float = 30,
+    ) -> None:
+        workers = workers or os.cpu_count() or 1
+        if jobs and workers > len(jobs):
+            logger.info(f"{workers} workers for {len(jobs)} jobs, {len(jobs)} are started")
+            workers = len(jobs)
+        self.jobs = jobs
+        self.workers = [_Worker(index) for index in range(workers)]
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stable_after = stable_after
+        self.drain_timeout = drain_timeout
+        self._stopping = False
+        self._reloading = False
+
+    def _jobs_of(self, worker: _Worker) -> list[PoolJob]:
+        return self.jobs[worker.index :: len(self.workers)]
+
+    def _spawn(self, worker: _Worker) -> None:
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                signal.pthread_sigmask(signal.SIG_UNBLOCK, self.SIGNALS)
+                for signum in self.SIGNALS:
+                    signal.signal(signum, signal.SIG_DFL)
+                asyncio.run(_serve_jobs(self._jobs_of(worker)))
+            except BaseException as e:
+                logger.error(f"Worker {worker.index} is failed: {e}")
+                code = 1
+            finally:
+                flush_log_handlers()
+                logging.shutdown()
+                os._exit(code)
+        worker.pid = pid
+        worker.started_at = time.monotonic()
+        worker.restart_at = None
+        logger.info(f"Worker {worker.index} is started, pid: {pid}")
+
+    def _handle(self, signum: int | None) -> None:
+        if signum in (signal.SIGTERM, signal.SIGINT):
+            self._stopping = True
+        elif signum == signal.SIGHUP:
+            self._reloading = True
+
+    def _wait(self, timeout: float) -> None:
+        info = signal.sigtimedwait(self.SIGNALS, max(0.0, timeout))
+        self._handle(info.si_signo if info else None)
+
+    def _reap(self) -> list[tuple[_Worker, int]]:
+        exited = []
+        by_pid = {worker.pid: worker for worker in self.workers if worker.pid}
+        while by_pid:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            if (worker := by_pid.pop(pid, None)) is not None:
+                worker.pid = None
+                exited.append((worker, os.waitstatus_to_exitcode(status)))
+        return exited
+
+    def _schedule_restart(self, worker: _Worker, code: int) -> None:
+        if time.monotonic() - worker.started_at >= self.stable_after:
+            worker.failures = 0
+        worker.failures += 1
+        delay = min(self.max_backoff, self.backoff * 2 ** (worker.failures - 1))
+        worker.restart_at = time.monotonic() + delay
+        logger.error(f"Worker {worker.index} exited with {code}, restart in {delay:.1f}s")
+
+    def _stop_workers(self, workers: list[_Worker]) -> None:
+        """Drains the workers, kills the ones still running after drain_timeout"""
+        for worker in workers:
+            if worker.pid:
+                os.kill(worker.pid, signal.SIGTERM)
+        deadline = time.monotonic() + self.drain_timeout
+        while any(worker.pid for worker in workers):
+            # Another worker may crash during the drain, it is restarted as usual
+            for worker, code in self._reap():
+                if worker not in workers:
+                    self._schedule_restart(worker, code)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                for worker in workers:
+                    if worker.pid:
+                        logger.warning(f"Worker {worker.index} is not drained, kill it")
+                        os.kill(worker.pid, signal.SIGKILL)
+                        os.waitpid(worker.pid, 0)
+                        worker.pid = None
+                break
+            if any(worker.pid for worker in workers):
+                self._wait(min(remaining, 0.5))
+
+    def _rolling_restart(self) -> None:
+        logger.info("Rolling restart of the workers")
+        for worker in self.workers:
+            if self._stopping:
+                return
+            self._stop_workers([worker])
+            worker.failures = 0
+            self._spawn(worker)
+
+    def run(self) -> int:
+        signal.pthread_sigmask(signal.SIG_BLOCK, self.SIGNALS)
+        try:
+            for worker in self.workers:
+                self._spawn(worker)
+            while not self._stopping:
+                for worker, code in self._reap():
+                    self._schedule_restart(worker, code)
+                if self._reloading:
+                    self._reloading = False
+                    self._rolling_restart()
+                    continue
+
+                now = time.monotonic()
+                for worker in self.workers:
+                    if worker.pid is None and worker.restart_at and worker.restart_at <= now:
+                        self._spawn(worker)
+                restarts = [worker.restart_at for worker in self.workers if worker.restart_at]
+                self._wait(min(restarts, default=now + 1) - now)
+
+            logger.info("Supervisor is draining the workers")
+            self._stop_workers(self.workers)
+            return 0
         finally:
-            if os.path.exists(f"/proc/{pid}"):
-                os.kill(pid, 9)
-                logger.warning(f"Send kill -9 to process {pid}")
-                sys.stderr.write(f"Send kill -9 to process {pid}\n")
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, self.SIGNALS)
 
 
 def cmd_parser():
@@ -142,9 +478,7 @@ def cmd_parser():
     parser.add_argument("-m", "--minute", action="store", type=int, default=0)
 
     exgroup = parser.add_mutually_exclusive_group(required=True)
-    exgroup.add_argument(
-        "-u", "--start", action="store_true", help="Start a reviewbi service"
-    )
+    exgroup.add_argument("-u", "--start", action="store_true", help="Start a reviewbi service")
     exgroup.add_argument(
         "-s",
         "--stop",
@@ -176,12 +510,7 @@ if __name__ == "__main__":
     test_class = Test()
     testd = test_class.testd
 
-    import asyncio
-
-    async def main():
-        if args.daemonize:
-            await demon.start(testd)
-        else:
-            demon.stop()
-
-    asyncio.run(main())
+    if args.daemonize:
+        demon.start(testd)
+    else:
+        demon.stop()
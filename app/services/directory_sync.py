@@ -0,0 +1,229 @@
+import asyncio
+import logging
+from collections.abc import Iterator
+from dataclasses import dataclass
+from datetime import UTC, datetime, timedelta
+
+from app.database.clusters import DataBase
+from app.database.connection import AsyncConnection
+
+from .ldap import ALL_USERS_FILTER, LdapSearch
+from .scheduler import Job, Time
+
+logger = logging.getLogger("stdout")
+
+SYNC_ATTRIBUTES = [
+    "objectGUID",
+    "sAMAccountName",
+    "displayName",
+    "mail",
+    "distinguishedName",
+    "userAccountControl",
+    "whenChanged",
+    "uSNChanged",
+]
+COLUMNS = [
+    "object_guid",
+    "sam_account_name",
+    "display_name",
+    "mail",
+    "distinguished_name",
+    "user_account_control",
+    "when_changed",
+    "usn_changed",
+    "synced_at",
+]
+
+DDL = (
+    """
+    CREATE TABLE IF NOT EXISTS directory_users (
+        object_guid text PRIMARY KEY,
+        sam_account_name text,
+        display_name text,
+        mail text,
+        distinguished_name text NOT NULL,
+        user_account_control integer,
+        when_changed timestamptz,
+        usn_changed bigint,
+        synced_at timestamptz NOT NULL,
+        deleted boolean NOT NULL DEFAULT false
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS directory_sync_state (
+        name text PRIMARY KEY,
+        dc text NOT NULL,
+        usn bigint NOT NULL,
+        full_sync_at timestamptz NOT NULL
+    )
+    """,
+)
+# The temp table lives as long as the session, the pooled connection reuses it in the next
+# runs. The whole sync is one transaction: TRUNCATE empties the table before every page
+STAGE_DDL = (
+    "CREATE TEMP TABLE IF NOT EXISTS directory_users_stage "
+    "(LIKE directory_users INCLUDING DEFAULTS)"
+)
+UPSERT_SQL = f"""
+    INSERT INTO directory_users ({", ".join(COLUMNS)}, deleted)
+    SELECT {", ".join(COLUMNS)}, false FROM directory_users_stage
+    ON CONFLICT (object_guid) DO UPDATE SET
+    {", ".join(f"{column} = EXCLUDED.{column}" for column in COLUMNS[1:])},
+    deleted = false
+"""
+MARK_DELETED_SQL = "UPDATE directory_users SET deleted = true WHERE synced_at < %s AND NOT deleted"
+STATE_SQL = "SELECT dc, usn, full_sync_at FROM directory_sync_state WHERE name = %s"
+SAVE_STATE_SQL = """
+    INSERT INTO directory_sync_state (name, dc, usn, full_sync_at) VALUES (%s, %s, %s, %s)
+    ON CONFLICT (name) DO UPDATE SET
+    dc = EXCLUDED.dc, usn = EXCLUDED.usn, full_sync_at = EXCLUDED.full_sync_at
+"""
+
+
+@dataclass(slots=True)
+class Watermark:
+    dc: str
+    usn: int
+    full_sync_at: datetime
+
+
+@dataclass(slots=True)
+class SyncResult:
+    entries: int
+    full: bool
+    watermark: Watermark
+
+
+def _value(attributes: dict, name: str):
+    value = attributes.get(name)
+    if isinstance(value, list):
+        return value[0] if value else None
+    return value
+
+
+class DirectorySyncJob(Job):
+    """
+    Mirrors AD users into the directory_users table.
+    Every run fetches with paged search only the entries with uSNChanged above
+    the watermark and upserts them page by page through COPY into a stage table.
+    uSNChanged is local to the domain controller, so the controller is stored with
+    the watermark. A full resync runs when there is no watermark, the controller has
+    changed or full_resync_interval has passed, it also marks the users removed
+    from AD as deleted: the incremental search doesn't see the deleted objects.
+
+    >>> job = DirectorySyncJob(LdapSearch(LdapPool(settings)), engine)
+    >>> scheduler.add(job, Every(15 * Time.MINUTE))
+    """
+
+    def __init__(
+        self,
+        search: LdapSearch,
+        engine: AsyncConnection,
+        name: str = "ad_users",
+        page_size: int = 1000,
+        full_resync_interval: float = 7 * Time.DAY,
+    ) -> None:
+        self.search = search
+        self.engine = engine
+        self.name = name
+        self.page_size = page_size
+        self.full_resync_interval = timedelta(seconds=full_resync_interval)
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self.name!r})"
+
+    @staticmethod
+    def to_row(entry: dict, synced_at: datetime) -> tuple:
+        """ValueError for the entries without objectGUID, it is the primary key"""
+        attributes = entry["attributes"]
+        object_guid = _value(attributes, "objectGUID")
+        if not object_guid:
+            raise ValueError(f"Entry {entry.get('dn')} has no objectGUID")
+        return (
+            str(object_guid),
+            _value(attributes, "sAMAccountName"),
+            _value(attributes, "displayName"),
+            _value(attributes, "mail"),
+            _value(attributes, "distinguishedName") or entry.get("dn"),
+            _value(attributes, "userAccountControl"),
+            _value(attributes, "whenChanged"),
+            _value(attributes, "uSNChanged"),
+            synced_at,
+        )
+
+    async def load_watermark(self, db: DataBase) -> Watermark | None:
+        rows = await db.fetchall(STATE_SQL, self.name)
+        return Watermark(**rows[0]) if rows else None
+
+    def _full_resync_due(self, watermark: Watermark | None, dc: str, now: datetime) -> bool:
+        if watermark is None:
+            return True
+        if watermark.dc != dc:
+            logger.warning(f"Domain controller changed: {watermark.dc} -> {dc}, full resync")
+            return True
+        return now - watermark.full_sync_at >= self.full_resync_interval
+
+    def _changes(
+        self, watermark: Watermark | None, now: datetime, plan: dict
+    ) -> Iterator[list[dict]]:
+        """Runs in a thread, the plan of the run is filled in before the first page"""
+        with self.search.pinned() as search:
+            root = search.root_dse()
+            dc = str(_value(root, "dsServiceName"))
+            # Read before the search: the changes made during it are fetched next time
+            usn = int(_value(root, "highestCommittedUSN"))
+            full = self._full_resync_due(watermark, dc, now)
+            plan["full"] = full
+            plan["watermark"] = Watermark(dc, usn, now if full else watermark.full_sync_at)
+
+            search_filter = ALL_USERS_FILTER
+            if not full:
+                search_filter = f"(&{ALL_USERS_FILTER}(uSNChanged>={watermark.usn + 1}))"
+            yield from search.pages(search_filter, SYNC_ATTRIBUTES, page_size=self.page_size)
+
+    def _rows(self, page: list[dict], synced_at: datetime) -> Iterator[tuple]:
+        for entry in page:
+            try:
+                yield self.to_row(entry, synced_at)
+            except ValueError as e:
+                logger.warning(f"{self}: {e}, skipped")
+
+    async def _upsert(self, db: DataBase, page: list[dict], synced_at: datetime) -> int:
+        await db.execute("TRUNCATE directory_users_stage")
+        count = await db.copy_in(
+            "directory_users_stage", self._rows(page, synced_at), columns=COLUMNS
+        )
+        await db.execute(UPSERT_SQL)
+        return count
+
+    async def sync(self) -> SyncResult:
+        now = datetime.now(UTC)
+        plan = {}
+        entries = 0
+        async with DataBase(self.engine) as db:
+            for statement in (*DDL, STAGE_DDL):
+                await db.execute(statement)
+            watermark = await self.load_watermark(db)
+
+            pages = self._changes(watermark, now, plan)
+            try:
+                while (page := await asyncio.to_thread(next, pages, None)) is not None:
+                    if page:
+                        entries += await self._upsert(db, page, now)
+            finally:
+                await asyncio.to_thread(pages.close)
+
+            if plan["full"]:
+                await db.execute(MARK_DELETED_SQL, now)
+            new = plan["watermark"]
+            await db.execute(SAVE_STATE_SQL, self.name, new.dc, new.usn, new.full_sync_at)
+            # A failed commit must fail the run, the commit on exit only logs it
+            await db.commit()
+        return SyncResult(entries, plan["full"], new)
+
+    async def run(self):
+        result = await self.sync()
+        mode = "full" if result.full else "incremental"
+        logger.info(
+            f"{self}: {mode} sync is done, entries: {result.entries}, usn: {result.watermark.usn}"
+        )
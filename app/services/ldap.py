@@ -1,12 +1,25 @@
+import asyncio
+import copy
 import json
 import logging
+import threading
+from collections.abc import AsyncIterator, Callable, Generator, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
 
+from ldap3 import BASE, Connection
+from ldap3.core.exceptions import LDAPCommunicationError
 from ldap3.utils.ciDict import CaseInsensitiveDict
+from ldap3.utils.conv import escape_filter_chars
 
-from app.drivers.ldap import LdapConnection
+from app.drivers.ldap import LdapConnection, LdapException, LdapPool
 
 logger = logging.getLogger("app.services.ldap")
 
+# Simple Paged Results control, RFC 2696
+PAGED_RESULTS_CONTROL = "1.2.840.113556.1.4.319"
+
 
 class LdapJsonEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -20,52 +33,323 @@ class LdapJsonEncoder(json.JSONEncoder):
         return super().default(self, obj)
 
 
+ALL_USERS_FILTER = "(&(objectCategory=person)(objectClass=user))"
+OU_FILTER = "(objectClass=organizationalUnit)"
+LOOKUP_ATTRIBUTES = ["sAMAccountName", "displayName", "distinguishedName", "mail"]
+
+
+def _user_filter(username: str) -> str:
+    return f"(sAMAccountName={escape_filter_chars(username)})"
+
+
+def _email_filter(email: str) -> str:
+    email = escape_filter_chars(email)
+    return f"(&(proxyAddresses=smtp:{email})(mail={email}))"
+
+
+def _batches(values: list[str], batch_size: int) -> list[list[str]]:
+    """Case-insensitive unique values split into batches"""
+    unique = list(dict.fromkeys(value.lower() for value in values))
+    return [unique[i : i + batch_size] for i in range(0, len(unique), batch_size)]
+
+
 class LdapSearch:
-    def __init__(self, ldap: LdapConnection):
-        self.connection = ldap.connection
+    """
+    >>> search = LdapSearch(LdapConnection(settings))
+    >>> search = LdapSearch(LdapPool(settings, max_size=8))  # borrows per search, thread-safe
+    >>> for entry in search.iter_users(page_size=500):  # page by page, under the size limit
+    ...     ...
+    """
+
+    def __init__(self, ldap: LdapConnection | LdapPool, page_size: int = 1000):
+        self.pool = ldap if isinstance(ldap, LdapPool) else None
+        self.connection = None if self.pool else ldap.connection
         self.search_base = "dc=katren,dc=net"
+        self.page_size = page_size
 
     @property
     def entries(self):
-        return self.connection.entries or ["No entries"]
+        return (self.connection and self.connection.entries) or ["No entries"]
+
+    @contextmanager
+    def _borrow(self) -> Generator[Connection, None, None]:
+        if self.pool is None:
+            yield self.connection
+            return
+        with self.pool.connection() as ldap:
+            yield ldap.connection
+
+    @contextmanager
+    def pinned(self) -> Generator["LdapSearch", None, None]:
+        """
+        LdapSearch running every search on one borrowed connection, so on one domain
+        controller: uSNChanged and highestCommittedUSN are local to the controller
+        """
+        with self._borrow() as connection:
+            pinned = copy.copy(self)
+            pinned.pool = None
+            pinned.connection = connection
+            yield pinned
+
+    def root_dse(self, attributes=("dsServiceName", "highestCommittedUSN")) -> dict:
+        with self._borrow() as connection:
+            _, _, response, _ = connection.search(
+                "", "(objectClass=*)", search_scope=BASE, attributes=list(attributes)
+            )
+        return dict(response[0]["attributes"]) if response else {}
 
     @staticmethod
     def dump_to_json(entries):
         return json.dumps(entries, ensure_ascii=False, cls=LdapJsonEncoder)
 
+    @staticmethod
+    def iter_json(entries: Iterable) -> Iterator[str]:
+        """JSON array of the entries chunk by chunk, only one entry is encoded at a time"""
+        # encode() takes the C speedups, iterencode() is the pure Python one
+        encode = LdapJsonEncoder(ensure_ascii=False).encode
+        separator = "["
+        for entry in entries:
+            yield separator + encode(entry)
+            separator = ","
+        yield "[]" if separator == "[" else "]"
+
+    @classmethod
+    def dump_to_file(cls, entries: Iterable, fp) -> None:
+        for chunk in cls.iter_json(entries):
+            fp.write(chunk)
+
     def _search(self, search_base: str, search_filter: str, attributes=None):
         logger.info(f"Search base: {search_base}, Search filter: {search_filter}")
-        status, result, response, request = self.connection.search(
-            search_base, search_filter, attributes=attributes
-        )  # usually you don't need the original request (4th element of the returned tuple)
+        try:
+            with self._borrow() as connection:
+                status, result, response, request = connection.search(
+                    search_base, search_filter, attributes=attributes
+                )  # usually you don't need the original request (4th element of the tuple)
+        except LDAPCommunicationError as e:
+            if self.pool is None:
+                raise
+            # The broken connection is dropped by the pool, retry once on a fresh one
+            logger.warning(f"LDAP search is failed: {e}, retrying")
+            with self._borrow() as connection:
+                status, result, response, request = connection.search(
+                    search_base, search_filter, attributes=attributes
+                )
         logger.info("Search is done")
 
         # logger.debug(f"{status=}, {result=}, {response=}")
         logger.debug(f"{request=}")
         return status, result, response
 
+    def pages(
+        self,
+        search_filter: str,
+        attributes=None,
+        search_base: str | None = None,
+        page_size: int | None = None,
+    ) -> Iterator[list[dict]]:
+        """
+        Paged search: yields the entries page by page, the paging cookie is bound
+        to the connection, so it is borrowed until the generator is exhausted or closed
+        """
+        search_base = search_base or self.search_base
+        page_size = page_size or self.page_size
+        logger.info(f"Paged search base: {search_base}, Search filter: {search_filter}")
+        with self._borrow() as connection:
+            cookie = None
+            page_number = 0
+            while True:
+                status, result, response, _ = connection.search(
+                    search_base,
+                    search_filter,
+                    attributes=attributes,
+                    paged_size=page_size,
+                    paged_cookie=cookie,
+                )
+                if not status and result.get("result"):
+                    raise LdapException(f"Paged search is failed: {result.get('description')}")
+                page_number += 1
+                # Skip the continuation references, they are not entries
+                yield [entry for entry in response if entry.get("type") != "searchResRef"]
+
+                control = (result.get("controls") or {}).get(PAGED_RESULTS_CONTROL)
+                cookie = control["value"]["cookie"] if control else None
+                if not cookie:
+                    break
+        logger.info(f"Paged search is done, pages: {page_number}")
+
+    def iter_entries(self, search_filter: str, attributes=None, **kwargs) -> Iterator[dict]:
+        for page in self.pages(search_filter, attributes, **kwargs):
+            yield from page
+
+    def _search_paged(self, search_filter: str, attributes=None):
+        response = list(self.iter_entries(search_filter, attributes))
+        return True, {"result": 0, "description": "success"}, response
+
+    def iter_users(self, page_size: int | None = None) -> Iterator[dict]:
+        return self.iter_entries(ALL_USERS_FILTER, page_size=page_size)
+
+    def iter_ou(self, page_size: int | None = None) -> Iterator[dict]:
+        return self.iter_entries(OU_FILTER, page_size=page_size)
+
     def all_users(self):
-        search_filter = "(&(objectCategory=person)(objectClass=user))"
-        return self._search(self.search_base, search_filter)
+        return self._search_paged(ALL_USERS_FILTER)
 
     def email(self, email: str):
-        search_filter = (
-            f"(&(objectClass=user)(proxyAddresses=smtp:{email})(mail={email}))"
-        )
-        return self._search(
-            self.search_base,
-            search_filter,
-            attributes=["sAMAccountName", "displayName", "distinguishedName", "mail"],
-        )
+        search_filter = f"(&(objectClass=user){_email_filter(email)})"
+        return self._search(self.search_base, search_filter, attributes=LOOKUP_ATTRIBUTES)
 
     def user(self, username):
-        search_filter = f"(&(objectClass=user)(sAMAccountName={username}))"
-        return self._search(
-            self.search_base,
-            search_filter,
-            attributes=["sAMAccountName", "displayName", "distinguishedName", "mail"],
-        )
+        search_filter = f"(&(objectClass=user){_user_filter(username)})"
+        return self._search(self.search_base, search_filter, attributes=LOOKUP_ATTRIBUTES)
+
+    def _lookup_batch(self, attribute: str, values: list[str]) -> dict[str, dict]:
+        """One search for the batch, the found entries by the lowercased attribute value"""
+        terms = map(_email_filter if attribute == "mail" else _user_filter, values)
+        search_filter = f"(&(objectClass=user)(|{''.join(terms)}))"
+        _, _, response = self._search(self.search_base, search_filter, LOOKUP_ATTRIBUTES)
+        found = {}
+        for entry in response:
+            value = entry.get("attributes", {}).get(attribute)
+            if isinstance(value, list):
+                value = value[0] if value else None
+            if value:
+                found[str(value).lower()] = entry
+        return found
+
+    def _lookup_many(
+        self, attribute: str, values: Iterable[str], batch_size: int, concurrency: int
+    ) -> dict[str, dict | None]:
+        values = list(values)
+        batches = _batches(values, batch_size)
+        found = {}
+        if concurrency <= 1 or len(batches) <= 1:
+            for batch in batches:
+                found.update(self._lookup_batch(attribute, batch))
+        else:
+            # Every batch borrows its own connection from the pool
+            workers = min(concurrency, len(batches))
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ldap-bulk") as pool:
+                for batch_found in pool.map(partial(self._lookup_batch, attribute), batches):
+                    found.update(batch_found)
+        return {value: found.get(value.lower()) for value in values}
+
+    def users(
+        self, usernames: Iterable[str], batch_size: int = 50, concurrency: int = 4
+    ) -> dict[str, dict | None]:
+        """
+        Bulk lookup by sAMAccountName, batch_size names per OR-filter.
+        The entries are keyed by the given usernames, None for the not found ones.
+        """
+        return self._lookup_many("sAMAccountName", usernames, batch_size, concurrency)
+
+    def emails(
+        self, addresses: Iterable[str], batch_size: int = 50, concurrency: int = 4
+    ) -> dict[str, dict | None]:
+        """Bulk lookup by mail, see users()"""
+        return self._lookup_many("mail", addresses, batch_size, concurrency)
 
     def ou(self):
-        search_filter = "(objectClass=organizationalUnit)"
-        return self._search(self.search_base, search_filter)
+        return self._search_paged(OU_FILTER)
+
+
+class AsyncLdapSearch:
+    """
+    LdapSearch for the event loop: the blocking searches run in a bounded thread pool,
+    every worker thread has its own bound connection, so lookups run in parallel.
+
+    >>> search = AsyncLdapSearch(lambda: LdapConnection(settings), max_workers=8)
+    >>> search = AsyncLdapSearch(LdapPool(settings, max_size=8), max_workers=8)
+    >>> status, result, response = await search.user("username")
+    >>> search.close()  # on shutdown, the pool is closed by its owner
+    """
+
+    def __init__(self, connect: Callable[[], LdapConnection] | LdapPool, max_workers: int = 8):
+        self._connect = connect
+        self._shared = LdapSearch(connect) if isinstance(connect, LdapPool) else None
+        self._local = threading.local()
+        self._connections: list[LdapConnection] = []
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ldap")
+
+    def _searcher(self) -> LdapSearch:
+        if self._shared is not None:
+            return self._shared
+        searcher = getattr(self._local, "searcher", None)
+        if searcher is None:
+            ldap = self._connect()
+            self._connections.append(ldap)
+            searcher = self._local.searcher = LdapSearch(ldap)
+        return searcher
+
+    async def _run(self, method: str, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, lambda: getattr(self._searcher(), method)(*args)
+        )
+
+    @staticmethod
+    def dump_to_json(entries):
+        return LdapSearch.dump_to_json(entries)
+
+    async def all_users(self):
+        return await self._run("all_users")
+
+    async def email(self, email: str):
+        return await self._run("email", email)
+
+    async def user(self, username):
+        return await self._run("user", username)
+
+    async def ou(self):
+        return await self._run("ou")
+
+    async def _lookup_many(
+        self, attribute: str, values: Iterable[str], batch_size: int
+    ) -> dict[str, dict | None]:
+        values = list(values)
+        found = {}
+        for batch_found in await asyncio.gather(
+            *(
+                self._run("_lookup_batch", attribute, batch)
+                for batch in _batches(values, batch_size)
+            )
+        ):
+            found.update(batch_found)
+        return {value: found.get(value.lower()) for value in values}
+
+    async def users(self, usernames: Iterable[str], batch_size: int = 50):
+        """The batches run concurrently, bounded by max_workers"""
+        return await self._lookup_many("sAMAccountName", usernames, batch_size)
+
+    async def emails(self, addresses: Iterable[str], batch_size: int = 50):
+        return await self._lookup_many("mail", addresses, batch_size)
+
+    async def iter_entries(
+        self, search_filter: str, attributes=None, page_size: int | None = None
+    ) -> AsyncIterator[dict]:
+        """Paged search, the pages are fetched in the thread pool one at a time"""
+        loop = asyncio.get_running_loop()
+        pages = await loop.run_in_executor(
+            self._executor,
+            lambda: self._searcher().pages(search_filter, attributes, page_size=page_size),
+        )
+        try:
+            while (
+                page := await loop.run_in_executor(self._executor, next, pages, None)
+            ) is not None:
+                for entry in page:
+                    yield entry
+        finally:
+            # Returns the borrowed connection
+            await loop.run_in_executor(self._executor, pages.close)
+
+    def iter_users(self, page_size: int | None = None) -> AsyncIterator[dict]:
+        return self.iter_entries(ALL_USERS_FILTER, page_size=page_size)
+
+    def iter_ou(self, page_size: int | None = None) -> AsyncIterator[dict]:
+        return self.iter_entries(OU_FILTER, page_size=page_size)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        for ldap in self._connections:
+            ldap.connection.unbind()
+        self._connections.clear()
@@ -0,0 +1,155 @@
+import asyncio
+import contextlib
+import logging
+import time
+from collections import Counter as HitCounter
+from collections.abc import Callable
+
+from prometheus_client import Counter, Histogram
+
+from app.core.cache import SingleFlight, TTLCache
+
+from .ldap import AsyncLdapSearch
+
+logger = logging.getLogger("app.services.ldap")
+
+LDAP_CACHE_HITS = Counter(
+    "ldap_lookup_cache_hits_total", "Lookups served from cache", ["lookup", "result"]
+)
+LDAP_CACHE_MISSES = Counter("ldap_lookup_cache_misses_total", "Lookups sent to LDAP", ["lookup"])
+LDAP_CACHE_COALESCED = Counter(
+    "ldap_lookup_cache_coalesced_total", "Lookups joined to one in flight", ["lookup"]
+)
+LDAP_CACHE_REFRESHES = Counter(
+    "ldap_lookup_cache_refreshes_total", "Hot entries reloaded before expiry", ["lookup"]
+)
+LDAP_LOOKUP_LATENCY = Histogram(
+    "ldap_lookup_duration_seconds", "Duration of the lookups sent to LDAP", ["lookup"]
+)
+
+
+class LdapLookupCache:
+    """
+    Cache of user/email lookups in front of AsyncLdapSearch.
+    Not found principals are cached for the shorter negative_ttl, failed searches
+    are not cached. Concurrent misses
+    of the same key make one LDAP request. The refresher reloads the keys hit at least
+    refresh_min_hits times when less than refresh_ahead of their ttl is left.
+
+    >>> lookups = LdapLookupCache(AsyncLdapSearch(pool), ttl=300, negative_ttl=30)
+    >>> lookups.start_refresher()  # optional, on startup
+    >>> status, result, response = await lookups.user("username")
+    >>> await lookups.close()
+    """
+
+    def __init__(
+        self,
+        search: AsyncLdapSearch,
+        max_entries: int = 10_000,
+        ttl: float = 300,
+        negative_ttl: float = 30,
+        refresh_ahead: float = 0.2,
+        refresh_min_hits: int = 3,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.search = search
+        self._entries = TTLCache(max_entries=max_entries, ttl=ttl, clock=clock)
+        self._flight = SingleFlight()
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._refresh_ahead = refresh_ahead
+        self._refresh_min_hits = refresh_min_hits
+        self._hits: HitCounter[tuple[str, str]] = HitCounter()
+        self._refresher: asyncio.Task | None = None
+
+    @property
+    def hit_ratio(self) -> float:
+        lookups = self._entries.hits + self._entries.misses
+        return self._entries.hits / lookups if lookups else 0.0
+
+    async def _load(self, key: tuple[str, str]):
+        lookup, value = key
+        start_time = time.perf_counter()
+        result = await getattr(self.search, lookup)(value)
+        LDAP_LOOKUP_LATENCY.labels(lookup=lookup).observe(time.perf_counter() - start_time)
+
+        status, search_result, response = result
+        # A search at the domain root also returns searchResRef continuation references
+        entries = [entry for entry in response if entry.get("type") == "searchResEntry"]
+        result = status, search_result, entries
+        if entries:
+            self._entries.set(key, result, ttl=self._ttl)
+        elif search_result.get("result") == 0:
+            self._entries.set(key, result, ttl=self._negative_ttl)
+        else:
+            # Busy, unavailable, ... is not "not found": the next lookup asks LDAP again
+            logger.warning(f"LDAP lookup {key} is failed: {search_result.get('description')}")
+        return result
+
+    async def _get(self, lookup: str, value: str):
+        # sAMAccountName and mail are case-insensitive in AD
+        key = (lookup, value.lower())
+        if (result := self._entries.get(key)) is not None:
+            self._hits[key] += 1
+            LDAP_CACHE_HITS.labels(
+                lookup=lookup, result="found" if result[2] else "not_found"
+            ).inc()
+            return result
+
+        result, shared = await self._flight.do(key, lambda: self._load(key))
+        if shared:
+            LDAP_CACHE_COALESCED.labels(lookup=lookup).inc()
+        else:
+            LDAP_CACHE_MISSES.labels(lookup=lookup).inc()
+        return result
+
+    async def user(self, username: str):
+        return await self._get("user", username)
+
+    async def email(self, email: str):
+        return await self._get("email", email)
+
+    def invalidate(self, lookup: str, value: str) -> None:
+        self._entries.pop((lookup, value.lower()))
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._hits.clear()
+
+    async def refresh(self) -> int:
+        """Reloads the hot keys close to expiry, returns the number of reloaded keys"""
+        hot = []
+        for key, hits in list(self._hits.items()):
+            expires_in = self._entries.expires_in(key)
+            if expires_in <= 0:
+                # Expired or evicted, the next lookup loads it again
+                del self._hits[key]
+            elif hits >= self._refresh_min_hits and expires_in < self._ttl * self._refresh_ahead:
+                hot.append(key)
+
+        for key in hot:
+            self._hits[key] = 0
+            try:
+                await self._flight.do(key, lambda key=key: self._load(key))
+            except Exception as e:
+                logger.warning(f"Refresh of {key} is failed: {e}")
+            else:
+                LDAP_CACHE_REFRESHES.labels(lookup=key[0]).inc()
+        return len(hot)
+
+    async def _refresh_forever(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            await self.refresh()
+
+    def start_refresher(self, interval: float | None = None) -> None:
+        if self._refresher is None:
+            interval = interval or self._ttl * self._refresh_ahead / 2
+            self._refresher = asyncio.create_task(self._refresh_forever(interval))
+
+    async def close(self) -> None:
+        if self._refresher is not None:
+            self._refresher.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._refresher
+            self._refresher = None
@@ -1,12 +1,33 @@
 import asyncio
+import contextlib
+import copy
+import heapq
+import itertools
 import logging
 import time
 from abc import ABC, abstractmethod
-from datetime import datetime, timedelta
-from enum import IntEnum
+from collections import deque
+from collections.abc import Callable
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, time as day_time, timedelta
+from enum import IntEnum, StrEnum
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from .scheduler_store import JobState, StateStore
 
 logger = logging.getLogger("stdout")
 
+JOB_DURATION = Histogram(
+    "scheduler_job_duration_seconds", "Duration of the job runs", ["job", "status"]
+)
+JOB_START_LAG = Histogram(
+    "scheduler_job_start_lag_seconds", "Delay between the planned and the actual start", ["job"]
+)
+JOB_MISSED = Counter("scheduler_job_missed_total", "Planned runs not started", ["job", "reason"])
+JOB_RUNNING = Gauge("scheduler_job_running", "Runs in progress", ["job"])
+
 
 class Time(IntEnum):
     DAY = 86400
@@ -21,61 +42,585 @@ class Job(ABC):
         pass
 
 
-# For more best way scheduling:
-# https://github.com/dbader/schedule/tree/master
-class Scheduler:
-    def __init__(self, hour: int, minute: int, time_frequency: Time, job: Job) -> None:
-        # self.definer = definer
-        self._frequency = time_frequency
-        self._second_wakeup: timedelta = self.__start_date(hour, minute)
-        self._hour = hour
-        self._minute = minute
-        self._job = job
-
-    def _next_wakeup(self):
-        start_date = datetime.now().replace(
-            hour=self._hour, minute=self._minute, second=0, microsecond=0
+class ExecutionMode(StrEnum):
+    INLINE = "inline"  # a task in the scheduler's event loop
+    THREAD = "thread"  # own event loop in a worker thread, for the blocking jobs
+    PROCESS = "process"  # own event loop in a worker process, for the CPU-bound jobs
+
+
+class CatchUp(StrEnum):
+    """What to do with the runs missed while the app was down, needs a state store"""
+
+    SKIP = "skip"
+    ONCE = "once"  # one run for all the missed ones
+    ALL = "all"  # every missed run, one after another, up to max_catch_up
+
+
+class Overlap(StrEnum):
+    """What to do when the job is due but its previous run is still going"""
+
+    SKIP = "skip"
+    QUEUE = "queue"  # start after the running one, at most one run waits
+    ALLOW = "allow"  # run concurrently, up to max_instances
+
+
+def _run_job(job: Job):
+    """Entry point of the process pool workers, the job must be picklable"""
+    return asyncio.run(job.run())
+
+
+class _ThreadRun:
+    """Runs the job in an event loop of the worker thread, can be cancelled from outside"""
+
+    def __init__(self, job: Job) -> None:
+        self.job = job
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._task: asyncio.Task | None = None
+        self._cancelled = False
+
+    def __call__(self):
+        loop = asyncio.new_event_loop()
+        try:
+            self._task = loop.create_task(self.job.run())
+            self._loop = loop
+            if self._cancelled:
+                self._task.cancel()
+            return loop.run_until_complete(self._task)
+        finally:
+            self._loop = None
+            loop.close()
+
+    def cancel(self) -> None:
+        self._cancelled = True
+        loop = self._loop
+        if loop is not None:
+            with contextlib.suppress(RuntimeError):
+                loop.call_soon_threadsafe(self._task.cancel)
+
+
+class Schedule(ABC):
+    @abstractmethod
+    def next_run(self, previous: float | None, now: float, wall: datetime) -> float:
+        """
+        Next run on the monotonic clock.
+        previous - the monotonic time of the previous planned run, None for the first one,
+        now - the current monotonic time, wall - the same moment on the wall clock
+        """
+
+    @abstractmethod
+    def following(self, planned: datetime) -> datetime:
+        """The planned run after the given one on the wall clock"""
+
+    def missed_runs(self, previous: float, next_run: float) -> int:
+        """Planned runs skipped between previous and next_run"""
+        return 0
+
+    def catch_up(
+        self, last: datetime, wall: datetime, limit: int
+    ) -> tuple[list[datetime], int, datetime]:
+        """
+        The runs planned after the last one up to the wall time: the latest `limit`
+        of them, their total number and the next planned run after the wall time
+        """
+        missed = deque(maxlen=limit)
+        count = 0
+        planned = self.following(last)
+        while planned <= wall:
+            missed.append(planned)
+            count += 1
+            planned = self.following(planned)
+        return list(missed), count, planned
+
+
+class Every(Schedule):
+    """
+    Fixed interval, planned from the previous planned run, so the runs don't drift.
+    >>> Every(Time.HOUR)
+    >>> Every(Time.DAY, at=day_time(7, 0))  # the first run at 07:00, then daily
+    """
+
+    def __init__(self, interval: float, at: day_time | None = None) -> None:
+        if interval <= 0:
+            raise ValueError("Interval must be positive")
+        self.interval = interval
+        self.at = at
+
+    def __repr__(self) -> str:
+        return f"Every({self.interval}, at={self.at})"
+
+    def next_run(self, previous: float | None, now: float, wall: datetime) -> float:
+        if previous is None:
+            if self.at is None:
+                return now + self.interval
+            start = datetime.combine(wall.date(), self.at, wall.tzinfo)
+            if start <= wall:
+                start += timedelta(days=1)
+            return now + (start - wall).total_seconds()
+        next_run = previous + self.interval
+        if next_run <= now:
+            # Behind the schedule: keep the phase, skip the runs in the past
+            next_run += (now - next_run) // self.interval * self.interval + self.interval
+        return next_run
+
+    def missed_runs(self, previous: float, next_run: float) -> int:
+        return max(0, round((next_run - previous) / self.interval) - 1)
+
+    def following(self, planned: datetime) -> datetime:
+        return planned + timedelta(seconds=self.interval)
+
+    def catch_up(
+        self, last: datetime, wall: datetime, limit: int
+    ) -> tuple[list[datetime], int, datetime]:
+        # Long downtime of a short interval, so without the iteration
+        step = timedelta(seconds=self.interval)
+        count = max(0, int((wall - last) / step))
+        first = max(1, count - limit + 1)
+        return [last + step * i for i in range(first, count + 1)], count, last + step * (count + 1)
+
+
+class Cron(Schedule):
+    """
+    Cron expression: minute hour day month weekday, the weekday 0 or 7 is Sunday.
+    Fields support *, lists, ranges and steps, the wall clock is the scheduler's one.
+    >>> Cron("30 2 * * *")  # every night at 02:30
+    >>> Cron("*/15 8-18 * * 1-5")  # every 15 minutes during the working hours
+    """
+
+    _bounds = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression: str) -> None:
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron expression must have 5 fields: {expression!r}")
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            self._parse(value, *bounds) for value, bounds in zip(fields, self._bounds, strict=True)
         )
-        next_start = start_date + timedelta(seconds=self._frequency)
-        return timedelta(
-            seconds=(next_start - datetime.now().replace(microsecond=0)).seconds
+        # Python weekday: Monday is 0, cron weekday: Sunday is 0
+        self.weekdays = frozenset((day - 1) % 7 for day in weekdays)
+        self._any_day = fields[2] == "*"
+        self._any_weekday = fields[4] == "*"
+
+    def __repr__(self) -> str:
+        return f"Cron({self.expression!r})"
+
+    @staticmethod
+    def _parse(value: str, low: int, high: int) -> frozenset[int]:
+        values = set()
+        for part in value.split(","):
+            part, _, step = part.partition("/")
+            if part == "*":
+                start, end = low, high
+            elif "-" in part:
+                start, end = map(int, part.split("-"))
+            else:
+                start = end = int(part)
+                if step:
+                    end = high
+            if not low <= start <= end <= high:
+                raise ValueError(f"Cron field {value!r} is out of {low}-{high}")
+            values.update(range(start, end + 1, int(step or 1)))
+        return frozenset(values)
+
+    def _day_matches(self, day: datetime) -> bool:
+        if day.month not in self.months:
+            return False
+        day_matches = day.day in self.days
+        weekday_matches = day.weekday() in self.weekdays
+        if self._any_day or self._any_weekday:
+            return day_matches and weekday_matches
+        # Both fields are restricted: any of them, like cron does
+        return day_matches or weekday_matches
+
+    def next_time(self, wall: datetime) -> datetime:
+        start = wall.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        day = start.replace(hour=0, minute=0)
+        # Leap day with a weekday may be years ahead
+        for _ in range(366 * 8):
+            if self._day_matches(day):
+                for hour in sorted(self.hours):
+                    for minute in sorted(self.minutes):
+                        candidate = day.replace(hour=hour, minute=minute)
+                        if candidate >= start:
+                            return candidate
+            day += timedelta(days=1)
+        raise ValueError(f"{self} never runs")
+
+    def next_run(self, previous: float | None, now: float, wall: datetime) -> float:
+        return now + (self.next_time(wall) - wall).total_seconds()
+
+    def following(self, planned: datetime) -> datetime:
+        return self.next_time(planned)
+
+
+@dataclass(slots=True)
+class ScheduledJob:
+    name: str
+    job: Job
+    schedule: Schedule
+    mode: ExecutionMode = ExecutionMode.INLINE
+    overlap: Overlap = Overlap.SKIP
+    timeout: float | None = None
+    max_instances: int = 1
+    catch_up: CatchUp = CatchUp.ONCE
+    next_run: float = 0.0
+    runs: int = 0
+    failures: int = 0
+    missed: int = 0
+    running: int = 0
+    waiting: int = 0
+    removed: bool = False
+    restored: bool = True
+    tasks: set[asyncio.Task] = field(default_factory=set)
+    slots: asyncio.Semaphore = field(init=False)
+    state: JobState = field(init=False)
+    saving: asyncio.Lock = field(init=False, default_factory=asyncio.Lock)
+
+    def __post_init__(self) -> None:
+        if self.overlap != Overlap.ALLOW:
+            self.max_instances = 1
+        self.slots = asyncio.Semaphore(self.max_instances)
+        self.state = JobState(self.name)
+
+    def admits(self) -> bool:
+        if self.running + self.waiting < self.max_instances:
+            return True
+        return self.overlap == Overlap.QUEUE and self.waiting == 0
+
+
+class Scheduler:
+    """
+    Runs many jobs in the event loop. The planned runs are kept in a heap ordered by
+    the monotonic time, the loop sleeps until the nearest one and starts the due jobs
+    as tasks, so they don't block each other, the loop or the FastAPI app.
+    max_concurrency caps the runs of all the jobs, the blocking jobs go to the threads,
+    the CPU-bound ones to the processes.
+    With a state store the jobs are planned from their last stored run after a restart,
+    the runs missed meanwhile are caught up by the catch_up policy of the job.
+
+    >>> scheduler = Scheduler(max_concurrency=4, store=SqliteStateStore("scheduler.db"))
+    >>> scheduler.add(DirectorySyncJob(search, engine), Every(15 * Time.MINUTE), timeout=600)
+    >>> scheduler.add(ReportJob(), Cron("0 7 * * 1-5"), mode=ExecutionMode.PROCESS)
+    >>> scheduler.start()  # in the lifespan of the app
+    >>> await scheduler.stop()
+    """
+
+    def __init__(
+        self,
+        clock: Callable[[], float] = time.monotonic,
+        wall_clock: Callable[[], datetime] = datetime.now,
+        max_concurrency: int | None = None,
+        thread_workers: int = 4,
+        process_workers: int = 2,
+        store: StateStore | None = None,
+        max_catch_up: int = 100,
+    ) -> None:
+        self._clock = clock
+        self._wall_clock = wall_clock
+        self._jobs: dict[str, ScheduledJob] = {}
+        self._queue: list[tuple[float, int, ScheduledJob]] = []
+        self._sequence = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._loop_task: asyncio.Task | None = None
+        self._slots = asyncio.Semaphore(max_concurrency) if max_concurrency else None
+        self._thread_workers = thread_workers
+        self._process_workers = process_workers
+        self._executors: dict[ExecutionMode, Executor] = {}
+        self._store = store
+        self._max_catch_up = max_catch_up
+        self._saves: set[asyncio.Task] = set()
+
+    @property
+    def jobs(self) -> dict[str, ScheduledJob]:
+        return self._jobs
+
+    def _push(self, entry: ScheduledJob, previous: float | None) -> None:
+        entry.next_run = entry.schedule.next_run(previous, self._clock(), self._wall_clock())
+        if previous is not None and (
+            missed := entry.schedule.missed_runs(previous, entry.next_run)
+        ):
+            self._miss(entry, "late", missed)
+        heapq.heappush(self._queue, (entry.next_run, next(self._sequence), entry))
+
+    def add(
+        self,
+        job: Job,
+        schedule: Schedule,
+        name: str | None = None,
+        mode: ExecutionMode = ExecutionMode.INLINE,
+        overlap: Overlap = Overlap.SKIP,
+        timeout: float | None = None,
+        max_instances: int = 1,
+        catch_up: CatchUp = CatchUp.ONCE,
+    ) -> ScheduledJob:
+        """
+        timeout cancels the inline runs. A thread run is cancelled at its next await,
+        the blocking code in it can't be interrupted, a process run can't be interrupted
+        at all: after the timeout they keep the slot of the job until they really end,
+        so the overlap policy still holds for them.
+        """
+        name = name or repr(job)
+        if name in self._jobs:
+            raise ValueError(f"Job {name} is already scheduled")
+        entry = self._jobs[name] = ScheduledJob(
+            name, job, schedule, mode, overlap, timeout, max_instances, catch_up
         )
+        if self._store is None:
+            self._push(entry, None)
+            logger.info(
+                f"Job {name} is scheduled by {schedule}, next run in {self.next_in(name):.0f}s"
+            )
+        else:
+            # Planned by restore() from the stored state
+            entry.restored = False
+        # The nearest run may have changed
+        self._wakeup.set()
+        return entry
+
+    def _to_wall(self, planned: float) -> datetime:
+        return self._wall_clock() - timedelta(seconds=self._clock() - planned)
+
+    async def _save(self, entry: ScheduledJob, state: JobState) -> None:
+        # The lock keeps the order of the saves of the job
+        async with entry.saving:
+            try:
+                await self._store.save(state)
+            except Exception as e:
+                logger.error(f"State of {entry.name} is not saved: {e}")
+
+    def _persist(self, entry: ScheduledJob) -> None:
+        if self._store is not None:
+            task = asyncio.create_task(self._save(entry, copy.copy(entry.state)))
+            self._saves.add(task)
+            task.add_done_callback(self._saves.discard)
+
+    async def restore(self) -> None:
+        """Plans the jobs added since the last call from their stored state"""
+        for entry in [entry for entry in self._jobs.values() if not entry.restored]:
+            entry.restored = True
+            try:
+                state = await self._store.load(entry.name)
+            except Exception as e:
+                logger.error(f"State of {entry.name} is not loaded: {e}")
+                state = None
+            if entry.removed:
+                continue
+            if state is not None:
+                entry.state = state
+            if state is None or state.last_planned is None:
+                self._push(entry, None)
+            else:
+                self._plan_from(entry, state.last_planned, self._interrupted(state))
+            logger.info(
+                f"Job {entry.name} is scheduled by {entry.schedule}, "
+                f"next run in {self.next_in(entry.name):.0f}s"
+            )
 
-    def __start_date(self, hour, minute):
-        start_date = datetime.now().replace(
-            hour=hour, minute=minute, second=0, microsecond=0
+    @staticmethod
+    def _interrupted(state: JobState) -> bool:
+        """The last run was started, but the app was stopped or crashed before its end"""
+        if state.last_status == "cancelled":
+            return True
+        return state.last_started is not None and (
+            state.last_finished is None or state.last_finished < state.last_started
         )
-        delta = start_date - datetime.now().replace(microsecond=0)
-        return timedelta(seconds=delta.seconds)
 
-    async def start(self):
-        # it is the start time
-        logger.info(
-            f"Start app in: {datetime.now() + self._second_wakeup}"  # noqa: E501
+    def _plan_from(self, entry: ScheduledJob, last_planned: datetime, interrupted: bool) -> None:
+        wall = self._wall_clock()
+        missed, count, next_planned = entry.schedule.catch_up(
+            last_planned, wall, self._max_catch_up
         )
-        time.sleep(self._second_wakeup.seconds)
-        # await asyncio.sleep(self._second_wakeup)
+        if interrupted:
+            # Caught up like the runs missed during the downtime
+            logger.warning(f"Job {entry.name}: the run planned at {last_planned} was interrupted")
+            missed = [last_planned, *missed][-self._max_catch_up :]
+            count += 1
+        entry.next_run = self._clock() + (next_planned - wall).total_seconds()
+        heapq.heappush(self._queue, (entry.next_run, next(self._sequence), entry))
+        if not count:
+            return
+
+        runs = {CatchUp.SKIP: [], CatchUp.ONCE: missed[-1:], CatchUp.ALL: missed}[entry.catch_up]
+        if count > len(runs):
+            self._miss(entry, "downtime", count - len(runs))
+        if runs:
+            logger.info(f"Job {entry.name} catches up {len(runs)} of {count} missed run(s)")
+            task = asyncio.create_task(self._catch_up(entry, runs), name=f"catch-up:{entry.name}")
+            entry.tasks.add(task)
+            task.add_done_callback(entry.tasks.discard)
+
+    async def _catch_up(self, entry: ScheduledJob, runs: list[datetime]) -> None:
+        for planned in runs:
+            entry.state.last_planned = planned
+            self._persist(entry)
+            entry.waiting += 1
+            wall, now = self._wall_clock(), self._clock()
+            await self._execute(entry, now - (wall - planned).total_seconds())
+
+    def remove(self, name: str) -> None:
+        # The heap item is dropped when it comes up
+        self._jobs.pop(name).removed = True
+
+    def next_in(self, name: str) -> float:
+        return max(0.0, self._jobs[name].next_run - self._clock())
+
+    @staticmethod
+    def _miss(entry: ScheduledJob, reason: str, count: int = 1) -> None:
+        entry.missed += count
+        JOB_MISSED.labels(job=entry.name, reason=reason).inc(count)
+        logger.warning(f"Job {entry.name} missed {count} run(s): {reason}")
+
+    def _executor(self, mode: ExecutionMode) -> Executor:
+        if mode not in self._executors:
+            if mode == ExecutionMode.THREAD:
+                executor = ThreadPoolExecutor(self._thread_workers, thread_name_prefix="job")
+            else:
+                executor = ProcessPoolExecutor(self._process_workers)
+            self._executors[mode] = executor
+        return self._executors[mode]
+
+    async def _call(self, entry: ScheduledJob) -> None:
+        if entry.mode == ExecutionMode.INLINE:
+            async with asyncio.timeout(entry.timeout):
+                await entry.job.run()
+            return
+
+        loop = asyncio.get_running_loop()
+        if entry.mode == ExecutionMode.THREAD:
+            run = _ThreadRun(entry.job)
+            future = loop.run_in_executor(self._executor(entry.mode), run)
+        else:
+            run = None
+            future = loop.run_in_executor(self._executor(entry.mode), _run_job, entry.job)
+        try:
+            async with asyncio.timeout(entry.timeout):
+                await asyncio.shield(future)
+        except TimeoutError:
+            if run is not None:
+                run.cancel()
+            if not future.done():
+                logger.warning(f"Job {entry.name} is timed out, waiting for its {entry.mode}")
+            # Its own result or error is dropped, the result of the run is the timeout
+            await asyncio.wait({future})
+            if not future.cancelled():
+                future.exception()
+            raise
+        except asyncio.CancelledError:
+            if run is not None:
+                run.cancel()
+            raise
+
+    async def _execute(self, entry: ScheduledJob, planned: float) -> None:
+        acquired = False
+        try:
+            async with entry.slots:
+                acquired = True
+                entry.waiting -= 1
+                entry.running += 1
+                try:
+                    async with self._slots or contextlib.nullcontext():
+                        await self._run(entry, planned)
+                finally:
+                    entry.running -= 1
+        finally:
+            if not acquired:
+                entry.waiting -= 1
+
+    async def _run(self, entry: ScheduledJob, planned: float) -> None:
+        JOB_START_LAG.labels(job=entry.name).observe(max(0.0, self._clock() - planned))
+        JOB_RUNNING.labels(job=entry.name).inc()
+        entry.state.last_started = self._wall_clock()
+        self._persist(entry)
+        status = "success"
+        start_time = time.perf_counter()
+        try:
+            await self._call(entry)
+        except TimeoutError:
+            status = "timeout"
+            entry.failures += 1
+            logger.error(f"Job {entry.name} is timed out after {entry.timeout}s")
+        except asyncio.CancelledError:
+            status = "cancelled"
+            raise
+        except Exception as e:
+            status = "error"
+            entry.failures += 1
+            logger.error(f"Something wrong for {entry.name}: {e}")
+        finally:
+            entry.runs += 1
+            entry.state.last_finished = self._wall_clock()
+            entry.state.last_status = status
+            self._persist(entry)
+            JOB_RUNNING.labels(job=entry.name).dec()
+            JOB_DURATION.labels(job=entry.name, status=status).observe(
+                time.perf_counter() - start_time
+            )
+
+    def _spawn(self, entry: ScheduledJob, planned: float) -> asyncio.Task:
+        # Counted as waiting until the task takes a slot of the job
+        entry.waiting += 1
+        task = asyncio.create_task(self._execute(entry, planned), name=f"job:{entry.name}")
+        entry.tasks.add(task)
+        task.add_done_callback(entry.tasks.discard)
+        return task
+
+    def run_pending(self) -> float | None:
+        """Starts the due jobs, returns the seconds until the next run, None without jobs"""
+        while self._queue:
+            next_run, _, entry = self._queue[0]
+            if entry.removed:
+                heapq.heappop(self._queue)
+                continue
+            now = self._clock()
+            if next_run > now:
+                return next_run - now
+            heapq.heappop(self._queue)
+            entry.state.last_planned = self._to_wall(next_run)
+            self._persist(entry)
+            if entry.admits():
+                self._spawn(entry, next_run)
+            else:
+                self._miss(entry, "overlap")
+            self._push(entry, next_run)
+        return None
+
+    async def _run_forever(self) -> None:
         while True:
-            try:
-                loop = asyncio.get_event_loop()
-                # loop = asyncio.new_event_loop() if not loop.is_running()
-                if not loop.is_running():
-                    loop = asyncio.new_event_loop()
-                    loop.run_until_complete(self._job.run())
-                    loop.close()
-                else:
-                    # second_wakeup
-                    await self._job.run()
-            except Exception as e:
-                logger.error(f"Something wrong for {self._job}: {e}")
-            finally:
-                self._second_wakeup = self._next_wakeup()
-                logger.info(f"Next Wakeup: {datetime.now() + self._second_wakeup}")
-                time.sleep(self._second_wakeup.seconds)
-                # await asyncio.sleep(self._frequency)
-
-    def stop(self):
-        pass
+            self._wakeup.clear()
+            if self._store is not None:
+                await self.restore()
+            delay = self.run_pending()
+            # Woken up earlier by add(), the queue is checked again
+            with contextlib.suppress(TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+
+    def start(self) -> asyncio.Task:
+        if self._loop_task is None or self._loop_task.done():
+            self._loop_task = asyncio.create_task(self._run_forever(), name="scheduler")
+        return self._loop_task
+
+    async def serve(self) -> None:
+        """Runs until cancelled, for the standalone scripts"""
+        try:
+            await self.start()
+        finally:
+            await self.stop()
+
+    async def stop(self, wait: bool = True) -> None:
+        if self._loop_task is not None:
+            self._loop_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._loop_task
+            self._loop_task = None
+        tasks = [task for entry in self._jobs.values() for task in entry.tasks]
+        if not wait:
+            for task in tasks:
+                task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.gather(*self._saves, return_exceptions=True)
+        for executor in self._executors.values():
+            executor.shutdown(wait=wait, cancel_futures=not wait)
+        self._executors.clear()
 
 
 class TestJob(Job):
@@ -89,7 +634,8 @@ if __name__ == "__main__":
     MINUTE = 57
 
     async def main():
-        scheduler = Scheduler(HOUR, MINUTE, Time.MINUTE, TestJob())
-        await scheduler.start()
+        scheduler = Scheduler()
+        scheduler.add(TestJob(), Every(Time.MINUTE, at=day_time(HOUR, MINUTE)))
+        await scheduler.serve()
 
     asyncio.run(main())
@@ -0,0 +1,146 @@
+import asyncio
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, fields
+from datetime import datetime
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from app.database.connection import AsyncConnection
+
+"""
+Description: Durable state of the scheduled jobs
+The scheduler records the last planned, started and finished run of every job,
+after a restart it plans from the stored run and catches up the missed ones.
+
+Example of usage:
+>>> scheduler = Scheduler(store=SqliteStateStore("/var/lib/app/scheduler.db"))
+>>> scheduler = Scheduler(store=DataBaseStateStore(engine))
+"""
+
+
+@dataclass(slots=True)
+class JobState:
+    name: str
+    last_planned: datetime | None = None
+    last_started: datetime | None = None
+    last_finished: datetime | None = None
+    last_status: str | None = None
+
+
+_COLUMNS = tuple(field.name for field in fields(JobState))
+
+
+def _times(state: JobState) -> tuple[datetime | None, ...]:
+    return state.last_planned, state.last_started, state.last_finished
+
+
+class StateStore(ABC):
+    @abstractmethod
+    async def load(self, name: str) -> JobState | None:
+        pass
+
+    @abstractmethod
+    async def save(self, state: JobState) -> None:
+        pass
+
+    @abstractmethod
+    async def close(self) -> None:
+        pass
+
+
+class SqliteStateStore(StateStore):
+    """Local file, the queries are short, they run in the default thread pool"""
+
+    def __init__(self, path: str | Path) -> None:
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS scheduler_jobs ("
+                "name TEXT PRIMARY KEY, last_planned TEXT, last_started TEXT, "
+                "last_finished TEXT, last_status TEXT)"
+            )
+
+    def _load(self, name: str) -> JobState | None:
+        with self._lock:
+            row = self._connection.execute(
+                f"SELECT {', '.join(_COLUMNS)} FROM scheduler_jobs WHERE name = ?", (name,)
+            ).fetchone()
+        if row is None:
+            return None
+        name, *times, status = row
+        return JobState(name, *(time and datetime.fromisoformat(time) for time in times), status)
+
+    def _save(self, state: JobState) -> None:
+        with self._lock, self._connection:
+            self._connection.execute(
+                f"INSERT OR REPLACE INTO scheduler_jobs ({', '.join(_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(_COLUMNS))})",
+                (
+                    state.name,
+                    *(time and time.isoformat() for time in _times(state)),
+                    state.last_status,
+                ),
+            )
+
+    async def load(self, name: str) -> JobState | None:
+        return await asyncio.to_thread(self._load, name)
+
+    async def save(self, state: JobState) -> None:
+        await asyncio.to_thread(self._save, state)
+
+    async def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+class DataBaseStateStore(StateStore):
+    """Shared by the instances of the app, the jobs are named uniquely across them"""
+
+    DDL = """
+        CREATE TABLE IF NOT EXISTS scheduler_jobs (
+            name text PRIMARY KEY,
+            last_planned timestamp,
+            last_started timestamp,
+            last_finished timestamp,
+            last_status text
+        )
+    """
+    LOAD_SQL = f"SELECT {', '.join(_COLUMNS)} FROM scheduler_jobs WHERE name = %s"
+    SAVE_SQL = f"""
+        INSERT INTO scheduler_jobs ({", ".join(_COLUMNS)})
+        VALUES ({", ".join(["%s"] * len(_COLUMNS))})
+        ON CONFLICT (name) DO UPDATE SET
+        {", ".join(f"{column} = EXCLUDED.{column}" for column in _COLUMNS[1:])}
+    """
+
+    def __init__(self, engine: "AsyncConnection") -> None:
+        # psycopg and the database settings are imported only by the apps using this store
+        from app.database.clusters import DataBase
+
+        self._database = DataBase
+        self._engine = engine
+        self._created = False
+
+    async def _ensure_table(self, db) -> None:
+        if not self._created:
+            await db.execute(self.DDL)
+            self._created = True
+
+    async def load(self, name: str) -> JobState | None:
+        async with self._database(self._engine) as db:
+            await self._ensure_table(db)
+            rows = await db.fetchall(self.LOAD_SQL, name)
+        return JobState(**rows[0]) if rows else None
+
+    async def save(self, state: JobState) -> None:
+        async with self._database(self._engine) as db:
+            await self._ensure_table(db)
+            await db.execute(self.SAVE_SQL, *(getattr(state, column) for column in _COLUMNS))
+
+    async def close(self) -> None:
+        # The engine belongs to the app
+        pass
@@ -0,0 +1,54 @@
+"""
+Requests/s of BaseApi with a client per request vs the shared pooled client.
+
+Run:
+    python -m benchmarks.api_client --requests 2000 --concurrency 20
+"""
+
+import argparse
+import asyncio
+import time
+
+from httpx import AsyncClient
+
+from app.services.api.base import BaseApi
+from app.services.api.client import HttpClients
+from benchmarks.stub_server import server_url, start_stub_server
+
+
+class ClientPerRequest(HttpClients):
+    """Old behaviour: a new AsyncClient (and connection) for every call"""
+
+    def get(self, base_url: str) -> AsyncClient:
+        client = self._create()
+        self._clients[str(id(client))] = client
+        return client
+
+
+async def run(api: BaseApi, requests: int, concurrency: int) -> float:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def call():
+        async with semaphore:
+            await api._request("/")
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*(call() for _ in range(requests)))
+    return requests / (time.perf_counter() - start_time)
+
+
+async def main(requests: int, concurrency: int):
+    url = server_url(start_stub_server())
+    for name, clients in (("per-request", ClientPerRequest()), ("shared", HttpClients())):
+        api = BaseApi(url, clients=clients)
+        rps = await run(api, requests, concurrency)
+        await clients.aclose()
+        print(f"{name:>12}: {rps:.0f} req/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(main(args.requests, args.concurrency))
@@ -0,0 +1,70 @@
+"""
+Latency and peak Python memory of a multi-MB JSON payload:
+buffered BaseApi._request vs incremental BaseApi.stream_items.
+
+Run:
+    python -m benchmarks.api_stream --items 200000
+"""
+
+import argparse
+import asyncio
+import json
+import time
+import tracemalloc
+
+from app.services.api.base import BaseApi
+from app.services.api.client import HttpClients
+from benchmarks.stub_server import StubHandler, server_url, start_stub_server
+
+
+def payload_handler(items: int):
+    body = json.dumps([{"id": i, "name": f"user-{i}", "active": i % 2 == 0} for i in range(items)])
+
+    class PayloadHandler(StubHandler):
+        pass
+
+    PayloadHandler.body = body.encode()
+    return PayloadHandler
+
+
+async def buffered(api: BaseApi) -> int:
+    return len(await api._request("/"))
+
+
+async def streamed(api: BaseApi) -> int:
+    count = 0
+    async for _ in api.stream_items("/"):
+        count += 1
+    return count
+
+
+async def measure(api: BaseApi, fn) -> tuple[int, float, float]:
+    start_time = time.perf_counter()
+    count = await fn(api)
+    duration = time.perf_counter() - start_time
+
+    # tracemalloc slows the run down, so the memory is measured in a separate run
+    tracemalloc.start()
+    await fn(api)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return count, duration, peak
+
+
+async def main(items: int):
+    handler = payload_handler(items)
+    print(f"payload: {len(handler.body) / 2**20:.1f}MB")
+    clients = HttpClients()
+    api = BaseApi(server_url(start_stub_server(handler)), clients=clients)
+    await api._request("/")  # warm up the connection
+    for name, fn in (("buffered", buffered), ("stream", streamed)):
+        count, duration, peak = await measure(api, fn)
+        print(f"{name:>9}: items={count} time={duration:.2f}s peak={peak / 2**20:.1f}MB")
+    await clients.aclose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", type=int, default=200_000)
+    args = parser.parse_args()
+    asyncio.run(main(args.items))
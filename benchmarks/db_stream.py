@@ -0,0 +1,63 @@
+"""
+Peak RSS of DataBase.fetchall vs DataBase.stream for a big result set.
+Every mode is started in a fresh process, so ru_maxrss belongs to this mode only.
+
+Run (PG_* variables must be set):
+    python -m benchmarks.db_stream --rows 3000000
+"""
+
+import argparse
+import asyncio
+import resource
+import subprocess
+import sys
+import time
+
+from app.configs import get_database_settings
+from app.database.clusters import DataBase
+from app.database.connection import PsycopgAsyncConnection
+
+SQL = "SELECT g AS id, md5(g::text) AS payload, now() AS created FROM generate_series(1, %s) g"
+
+
+async def run(mode: str, rows: int, batch_size: int) -> int:
+    engine = PsycopgAsyncConnection(get_database_settings().pg_dsn)
+    count = 0
+    async with DataBase(engine) as db:
+        if mode == "fetchall":
+            count = len(await db.fetchall(SQL, rows))
+        else:
+            async for _ in db.stream(SQL, rows, batch_size=batch_size):
+                count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=3_000_000)
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--mode", choices=["fetchall", "stream"])
+    args = parser.parse_args()
+
+    if args.mode:
+        start_time = time.perf_counter()
+        count = asyncio.run(run(args.mode, args.rows, args.batch_size))
+        duration = time.perf_counter() - start_time
+        peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print(f"{args.mode:>8}: rows={count} time={duration:.2f}s peak_rss={peak_mb:.1f}MB")
+        return
+
+    for mode in ("fetchall", "stream"):
+        subprocess.run(
+            [
+                sys.executable, "-m", "benchmarks.db_stream",
+                "--mode", mode,
+                "--rows", str(args.rows),
+                "--batch-size", str(args.batch_size),
+            ],
+            check=True,
+        )  # fmt: skip
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+"""
+Resolving a list of users: one LdapSearch.user per name vs LdapSearch.users
+with OR-filter batches, against a local LDAP stand-in.
+
+Run:
+    python -m benchmarks.ldap_bulk --users 500 --latency 0.02 --batch-size 50
+"""
+
+import argparse
+import time
+
+from app.services.ldap import LdapSearch
+from benchmarks.ldap_stub import StubLdap
+
+
+def one_by_one(search: LdapSearch, names: list[str], batch_size: int) -> dict:
+    return {name: search.user(name)[2] for name in names}
+
+
+def bulk(search: LdapSearch, names: list[str], batch_size: int) -> dict:
+    return search.users(names, batch_size=batch_size)
+
+
+def main(users: int, latency: float, batch_size: int):
+    names = [f"user{i}" for i in range(users)]
+    for name, fn in (("one by one", one_by_one), ("bulk", bulk)):
+        ldap = StubLdap(latency, users)
+        start_time = time.perf_counter()
+        found = fn(LdapSearch(ldap), names, batch_size)
+        duration = time.perf_counter() - start_time
+        print(
+            f"{name:>10}: found={sum(map(bool, found.values()))} "
+            f"searches={ldap.connection.searches} time={duration:.2f}s"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--batch-size", type=int, default=50)
+    args = parser.parse_args()
+    main(args.users, args.latency, args.batch_size)
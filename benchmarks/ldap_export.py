@@ -0,0 +1,54 @@
+"""
+Peak Python memory of exporting every user to JSON:
+unpaged all_users + dump_to_json vs paged iter_users + dump_to_file.
+
+Run:
+    python -m benchmarks.ldap_export --users 50000 --page-size 1000
+"""
+
+import argparse
+import os
+import time
+import tracemalloc
+
+from app.services.ldap import LdapSearch
+from benchmarks.ldap_stub import StubLdap
+
+
+def buffered(search: LdapSearch, fp) -> None:
+    _, _, response, _ = search.connection.search(search.search_base, "(objectClass=user)")
+    fp.write(search.dump_to_json(response))
+
+
+def streamed(search: LdapSearch, fp) -> None:
+    search.dump_to_file(search.iter_users(), fp)
+
+
+def measure(fn, users: int, page_size: int) -> tuple[float, float]:
+    # The stub keeps its own directory, it is created outside of the measurement
+    search = LdapSearch(StubLdap(latency=0, users=users), page_size=page_size)
+    with open(os.devnull, "w") as fp:
+        start_time = time.perf_counter()
+        fn(search, fp)
+        duration = time.perf_counter() - start_time
+
+        # tracemalloc slows the run down, so the memory is measured in a separate run
+        tracemalloc.start()
+        fn(search, fp)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return duration, peak
+
+
+def main(users: int, page_size: int):
+    for name, fn in (("buffered", buffered), ("stream", streamed)):
+        duration, peak = measure(fn, users, page_size)
+        print(f"{name:>9}: time={duration:.2f}s peak={peak / 2**20:.1f}MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=50_000)
+    parser.add_argument("--page-size", type=int, default=1000)
+    args = parser.parse_args()
+    main(args.users, args.page_size)
@@ -0,0 +1,49 @@
+"""
+Throughput of concurrent user lookups from the event loop:
+blocking LdapSearch vs AsyncLdapSearch, against a local LDAP stand-in.
+
+Run:
+    python -m benchmarks.ldap_load --lookups 400 --latency 0.02 --workers 16
+"""
+
+import argparse
+import asyncio
+import time
+
+from app.services.ldap import AsyncLdapSearch, LdapSearch
+from benchmarks.ldap_stub import StubLdap
+
+
+async def blocking(lookups: int, latency: float, workers: int) -> float:
+    search = LdapSearch(StubLdap(latency))
+
+    async def lookup(i):  # noqa: RUF029 - a handler calling the blocking search
+        return search.user(f"user{i}")
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*(lookup(i) for i in range(lookups)))
+    return lookups / (time.perf_counter() - start_time)
+
+
+async def non_blocking(lookups: int, latency: float, workers: int) -> float:
+    search = AsyncLdapSearch(lambda: StubLdap(latency), max_workers=workers)
+    start_time = time.perf_counter()
+    await asyncio.gather(*(search.user(f"user{i}") for i in range(lookups)))
+    rps = lookups / (time.perf_counter() - start_time)
+    search.close()
+    return rps
+
+
+async def main(lookups: int, latency: float, workers: int):
+    for name, fn in (("blocking", blocking), ("async", non_blocking)):
+        rps = await fn(lookups, latency, workers)
+        print(f"{name:>9}: {rps:.0f} lookups/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lookups", type=int, default=400)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--workers", type=int, default=16)
+    args = parser.parse_args()
+    asyncio.run(main(args.lookups, args.latency, args.workers))
@@ -0,0 +1,60 @@
+"""Local LDAP stand-in: answers every search after a fixed network-like latency"""
+
+import re
+import time
+
+from app.services.ldap import PAGED_RESULTS_CONTROL
+
+
+class StubConnection:
+    def __init__(self, latency: float = 0.02, users: int = 1000):
+        self.latency = latency
+        self.entries = []
+        self.closed = False
+        self.bound = True
+        self.searches = 0
+        self._users = {
+            f"user{i}": {
+                "dn": f"CN=User {i},OU=Users,DC=katren,DC=net",
+                "attributes": {"sAMAccountName": f"user{i}", "mail": f"user{i}@katren.net"},
+            }
+            for i in range(users)
+        }
+        self._all = list(self._users.values())
+
+    def search(
+        self,
+        search_base,
+        search_filter,
+        attributes=None,
+        paged_size=None,
+        paged_cookie=None,
+        **kwargs,
+    ):
+        time.sleep(self.latency)  # releases the GIL like the real socket read
+        self.searches += 1
+        result = {"result": 0, "description": "success"}
+        names = re.findall(r"sAMAccountName=([^)]+)", search_filter)
+        names += [mail.split("@")[0] for mail in re.findall(r"\(mail=([^)]+)", search_filter)]
+        if names:
+            response = [self._users[name] for name in names if name in self._users]
+        else:
+            response = self._all
+        if paged_size:
+            offset = int(paged_cookie or 0)
+            end = offset + paged_size
+            cookie = str(end).encode() if end < len(response) else b""
+            response = response[offset:end]
+            result["controls"] = {PAGED_RESULTS_CONTROL: {"value": {"cookie": cookie}}}
+        return bool(response), result, response, None
+
+    def unbind(self):
+        self.closed = True
+        self.bound = False
+
+
+class StubLdap:
+    """Stands for app.drivers.ldap.LdapConnection"""
+
+    def __init__(self, latency: float = 0.02, users: int = 1000):
+        self.connection = StubConnection(latency, users)
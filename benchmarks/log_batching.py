@@ -0,0 +1,70 @@
+"""
+QueueListener + StreamHandler vs BatchingQueueListener + BatchStreamHandler:
+records per second and write syscalls of the stream, a line-buffered file like stderr.
+
+Run:
+    python -m benchmarks.log_batching --records 100000
+"""
+
+import argparse
+import io
+import logging
+import logging.handlers
+import queue
+import tempfile
+import time
+
+from app.core.configs.log_settings import (
+    BatchingQueueListener,
+    BatchStreamHandler,
+    JSONFormatter,
+)
+
+FORMAT = "%(process)d::%(filename)s::%(lineno)s::%(message)s::%(req_id)s"
+
+
+class CountingFileIO(io.FileIO):
+    writes = 0
+
+    def write(self, data):
+        CountingFileIO.writes += 1
+        return super().write(data)
+
+
+def run(listener_class, handler_class, records: int, path: str) -> tuple[float, int]:
+    CountingFileIO.writes = 0
+    stream = io.TextIOWrapper(io.BufferedWriter(CountingFileIO(path, "w")), line_buffering=True)
+    handler = handler_class(stream)
+    handler.setFormatter(JSONFormatter(FORMAT))
+    log_queue = queue.Queue(-1)
+    logger = logging.Logger("benchmark")
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = listener_class(log_queue, handler)
+    if not listener._thread:
+        listener.start()
+
+    start_time = time.perf_counter()
+    for i in range(records):
+        logger.info("request %s is done", i)
+    listener.stop()
+    duration = time.perf_counter() - start_time
+    stream.close()
+    return records / duration, CountingFileIO.writes
+
+
+def main(records: int):
+    variants = {
+        "per record": (logging.handlers.QueueListener, logging.StreamHandler),
+        "batched": (BatchingQueueListener, BatchStreamHandler),
+    }
+    with tempfile.NamedTemporaryFile() as file:
+        for name, (listener_class, handler_class) in variants.items():
+            speed, writes = run(listener_class, handler_class, records, file.name)
+            print(f"{name:>10}: {speed:,.0f} records/s, {writes:,} writes")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, default=100_000)
+    args = parser.parse_args()
+    main(args.records)
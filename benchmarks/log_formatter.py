@@ -0,0 +1,98 @@
+"""
+JSONFormatter before and after the precompiled field plan: records per second
+and peak memory allocated while formatting one record (tracemalloc, separate run).
+
+Run:
+    python -m benchmarks.log_formatter --records 200000
+"""
+
+import argparse
+import json
+import logging
+import time
+import tracemalloc
+
+from app.core.configs.log_settings import JSONFormatter
+
+FORMAT = "%(process)d::%(filename)s::%(lineno)s::%(message)s::%(req_id)s"
+
+
+class LegacyJSONFormatter(JSONFormatter):
+    """formatMessage as it was: the format is parsed and the time formatted per record"""
+
+    COUNTER = 0
+
+    def format(self, record) -> str:
+        return logging.Formatter.format(self, record)
+
+    def formatTime(self, record, datefmt=None) -> str:
+        return logging.Formatter.formatTime(self, record, datefmt)
+
+    def formatMessage(self, record) -> str:
+        ready_message: dict = {}
+        values = record.__dict__
+
+        self.COUNTER += 1
+        logger_name: str = values["name"]
+        ready_message["app.name"] = "appname"
+        ready_message["app.version"] = "1.0.0"
+        ready_message["app.logger"] = logger_name
+        ready_message["time"] = self.formatTime(record, self.datefmt)
+        ready_message["level"] = values.get("levelname")
+        ready_message["log_id"] = self.COUNTER
+        ready_message["message"] = str(values["message"])
+
+        if not values.get("req_id"):
+            values["req_id"] = self._req_id.get()
+
+        for value_name in self._pattern.findall(self._fmt):
+            value = values.get(value_name)
+            ready_message.update({value_name: value})
+
+        return json.dumps(ready_message, ensure_ascii=False)
+
+
+def make_records(count: int) -> list[logging.LogRecord]:
+    logger = logging.getLogger("stdout")
+    return [
+        logger.makeRecord("stdout", logging.INFO, __file__, i, "request %s is done", (i,), None)
+        for i in range(count)
+    ]
+
+
+def records_per_second(formatter: logging.Formatter, records: list[logging.LogRecord]) -> float:
+    start_time = time.perf_counter()
+    for record in records:
+        formatter.format(record)
+    return len(records) / (time.perf_counter() - start_time)
+
+
+def peak_per_record(formatter: logging.Formatter, records: list[logging.LogRecord]) -> float:
+    tracemalloc.start()
+    total = 0
+    for record in records:
+        tracemalloc.reset_peak()
+        current, _ = tracemalloc.get_traced_memory()
+        formatter.format(record)
+        total += tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+    return total / len(records)
+
+
+def main(records: int):
+    formatters = {
+        "legacy": LegacyJSONFormatter(FORMAT),
+        "stdlib json": JSONFormatter(FORMAT, encoder=json.JSONEncoder(ensure_ascii=False).encode),
+        "default": JSONFormatter(FORMAT),
+    }
+    for name, formatter in formatters.items():
+        speed = records_per_second(formatter, make_records(records))
+        memory = peak_per_record(formatter, make_records(min(records, 20_000)))
+        print(f"{name:>12}: {speed:,.0f} records/s, {memory:,.0f} bytes peak per record")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, default=200_000)
+    args = parser.parse_args()
+    main(args.records)
@@ -0,0 +1,52 @@
+"""
+Allocations and throughput of DataBase.fetchall for every RowMode.
+
+Run (PG_* variables must be set):
+    python -m benchmarks.row_modes --rows 200000 --repeat 5
+"""
+
+import argparse
+import asyncio
+import time
+import tracemalloc
+
+from app.configs import get_database_settings
+from app.database.clusters import DataBase
+from app.database.connection import PsycopgAsyncConnection, RowMode
+
+SQL = "SELECT g AS id, md5(g::text) AS name, g % 7 AS grp FROM generate_series(1, %s) g"
+
+
+async def measure(db: DataBase, mode: RowMode, rows: int, repeat: int) -> tuple[float, int, int]:
+    await db.fetchall(SQL, rows, row_mode=mode)  # warm up
+
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        await db.fetchall(SQL, rows, row_mode=mode)
+    rows_per_second = rows * repeat / (time.perf_counter() - start_time)
+
+    tracemalloc.start()
+    result = await db.fetchall(SQL, rows, row_mode=mode)
+    snapshot = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    blocks = sum(stat.count for stat in snapshot.statistics("filename"))
+    del result
+    return rows_per_second, blocks, peak
+
+
+async def main(rows: int, repeat: int):
+    engine = PsycopgAsyncConnection(get_database_settings().pg_dsn)
+    async with DataBase(engine) as db:
+        print(f"{'mode':>9} {'rows/s':>12} {'blocks':>10} {'peak MB':>9}")
+        for mode in RowMode:
+            rows_per_second, blocks, peak = await measure(db, mode, rows, repeat)
+            print(f"{mode:>9} {rows_per_second:>12.0f} {blocks:>10} {peak / 2**20:>9.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    asyncio.run(main(args.rows, args.repeat))
@@ -16,8 +16,11 @@ from prometheus_client import (
 from starlette.middleware.cors import CORSMiddleware
 
 from app.api.v1 import routers
-from app.configs import get_appsettings, get_logger
+from app.configs import get_appsettings, get_database_settings, get_logger
 from app.core.configs import LogConfig
+from app.database.clusters import DataBaseCluster
+from app.database.metrics import update_pool_metrics
+from app.services.api.client import http_clients
 
 logger = get_logger()
 
@@ -27,7 +30,14 @@ settings = get_appsettings()
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # For activation of connections, creds and etc...
-    yield
+    app.state.db_cluster = DataBaseCluster.from_settings(get_database_settings())
+    app.state.db_engine = app.state.db_cluster.engines[0]
+    await app.state.db_cluster.open()
+    try:
+        yield
+    finally:
+        await http_clients.aclose()
+        await app.state.db_cluster.close()
 
 
 app = FastAPI(
@@ -82,6 +92,8 @@ def update_system_metrics():
 @app.get("/metrics")
 async def metrics():
     update_system_metrics()
+    for engine in app.state.db_cluster.engines:
+        update_pool_metrics(engine)
     return Response(generate_latest(REGISTRY), media_type=CONTENT_TYPE_LATEST)
 
 
@@ -0,0 +1,30 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+
+class FakeClock:
+    """Monotonic and wall clocks moving together, the wall clock starts at `start`"""
+
+    def __init__(self, now=0.0, start=datetime(2024, 1, 1, 6, 30)):
+        self.now = now
+        self.origin = now
+        self.start = start
+
+    def __call__(self):
+        return self.now
+
+    def wall(self):
+        return self.start + timedelta(seconds=self.now - self.origin)
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def fake_clock(request):
+    """Also set as self.clock of the unittest test cases, before their setUp"""
+    clock = FakeClock()
+    if request.instance is not None:
+        request.instance.clock = clock
+    return clock
@@ -0,0 +1,570 @@
+import asyncio
+import itertools
+import json
+import time
+import unittest
+
+import httpx
+import pytest
+
+from app.core.configs import HttpClientSettings
+from app.services.api.base import ApiRequest, BaseApi
+from app.services.api.cache import HttpCache, freshness
+from app.services.api.client import HttpClients
+from app.services.api.codec import JsonArrayParser, default_codec
+from app.services.api.exceptions import CircuitOpenError, HTTPException
+from app.services.api.ratelimit import TokenBucket, host_bucket
+from app.services.api.resilience import (
+    BreakerPolicy,
+    CircuitBreaker,
+    CircuitState,
+    HedgePolicy,
+    RetryPolicy,
+    host_breaker,
+    host_latencies,
+)
+
+
+class MockClients(HttpClients):
+    """HttpClients answering through `handler` instead of the network"""
+
+    def __init__(self, handler) -> None:
+        super().__init__(HttpClientSettings())
+        self._handler = handler
+        self.created = 0
+
+    def _create(self) -> httpx.AsyncClient:
+        self.created += 1
+        return httpx.AsyncClient(transport=httpx.MockTransport(self._handler))
+
+
+class Api(BaseApi):
+    RETRY = None
+    CIRCUIT_BREAKER = None
+
+
+class TestHttpClients(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.clients = HttpClients(HttpClientSettings(max_connections=7, timeout=3))
+        self.addAsyncCleanup(self.clients.aclose)
+
+    async def test_one_client_per_base_url(self):
+        client = self.clients.get("https://a.example")
+        self.assertIs(self.clients.get("https://a.example"), client)
+        self.assertIsNot(self.clients.get("https://b.example"), client)
+        self.assertEqual(client.timeout.read, 3)
+
+    async def test_closed_client_is_replaced(self):
+        client = self.clients.get("https://a.example")
+        await self.clients.aclose()
+        self.assertTrue(client.is_closed)
+        self.assertFalse(self.clients.get("https://a.example").is_closed)
+
+    async def test_requests_share_the_client(self):
+        clients = MockClients(lambda request: httpx.Response(200, json={"path": request.url.path}))
+        self.addAsyncCleanup(clients.aclose)
+        api = Api("https://a.example", clients)
+        self.assertEqual(await api._request("/one"), {"path": "/one"})
+        self.assertEqual(await api._request("/two"), {"path": "/two"})
+        self.assertEqual(clients.created, 1)
+
+
+class TestRequestMany(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        async def handler(request):
+            status = int(request.url.path.strip("/"))
+            # The first requests answer the last
+            await asyncio.sleep(0.01 * (3 - status // 100))
+            return httpx.Response(status, json={"status": status})
+
+        self.clients = MockClients(handler)
+        self.addAsyncCleanup(self.clients.aclose)
+        self.api = Api("https://a.example", self.clients)
+
+    async def test_status_of_each_request(self):
+        result = await self.api.request_many(
+            [ApiRequest(f"/{status}") for status in (200, 201, 404)], concurrency=3
+        )
+        self.assertEqual(result.statuses, [200, 201, 404])
+        self.assertEqual(result.results, [{"status": 200}, {"status": 201}, None])
+        self.assertEqual(result.errors[2].status_code, 404)
+        self.assertEqual(self.api.status_code, -1)
+
+    async def test_concurrent_requests_get_their_own_status(self):
+        results = await asyncio.gather(
+            self.api._request_with_status("/200"), self.api._request_with_status("/201")
+        )
+        self.assertEqual([status for status, _ in results], [200, 201])
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def test_only_idempotent_methods_are_retried(self):
+        policy = RetryPolicy()
+        self.assertTrue(policy.retryable("get"))
+        self.assertTrue(policy.retryable("PUT", 503))
+        self.assertFalse(policy.retryable("POST"))
+        self.assertFalse(policy.retryable("GET", 500))
+
+    def test_delay_is_capped(self):
+        policy = RetryPolicy(backoff=1, max_backoff=3)
+        for attempt in range(10):
+            self.assertTrue(0 <= policy.delay(attempt) <= min(3, 2**attempt))
+
+    def test_retry_after_is_respected_up_to_the_cap(self):
+        policy = RetryPolicy(backoff=0.01, max_backoff=3)
+        self.assertGreaterEqual(policy.delay(0, retry_after=2), 2)
+        self.assertLessEqual(policy.delay(0, retry_after=60), 3)
+
+
+@pytest.mark.usefixtures("fake_clock")
+class TestCircuitBreaker(unittest.TestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker(
+            "a.example", BreakerPolicy(failure_threshold=2, reset_timeout=10), clock=self.clock
+        )
+
+    def open(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+
+    def test_opens_after_failures_in_a_row(self):
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitState.OPEN)
+        self.assertFalse(self.breaker.allow())
+
+    def test_one_probe_after_reset_timeout(self):
+        self.open()
+        self.clock.advance(10)
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, CircuitState.HALF_OPEN)
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, CircuitState.CLOSED)
+
+    def test_failed_probe_opens_again(self):
+        self.open()
+        self.clock.advance(10)
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitState.OPEN)
+        self.assertFalse(self.breaker.allow())
+
+    def test_only_the_probe_can_abandon_it(self):
+        self.open()
+        self.clock.advance(10)
+        probe, other = object(), object()
+        self.assertTrue(self.breaker.allow(probe))
+        self.breaker.abandon(other)
+        self.assertFalse(self.breaker.allow(other))
+        self.breaker.abandon(probe)
+        self.assertTrue(self.breaker.allow(other))
+
+
+class TestRegistries(unittest.TestCase):
+    def test_policies_are_not_shared(self):
+        strict, lenient = BreakerPolicy(failure_threshold=1), BreakerPolicy(failure_threshold=9)
+        self.assertIs(host_breaker("r.example", strict), host_breaker("r.example", strict))
+        self.assertIsNot(host_breaker("r.example", strict), host_breaker("r.example", lenient))
+        self.assertIsNot(host_bucket("r.example", 10), host_bucket("r.example", 100))
+        self.assertIsNot(host_latencies("r.example", 10), host_latencies("r.example", 100))
+
+
+class TestJsonArrayParser(unittest.TestCase):
+    DOCUMENT = (
+        '[2.5, 1e3, -17, "a,b]", "quote \\" and \\\\", "\\u00e9 é",'
+        ' {"id": 1, "tags": ["x", {"y": "}"}]}, [], null, true]'
+    ).encode()
+
+    def parse(self, *chunks, loads=json.loads):
+        parser = JsonArrayParser(loads)
+        items = [item for chunk in chunks for item in parser.feed(chunk)]
+        return items + parser.close()
+
+    def test_every_split(self):
+        expected = json.loads(self.DOCUMENT)
+        for index in range(len(self.DOCUMENT) + 1):
+            with self.subTest(split=index):
+                self.assertEqual(self.parse(self.DOCUMENT[:index], self.DOCUMENT[index:]), expected)
+
+    def test_byte_by_byte(self):
+        chunks = [self.DOCUMENT[index : index + 1] for index in range(len(self.DOCUMENT))]
+        self.assertEqual(self.parse(*chunks), json.loads(self.DOCUMENT))
+        self.assertEqual(
+            self.parse(*chunks, loads=default_codec().loads), json.loads(self.DOCUMENT)
+        )
+
+    def test_number_is_emitted_after_the_separator(self):
+        parser = JsonArrayParser()
+        self.assertEqual(parser.feed(b"[2."), [])
+        self.assertEqual(parser.feed(b"5"), [])
+        self.assertEqual(parser.feed(b"]"), [2.5])
+        self.assertTrue(parser.finished)
+
+    def test_empty_array(self):
+        self.assertEqual(self.parse(b" [ ", b" ] "), [])
+
+    def test_invalid_arrays(self):
+        for document in (b"[1 2 3]", b"[1,,2]", b"[1,]", b"[,1]", b"{}", b"[1] 2", b"[1, 2"):
+            with self.subTest(document=document):
+                with self.assertRaises(json.JSONDecodeError):
+                    self.parse(document)
+
+    def test_long_item_is_scanned_once(self):
+        parser = JsonArrayParser()
+        parser.feed(b'["')
+        for _ in range(100):
+            parser.feed(b"x" * 100)
+            self.assertEqual(parser._position, len(parser._buffer))
+        self.assertEqual(parser.feed(b'"]'), ["x" * 10_000])
+
+
+class TestStream(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.handler = None
+        self.clients = MockClients(lambda request: self.handler(request))
+        self.addAsyncCleanup(self.clients.aclose)
+
+    def api(self):
+        # One host per test, the breakers of the hosts are global
+        api = Api(f"https://{self._testMethodName.replace('_', '-')}.example", self.clients)
+        api.CIRCUIT_BREAKER = BreakerPolicy(failure_threshold=1, reset_timeout=0)
+        return api
+
+    def half_open(self, api):
+        breaker = host_breaker(httpx.URL(api.URL).host, api.CIRCUIT_BREAKER)
+        breaker.record_failure()
+        return breaker
+
+    async def test_items(self):
+        self.handler = lambda request: httpx.Response(200, content=b'[{"id": 1}, {"id": 2}]')
+        items = [item async for item in self.api().stream_items("/items")]
+        self.assertEqual(items, [{"id": 1}, {"id": 2}])
+
+    async def test_network_error_of_the_probe_opens_the_circuit(self):
+        def handler(request):
+            raise httpx.ConnectError("refused", request=request)
+
+        self.handler = handler
+        api = self.api()
+        breaker = self.half_open(api)
+        with self.assertRaises(httpx.ConnectError):
+            async for _ in api.stream("/items"):
+                pass
+        self.assertEqual(breaker.state, CircuitState.OPEN)
+        # reset_timeout=0: the next request is the probe again
+        self.assertTrue(breaker.allow())
+
+    async def test_cancelled_probe_is_given_back(self):
+        async def handler(request):
+            await asyncio.sleep(60)
+
+        self.handler = handler
+        api = self.api()
+        breaker = self.half_open(api)
+
+        async def consume():
+            async for _ in api.stream("/items"):
+                pass
+
+        task = asyncio.create_task(consume())
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        self.assertEqual(breaker.state, CircuitState.HALF_OPEN)
+        self.assertTrue(breaker.allow())
+
+
+class TestRateLimit(unittest.IsolatedAsyncioTestCase):
+    RATE = 20
+
+    async def asyncSetUp(self):
+        self.times = []
+
+        def handler(request):
+            self.times.append(time.monotonic())
+            return httpx.Response(200, content=b'{"ok": true}')
+
+        self.clients = MockClients(handler)
+        self.addAsyncCleanup(self.clients.aclose)
+        # One host per test, the buckets of the hosts are global
+        self.api = Api(f"https://{self._testMethodName.replace('_', '-')}.example", self.clients)
+        self.api.RATE_LIMIT = self.RATE
+        self.api.RATE_BURST = 1
+
+    def assertSpan(self, times, intervals):
+        # A little slack for the timer resolution of the event loop
+        self.assertGreaterEqual(max(times) - min(times), 0.9 * intervals / self.RATE)
+
+    async def test_concurrent_acquires_follow_the_rate(self):
+        bucket = TokenBucket(rate=self.RATE, capacity=2)
+        times = []
+
+        async def acquire():
+            await bucket.acquire()
+            times.append(time.monotonic())
+
+        await asyncio.gather(*(acquire() for _ in range(6)))
+        gaps = [later - earlier for earlier, later in itertools.pairwise(times)]
+        # The burst of two at once, then one per 1 / rate seconds
+        self.assertLess(gaps[0], 0.5 / self.RATE)
+        self.assertTrue(all(gap >= 0.9 / self.RATE for gap in gaps[1:]), gaps)
+        self.assertLess(times[-1] - times[0], 6 / self.RATE)
+
+    async def test_requests_follow_the_rate_limit_of_the_host(self):
+        other = Api(self.api.URL, self.clients)
+        other.RATE_LIMIT, other.RATE_BURST = self.RATE, 1
+        await asyncio.gather(*(api._request("/items") for api in [self.api, other] * 2))
+        # The instances share the bucket of the host
+        self.assertEqual(len(self.times), 4)
+        self.assertSpan(self.times, 3)
+
+    async def test_streams_follow_the_rate_limit(self):
+        async def consume():
+            return b"".join([chunk async for chunk in self.api.stream("/items")])
+
+        results = await asyncio.gather(*(consume() for _ in range(3)))
+        self.assertEqual(results, [b'{"ok": true}'] * 3)
+        self.assertSpan(self.times, 2)
+
+
+class TestRetries(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.responses = []
+        self.methods = []
+
+        def handler(request):
+            self.methods.append(request.method)
+            response = self.responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        self.clients = MockClients(handler)
+        self.addAsyncCleanup(self.clients.aclose)
+
+    def api(self):
+        # One host per test, the breakers of the hosts are global
+        api = Api(f"https://{self._testMethodName.replace('_', '-')}.example", self.clients)
+        api.RETRY = RetryPolicy(attempts=3, backoff=0.001, max_backoff=1)
+        return api
+
+    async def test_unavailable_is_retried(self):
+        self.responses = [httpx.Response(503), httpx.Response(200, json={"ok": True})]
+        self.assertEqual(await self.api()._request("/items"), {"ok": True})
+        self.assertEqual(self.methods, ["GET", "GET"])
+
+    async def test_network_errors_are_retried_up_to_the_attempts(self):
+        self.responses = [httpx.ConnectError("refused") for _ in range(3)]
+        with self.assertRaises(httpx.ConnectError):
+            await self.api()._request("/items")
+        self.assertEqual(len(self.methods), 3)
+
+    async def test_retry_after_is_waited(self):
+        self.responses = [
+            httpx.Response(429, headers={"Retry-After": "0.1"}),
+            httpx.Response(200, json={}),
+        ]
+        started = time.perf_counter()
+        await self.api()._request("/items")
+        self.assertGreaterEqual(time.perf_counter() - started, 0.1)
+
+    async def test_post_is_not_retried(self):
+        self.responses = [httpx.Response(503)]
+        with self.assertRaises(HTTPException) as error:
+            await self.api()._request("/items", method="POST")
+        self.assertEqual(error.exception.status_code, 503)
+        self.assertEqual(self.methods, ["POST"])
+
+    async def test_open_circuit_stops_the_retries(self):
+        api = self.api()
+        api.CIRCUIT_BREAKER = BreakerPolicy(failure_threshold=1, reset_timeout=60)
+        self.responses = [httpx.Response(503), httpx.Response(200, json={})]
+        with self.assertRaises(CircuitOpenError):
+            await api._request("/items")
+        self.assertEqual(len(self.methods), 1)
+
+
+class TestHedging(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.handler = None
+        self.clients = MockClients(lambda request: self.handler(request))
+        self.addAsyncCleanup(self.clients.aclose)
+
+    def api(self, name=""):
+        # One host per test, the breakers and latencies of the hosts are global
+        host = f"{self._testMethodName}{name}".replace("_", "-")
+        api = Api(f"https://{host}.example", self.clients)
+        api.CIRCUIT_BREAKER = BreakerPolicy(failure_threshold=1, reset_timeout=0)
+        api.HEDGE = HedgePolicy(delay=0.02)
+        return api
+
+    @staticmethod
+    def attempts():
+        return [
+            task
+            for task in asyncio.all_tasks()
+            if getattr(task.get_coro(), "__qualname__", "") == "BaseApi._send"
+        ]
+
+    async def test_fast_response_is_not_hedged(self):
+        calls = []
+
+        def handler(request):
+            calls.append(request)
+            return httpx.Response(200, json={"ok": True})
+
+        self.handler = handler
+        self.assertEqual(await self.api()._request("/items"), {"ok": True})
+        self.assertEqual(len(calls), 1)
+
+    async def test_second_attempt_wins_and_the_first_is_cancelled(self):
+        calls = []
+
+        async def handler(request):
+            calls.append(len(calls) + 1)
+            attempt = calls[-1]
+            try:
+                if attempt == 1:
+                    await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                calls.append("cancelled")
+                raise
+            return httpx.Response(200, json={"attempt": attempt})
+
+        self.handler = handler
+        started = time.perf_counter()
+        self.assertEqual(await self.api()._request("/items"), {"attempt": 2})
+        self.assertLess(time.perf_counter() - started, 0.5)
+        self.assertEqual(calls, [1, 2, "cancelled"])
+        self.assertEqual(self.attempts(), [])
+
+    async def test_probe_is_not_hedged_around_the_breaker(self):
+        calls = []
+
+        async def handler(request):
+            calls.append(request)
+            await asyncio.sleep(0.05)
+            return httpx.Response(200, json={"ok": True})
+
+        self.handler = handler
+        api = self.api()
+        breaker = host_breaker(httpx.URL(api.URL).host, api.CIRCUIT_BREAKER)
+        breaker.record_failure()
+        # The second attempt is rejected by the half-open breaker, the probe answers
+        self.assertEqual(await api._request("/items"), {"ok": True})
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(breaker.state, CircuitState.CLOSED)
+
+    async def test_cancelled_caller_cancels_the_attempts(self):
+        async def handler(request):
+            await asyncio.sleep(60)
+
+        self.handler = handler
+        # Before and after the second attempt is fired
+        for wait in (0.01, 0.05):
+            with self.subTest(wait=wait):
+                api = self.api(str(wait))
+                breaker = host_breaker(httpx.URL(api.URL).host, api.CIRCUIT_BREAKER)
+                breaker.record_failure()
+                task = asyncio.create_task(api._request("/hang"))
+                await asyncio.sleep(wait)
+                task.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await task
+                self.assertEqual(self.attempts(), [])
+                # The first attempt was the probe of the half-open breaker, it is given back
+                self.assertTrue(breaker.allow())
+
+
+class TestHttpCache(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.cache = HttpCache()
+        self.responses = []
+        self.sent = []
+
+    async def send(self, headers):
+        self.sent.append(headers)
+        return self.responses.pop(0)
+
+    async def get(self, params=None, **headers):
+        key = HttpCache.key("https://a.example/items", params, headers)
+        return await self.cache.get(key, "a.example", headers, self.send)
+
+    def test_freshness(self):
+        self.assertEqual(freshness(httpx.Headers({"cache-control": "max-age=60"})), 60)
+        self.assertEqual(freshness(httpx.Headers({"cache-control": "max-age=60", "age": "50"})), 10)
+        self.assertEqual(freshness(httpx.Headers({"cache-control": "max-age=60", "age": "90"})), 0)
+        self.assertEqual(freshness(httpx.Headers({"cache-control": "no-cache"})), 0)
+        self.assertIsNone(freshness(httpx.Headers({"cache-control": "private, no-store"})))
+        self.assertEqual(freshness(httpx.Headers({}), default_ttl=5), 5)
+        expires = {
+            "date": "Mon, 01 Jan 2024 00:00:00 GMT",
+            "expires": "Mon, 01 Jan 2024 00:01:00 GMT",
+        }
+        self.assertEqual(freshness(httpx.Headers(expires)), 60)
+
+    def test_key_of_params(self):
+        key = HttpCache.key
+        self.assertEqual(key("/a", [("b", 2), ("a", "1")], {}), key("/a", {"a": 1, "b": "2"}, {}))
+        self.assertEqual(key("/a", None, {}), key("/a", {}, {}))
+        self.assertNotEqual(key("/a", [("a", 1), ("a", 2)], {}), key("/a", {"a": 1}, {}))
+        self.assertNotEqual(key("/a", None, {"Accept": "text/csv"}), key("/a", None, {}))
+
+    async def test_fresh_response_is_reused(self):
+        self.responses = [
+            httpx.Response(200, headers={"cache-control": "max-age=60"}, content=b"1")
+        ]
+        self.assertEqual((await self.get()).content, b"1")
+        self.assertEqual((await self.get()).content, b"1")
+        self.assertEqual(len(self.sent), 1)
+
+    async def test_stale_response_is_revalidated(self):
+        self.responses = [
+            httpx.Response(
+                200, headers={"cache-control": "max-age=60", "age": "60", "etag": '"v1"'}
+            ),
+            httpx.Response(304, headers={"cache-control": "max-age=60"}),
+        ]
+        await self.get()
+        self.assertEqual((await self.get()).status_code, 200)
+        self.assertEqual(self.sent[1]["If-None-Match"], '"v1"')
+        await self.get()
+        self.assertEqual(len(self.sent), 2)
+
+    async def test_vary(self):
+        headers = {"cache-control": "max-age=60", "vary": "X-Tenant"}
+        self.responses = [
+            httpx.Response(200, headers=headers, content=b"a"),
+            httpx.Response(200, headers=headers, content=b"b"),
+        ]
+        self.assertEqual((await self.get(**{"X-Tenant": "a"})).content, b"a")
+        self.assertEqual((await self.get(**{"X-Tenant": "b"})).content, b"b")
+        self.assertNotIn("If-None-Match", self.sent[1])
+        self.assertEqual((await self.get(**{"x-tenant": "b"})).content, b"b")
+        self.assertEqual(len(self.sent), 2)
+
+    async def test_vary_star_is_not_stored(self):
+        self.responses = [
+            httpx.Response(200, headers={"cache-control": "max-age=60", "vary": "*"}),
+            httpx.Response(200),
+        ]
+        await self.get()
+        await self.get()
+        self.assertEqual(len(self.sent), 2)
+
+    async def test_unrevalidatable_response_drops_the_stale_entry(self):
+        self.responses = [
+            httpx.Response(200, headers={"cache-control": "no-cache", "etag": '"v1"'}),
+            httpx.Response(200, headers={"cache-control": "no-cache"}),
+            httpx.Response(200),
+        ]
+        await self.get()
+        await self.get()
+        await self.get()
+        self.assertEqual(self.sent[1]["If-None-Match"], '"v1"')
+        self.assertNotIn("If-None-Match", self.sent[2])
@@ -0,0 +1,106 @@
+import asyncio
+import unittest
+
+import pytest
+
+from app.core.cache import SingleFlight, TTLCache
+
+
+@pytest.mark.usefixtures("fake_clock")
+class TestTTLCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = TTLCache(max_entries=2, ttl=10, clock=self.clock)
+
+    def test_expired_entry_is_miss(self):
+        self.cache.set("key", "value")
+        self.assertEqual(self.cache.get("key"), "value")
+        self.clock.now = 10
+        self.assertIsNone(self.cache.get("key"))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_least_recently_used_is_evicted(self):
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.cache.get("a")
+        self.cache.set("c", 3)
+        self.assertIn("a", self.cache)
+        self.assertNotIn("b", self.cache)
+        self.assertEqual(self.cache.evictions, 1)
+
+    def test_memory_cap(self):
+        cache = TTLCache(max_entries=100, max_bytes=1000, ttl=10, clock=self.clock)
+        for i in range(10):
+            cache.set(i, "x" * 200)
+        self.assertLessEqual(cache.bytes, 1000)
+        self.assertIn(9, cache)
+        self.assertNotIn(0, cache)
+
+
+class TestSingleFlight(unittest.IsolatedAsyncioTestCase):
+    async def test_concurrent_calls_are_coalesced(self):
+        flight = SingleFlight()
+        calls = 0
+
+        async def load():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return "value"
+
+        results = await asyncio.gather(*(flight.do("key", load) for _ in range(5)))
+        self.assertEqual(results, [("value", False)] + [("value", True)] * 4)
+        self.assertEqual(calls, 1)
+        self.assertEqual(flight.coalesced, 4)
+
+    async def test_cancelled_caller_does_not_cancel_the_others(self):
+        flight = SingleFlight()
+        calls = []
+
+        async def load(caller):
+            calls.append(caller)
+            await asyncio.sleep(0.05)
+            return caller
+
+        first = asyncio.create_task(flight.do("key", lambda: load("first")))
+        await asyncio.sleep(0)
+        others = [
+            asyncio.create_task(flight.do("key", lambda i=i: load(f"other{i}"))) for i in range(3)
+        ]
+        await asyncio.sleep(0.01)
+        first.cancel()
+        results = await asyncio.gather(*others)
+        self.assertTrue(first.cancelled())
+        # One of the waiting callers took the call over, the others shared its result
+        self.assertEqual(calls, ["first", "other0"])
+        self.assertEqual(results, [("other0", False), ("other0", True), ("other0", True)])
+
+    async def test_cancelled_waiter_leaves_the_call_running(self):
+        flight = SingleFlight()
+
+        async def load():
+            await asyncio.sleep(0.02)
+            return "value"
+
+        first = asyncio.create_task(flight.do("key", load))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(flight.do("key", load))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        self.assertEqual(await first, ("value", False))
+        self.assertTrue(waiter.cancelled())
+
+    async def test_error_is_shared(self):
+        flight = SingleFlight()
+
+        async def load():
+            await asyncio.sleep(0.01)
+            raise ValueError("boom")
+
+        results = await asyncio.gather(
+            *(flight.do("key", load) for _ in range(3)), return_exceptions=True
+        )
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,200 @@
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+from app.services.demon import Daemon, PoolJob, Supervisor
+from app.services.scheduler import Every, Job
+
+
+class AppendPidJob(Job):
+    """Appends the pid of the worker to the file, takes `duration` seconds"""
+
+    def __init__(self, path, duration=0.0):
+        self.path = path
+        self.duration = duration
+
+    async def run(self):
+        with open(self.path, "a") as f:
+            f.write(f"start {os.getpid()}\n")
+        await asyncio.sleep(self.duration)
+        with open(self.path, "a") as f:
+            f.write(f"end {os.getpid()}\n")
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+class TestSupervisor(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.paths = [Path(self.directory.name) / f"job{i}.log" for i in range(2)]
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def start(self, duration=0.0, durations=None, **options):
+        durations = durations or [duration] * len(self.paths)
+        jobs = [
+            PoolJob(AppendPidJob(path, duration), Every(0.05))
+            for path, duration in zip(self.paths, durations, strict=True)
+        ]
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                code = Supervisor(jobs, workers=2, **options).run()
+            finally:
+                os._exit(code)
+        self.addCleanup(self.stop, pid)
+        return pid
+
+    def stop(self, master):
+        # The master is still running when an assertion has failed
+        try:
+            os.kill(master, signal.SIGTERM)
+            os.waitpid(master, 0)
+        except (ProcessLookupError, ChildProcessError):
+            pass
+
+    def lines(self, index):
+        path = self.paths[index]
+        return path.read_text().split("\n")[:-1] if path.exists() else []
+
+    def pids(self, index):
+        return {line.split()[1] for line in self.lines(index)}
+
+    def test_jobs_are_spread_over_workers(self):
+        master = self.start()
+        self.assertTrue(wait_for(lambda: self.lines(0) and self.lines(1)))
+        os.kill(master, signal.SIGTERM)
+        _, status = os.waitpid(master, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+        self.assertEqual(len(self.pids(0) | self.pids(1)), 2)
+        self.assertNotIn(str(master), self.pids(0))
+
+    def test_crashed_worker_is_restarted(self):
+        master = self.start(backoff=0.05)
+        self.assertTrue(wait_for(lambda: self.lines(0)))
+        (worker,) = self.pids(0)
+        os.kill(int(worker), signal.SIGKILL)
+        self.assertTrue(wait_for(lambda: len(self.pids(0)) == 2))
+        os.kill(master, signal.SIGTERM)
+        os.waitpid(master, 0)
+
+    def test_drain_and_rolling_restart_finish_the_running_jobs(self):
+        master = self.start(duration=0.2)
+        self.assertTrue(wait_for(lambda: self.lines(0)))
+        os.kill(master, signal.SIGHUP)
+        self.assertTrue(wait_for(lambda: len(self.pids(0)) == 2 and len(self.pids(1)) == 2))
+        os.kill(master, signal.SIGTERM)
+        os.waitpid(master, 0)
+        for index in range(2):
+            lines = self.lines(index)
+            self.assertEqual(
+                sum(line.startswith("start") for line in lines),
+                sum(line.startswith("end") for line in lines),
+            )
+
+    def test_worker_crashed_during_a_rolling_restart_is_restarted(self):
+        master = self.start(durations=[0.0, 1.0], backoff=0.05)
+        self.assertTrue(wait_for(lambda: self.lines(0) and self.lines(1)))
+        (first,) = self.pids(0)
+        os.kill(master, signal.SIGHUP)
+        # The first worker is restarted, the second one is still draining its long job
+        self.assertTrue(wait_for(lambda: len(self.pids(0)) == 2))
+        (restarted,) = self.pids(0) - {first}
+        os.kill(int(restarted), signal.SIGKILL)
+        self.assertTrue(wait_for(lambda: len(self.pids(0)) == 3))
+        os.kill(master, signal.SIGTERM)
+        os.waitpid(master, 0)
+
+
+DAEMON_SCRIPT = """
+import asyncio
+import os
+import sys
+
+from app.services.demon import Daemon
+from app.services.scheduler import Every, Job, Scheduler
+
+log, pid_dir = sys.argv[1:]
+
+
+class SlowJob(Job):
+    async def run(self):
+        with open(log, "a") as f:
+            f.write(f"start {os.getpid()}\\n")
+        await asyncio.sleep(0.3)
+        with open(log, "a") as f:
+            f.write(f"end {os.getpid()}\\n")
+
+
+with open(log, "a") as f:
+    f.write(f"boot {os.getpid()}\\n")
+daemon = Daemon("test", pid_dir=pid_dir, drain_timeout=5)
+scheduler = Scheduler()
+scheduler.add(SlowJob(), Every(0.1))
+daemon.start(daemon.run_scheduler, scheduler)
+"""
+
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = Path(self.directory.name)
+        self.log = self.path / "jobs.log"
+        self.daemon = Daemon("test", pid_dir=self.directory.name, drain_timeout=5)
+        script = self.path / "daemon.py"
+        script.write_text(DAEMON_SCRIPT)
+        env = {**os.environ, "PYTHONPATH": os.getcwd()}
+        # Returns when the daemon is detached, the daemon chdirs to /
+        subprocess.run([sys.executable, str(script), str(self.log), str(self.path)], env=env)
+        self.assertTrue(wait_for(lambda: Path(self.daemon.pidfile).exists()))
+        self.pid = int(Path(self.daemon.pidfile).read_text())
+
+    def tearDown(self):
+        if os.path.exists(self.daemon.pidfile):
+            self.daemon.stop()
+        self.directory.cleanup()
+
+    def lines(self, kind):
+        lines = self.log.read_text().split("\n")[:-1] if self.log.exists() else []
+        return [line for line in lines if line.startswith(kind)]
+
+    def assertNoJobIsCut(self):
+        self.assertEqual(len(self.lines("start")), len(self.lines("end")))
+
+    def test_stop_drains_the_running_job(self):
+        self.assertTrue(wait_for(lambda: len(self.lines("start")) > len(self.lines("end"))))
+        self.daemon.stop()
+        self.assertFalse(os.path.exists(f"/proc/{self.pid}"))
+        self.assertFalse(os.path.exists(self.daemon.pidfile))
+        self.assertNoJobIsCut()
+
+    def test_reload_keeps_the_pid_and_the_pidfile(self):
+        self.assertTrue(wait_for(lambda: len(self.lines("start")) > len(self.lines("end"))))
+        self.daemon.reload()
+        # The first boot is the one of the launcher, the daemon boots again after the reload
+        self.assertTrue(wait_for(lambda: len(self.lines(f"boot {self.pid}")) == 1))
+        self.assertEqual(int(Path(self.daemon.pidfile).read_text()), self.pid)
+
+        started = len(self.lines("start"))
+        self.assertTrue(wait_for(lambda: len(self.lines("end")) > started))
+        self.daemon.stop()
+        self.assertNoJobIsCut()
+
+
+if __name__ == "__main__":
+    unittest.main()
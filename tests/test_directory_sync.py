@@ -0,0 +1,136 @@
+import unittest
+from contextlib import contextmanager
+from datetime import UTC, datetime, timedelta
+
+from app.services.directory_sync import (
+    MARK_DELETED_SQL,
+    SAVE_STATE_SQL,
+    STATE_SQL,
+    DirectorySyncJob,
+    Watermark,
+)
+
+NOW = datetime(2024, 1, 1, tzinfo=UTC)
+
+
+def entry(guid, name, usn=1):
+    attributes = {"sAMAccountName": [name], "uSNChanged": usn, "distinguishedName": []}
+    if guid:
+        attributes["objectGUID"] = guid
+    return {"type": "searchResEntry", "dn": f"CN={name},DC=katren,DC=net", "attributes": attributes}
+
+
+class FakeSearch:
+    def __init__(self, pages, dc="CN=NTDS Settings,CN=DC1", usn=100):
+        self.pages_ = pages
+        self.root = {"dsServiceName": dc, "highestCommittedUSN": [str(usn)]}
+        self.filters = []
+
+    @contextmanager
+    def pinned(self):
+        yield self
+
+    def root_dse(self):
+        return self.root
+
+    def pages(self, search_filter, attributes=None, page_size=None):
+        self.filters.append(search_filter)
+        yield from self.pages_
+
+
+class FakeCursor:
+    def __init__(self, rows):
+        self.description = []
+        self.rows = rows
+
+    async def fetchall(self):
+        return self.rows
+
+
+class FakeConnection:
+    def __init__(self, engine):
+        self.engine = engine
+
+    async def commit(self):
+        self.engine.events.append("commit")
+        if self.engine.commit_error:
+            raise self.engine.commit_error
+
+
+class FakeEngine:
+    def __init__(self, state=None, commit_error=None):
+        self.state = state or []
+        self.commit_error = commit_error
+        self.events = []
+        self.copied = []
+
+    async def get_connection(self):
+        return FakeConnection(self)
+
+    async def release(self, connection):
+        self.events.append("release")
+
+    async def cursor(self, connection, sql, *args, row_factory=None):
+        return FakeCursor(self.state if sql == STATE_SQL else [])
+
+    async def execute(self, connection, sql, *args):
+        self.events.append((sql, args))
+
+    async def copy_in(self, connection, table, rows, columns=None, binary=False, types=None):
+        rows = list(rows)
+        self.copied.append(rows)
+        return len(rows)
+
+
+class TestDirectorySyncJob(unittest.IsolatedAsyncioTestCase):
+    def job(self, search, engine, **kwargs):
+        return DirectorySyncJob(search, engine, full_resync_interval=3600, **kwargs)
+
+    def test_to_row(self):
+        row = DirectorySyncJob.to_row(entry("guid-1", "alice", usn=7), NOW)
+        self.assertEqual(row[:2], ("guid-1", "alice"))
+        # An empty distinguishedName falls back to the dn of the entry
+        self.assertEqual(row[4], "CN=alice,DC=katren,DC=net")
+        self.assertEqual(row[7:], (7, NOW))
+
+    def test_entry_without_guid_is_rejected(self):
+        with self.assertRaises(ValueError):
+            DirectorySyncJob.to_row(entry(None, "ghost"), NOW)
+
+    def test_full_resync_due(self):
+        job = self.job(FakeSearch([]), FakeEngine())
+        watermark = Watermark("DC1", 10, NOW)
+        self.assertTrue(job._full_resync_due(None, "DC1", NOW))
+        self.assertTrue(job._full_resync_due(watermark, "DC2", NOW))
+        self.assertFalse(job._full_resync_due(watermark, "DC1", NOW + timedelta(minutes=59)))
+        self.assertTrue(job._full_resync_due(watermark, "DC1", NOW + timedelta(hours=1)))
+
+    async def test_full_sync_upserts_page_by_page(self):
+        search = FakeSearch([[entry("1", "a"), entry("2", "b")], [], [entry(None, "c")]])
+        engine = FakeEngine()
+        result = await self.job(search, engine).sync()
+        self.assertTrue(result.full)
+        self.assertEqual(result.entries, 2)
+        self.assertEqual(result.watermark.usn, 100)
+        # The empty page is skipped, the entry without objectGUID is dropped
+        self.assertEqual([len(rows) for rows in engine.copied], [2, 0])
+        executed = [event[0] for event in engine.events if isinstance(event, tuple)]
+        self.assertIn(MARK_DELETED_SQL, executed)
+        self.assertEqual(executed[-1], SAVE_STATE_SQL)
+        # The state is committed by the job, the commit on exit has nothing left to do
+        self.assertEqual(engine.events[-3:], ["commit", "commit", "release"])
+
+    async def test_incremental_sync_starts_above_the_watermark(self):
+        state = [{"dc": "CN=NTDS Settings,CN=DC1", "usn": 41, "full_sync_at": datetime.now(UTC)}]
+        search = FakeSearch([[entry("1", "a")]])
+        engine = FakeEngine(state)
+        result = await self.job(search, engine).sync()
+        self.assertFalse(result.full)
+        self.assertIn("(uSNChanged>=42)", search.filters[0])
+        executed = [event[0] for event in engine.events if isinstance(event, tuple)]
+        self.assertNotIn(MARK_DELETED_SQL, executed)
+
+    async def test_failed_commit_fails_the_run(self):
+        engine = FakeEngine(commit_error=RuntimeError("could not serialize access"))
+        with self.assertRaises(RuntimeError):
+            await self.job(FakeSearch([[entry("1", "a")]]), engine).sync()
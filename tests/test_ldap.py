@@ -0,0 +1,263 @@
+import asyncio
+import io
+import json
+import re
+import threading
+import time
+import unittest
+from functools import partial
+from types import SimpleNamespace
+
+import pytest
+
+from app.drivers.ldap import LdapException, LdapPool
+from app.services.ldap import (
+    ALL_USERS_FILTER,
+    PAGED_RESULTS_CONTROL,
+    AsyncLdapSearch,
+    LdapSearch,
+    _batches,
+    _email_filter,
+    _user_filter,
+)
+
+
+class FakeConnection:
+    """ldap3 Connection answering the sAMAccountName, mail and paged searches"""
+
+    def __init__(self, users=100, latency=0.0):
+        self.latency = latency
+        self.closed = False
+        self.bound = True
+        self.searches = []
+        self.threads = set()
+        self.users = [
+            {
+                "type": "searchResEntry",
+                "dn": f"CN=User {i},DC=katren,DC=net",
+                "attributes": {"sAMAccountName": f"user{i}", "mail": f"user{i}@katren.net"},
+            }
+            for i in range(users)
+        ]
+
+    def search(self, search_base, search_filter, attributes=None, paged_size=None, **kwargs):
+        time.sleep(self.latency)
+        self.searches.append(search_filter)
+        self.threads.add(threading.get_ident())
+        names = re.findall(r"sAMAccountName=([^)]+)", search_filter)
+        names += [mail.split("@")[0] for mail in re.findall(r"\(mail=([^)]+)", search_filter)]
+        if names:
+            response = [
+                user for user in self.users if user["attributes"]["sAMAccountName"] in names
+            ]
+        else:
+            response = list(self.users)
+        result = {"result": 0, "description": "success"}
+        if paged_size:
+            offset = int(kwargs.get("paged_cookie") or 0)
+            end = offset + paged_size
+            cookie = str(end).encode() if end < len(response) else b""
+            response = response[offset:end]
+            result["controls"] = {PAGED_RESULTS_CONTROL: {"value": {"cookie": cookie}}}
+        return bool(response), result, response, None
+
+    def unbind(self):
+        self.closed = True
+        self.bound = False
+
+
+class FakeLdap:
+    """Stands for app.drivers.ldap.LdapConnection"""
+
+    def __init__(self, **kwargs):
+        self.connection = FakeConnection(**kwargs)
+
+
+class TestAsyncLdapSearch(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.connections = []
+
+        def connect():
+            self.connections.append(FakeLdap(latency=0.05))
+            return self.connections[-1]
+
+        self.search = AsyncLdapSearch(connect, max_workers=4)
+        self.addCleanup(self.search.close)
+
+    async def test_lookups_run_in_parallel_threads(self):
+        started = time.perf_counter()
+        results = await asyncio.gather(*(self.search.user(f"user{i}") for i in range(4)))
+        self.assertLess(time.perf_counter() - started, 0.15)
+        self.assertEqual(
+            [response[0]["attributes"]["sAMAccountName"] for _, _, response in results],
+            ["user0", "user1", "user2", "user3"],
+        )
+        # One bound connection per worker thread
+        self.assertEqual(len(self.connections), 4)
+        for ldap in self.connections:
+            self.assertEqual(len(ldap.connection.threads), 1)
+
+    async def test_close_unbinds_the_connections(self):
+        await self.search.user("user1")
+        self.search.close()
+        self.assertTrue(all(ldap.connection.closed for ldap in self.connections))
+
+
+class FakePool(LdapPool):
+    def _open(self):
+        ldap = FakeLdap()
+        ldap.connection.unbind = partial(self._fake_unbind, ldap.connection)
+        self.opened.append(ldap)
+        self.sizes.append(self._size)
+        return ldap
+
+    def _fake_unbind(self, connection):
+        # The lock must not be held for the network round trip
+        self.unbound_under_lock |= self._condition._is_owned()
+        FakeConnection.unbind(connection)
+
+    def __init__(self, **kwargs):
+        self.opened = []
+        self.sizes = []
+        self.unbound_under_lock = False
+        settings = SimpleNamespace(host="dc1", port=636, username="KATREN\\user", password="")
+        super().__init__(settings, maintenance_interval=None, **kwargs)
+
+
+@pytest.mark.usefixtures("fake_clock")
+class TestLdapPool(unittest.TestCase):
+    def pool(self, **kwargs):
+        pool = FakePool(idle_timeout=300, probe_interval=30, clock=self.clock, **kwargs)
+        self.addCleanup(pool.close)
+        return pool
+
+    def test_oldest_idle_connection_is_evicted_on_release(self):
+        pool = self.pool(min_size=0)
+        first, second = pool.acquire(), pool.acquire()
+        pool.release(first)
+        self.clock.advance(200)
+        pool.release(second)
+        self.clock.advance(150)
+        self.assertIs(pool.acquire(), second)
+        self.assertTrue(first.connection.closed)
+        self.assertEqual(pool.stats(), {"size": 1, "idle": 0})
+        self.assertFalse(pool.unbound_under_lock)
+
+    def test_maintain_refills_to_min_size(self):
+        pool = self.pool(min_size=2)
+        self.assertEqual(pool.stats(), {"size": 2, "idle": 2})
+        self.clock.advance(301)
+        pool.maintain()
+        self.assertTrue(all(ldap.connection.closed for ldap in pool.opened[:2]))
+        self.assertEqual(len(pool.opened), 4)
+        self.assertEqual(pool.stats(), {"size": 2, "idle": 2})
+        self.assertFalse(pool.unbound_under_lock)
+
+    def test_lost_connection_is_rebound_in_its_slot(self):
+        pool = self.pool(min_size=1, max_size=1)
+        lost = pool.acquire()
+        pool.release(lost)
+        lost.connection.bound = False
+        self.clock.advance(31)
+        ldap = pool.acquire()
+        self.assertIsNot(ldap, lost)
+        self.assertTrue(lost.connection.closed)
+        # The new bind took the slot of the lost connection, never one more
+        self.assertEqual(pool.sizes, [1, 1])
+        self.assertEqual(pool.stats(), {"size": 1, "idle": 0})
+
+    def test_fresh_connection_is_not_probed(self):
+        pool = self.pool(min_size=1)
+        ldap = pool.acquire()
+        pool.release(ldap)
+        self.assertIs(pool.acquire(), ldap)
+        self.assertEqual(ldap.connection.searches, [])
+
+    def test_broken_connection_frees_the_slot(self):
+        pool = self.pool(min_size=0, max_size=1, timeout=0)
+        ldap = pool.acquire()
+        with self.assertRaises(LdapException):
+            pool.acquire()
+        pool.release(ldap, broken=True)
+        self.assertTrue(ldap.connection.closed)
+        self.assertIsNot(pool.acquire(), ldap)
+
+    def test_close(self):
+        pool = self.pool(min_size=2)
+        pool.close()
+        self.assertTrue(all(ldap.connection.closed for ldap in pool.opened))
+        with self.assertRaises(LdapException):
+            pool.acquire()
+
+
+class TestPagedSearch(unittest.TestCase):
+    def setUp(self):
+        self.ldap = FakeLdap(users=25)
+        self.search = LdapSearch(self.ldap, page_size=10)
+
+    def test_pages_follow_the_cookie(self):
+        pages = list(self.search.pages(ALL_USERS_FILTER))
+        self.assertEqual([len(page) for page in pages], [10, 10, 5])
+        self.assertEqual(len(self.ldap.connection.searches), 3)
+
+    def test_references_are_skipped(self):
+        self.ldap.connection.users.append({
+            "type": "searchResRef",
+            "uri": ["ldap://DomainDnsZones.katren.net/DC=katren,DC=net"],
+        })
+        entries = list(self.search.iter_users(page_size=100))
+        self.assertEqual(len(entries), 25)
+
+    def test_failed_page_raises(self):
+        def search(*args, **kwargs):
+            return False, {"result": 4, "description": "sizeLimitExceeded"}, [], None
+
+        self.ldap.connection.search = search
+        with self.assertRaises(LdapException):
+            list(self.search.iter_users())
+
+    def test_json_export(self):
+        stream = io.StringIO()
+        LdapSearch.dump_to_file(self.search.iter_users(), stream)
+        exported = json.loads(stream.getvalue())
+        self.assertEqual(len(exported), 25)
+        self.assertEqual(exported[0]["attributes"]["sAMAccountName"], "user0")
+        self.assertEqual("".join(LdapSearch.iter_json([])), "[]")
+        self.assertEqual(
+            json.loads("".join(LdapSearch.iter_json([{"name": b"\xd0\xaf"}]))), [{"name": "Я"}]
+        )
+
+
+class TestBulkLookup(unittest.IsolatedAsyncioTestCase):
+    def test_filters_are_escaped(self):
+        self.assertEqual(_user_filter("a*)(cn=*"), r"(sAMAccountName=a\2a\29\28cn=\2a)")
+        self.assertEqual(
+            _email_filter("x)(mail=*"),
+            r"(&(proxyAddresses=smtp:x\29\28mail=\2a)(mail=x\29\28mail=\2a))",
+        )
+        self.assertEqual(_user_filter("back\\slash"), r"(sAMAccountName=back\5cslash)")
+
+    def test_batches_are_unique_case_insensitive(self):
+        self.assertEqual(
+            _batches(["A", "b", "a", "C", "B", "d", "e"], 2), [["a", "b"], ["c", "d"], ["e"]]
+        )
+        self.assertEqual(_batches([], 2), [])
+
+    def test_users_are_keyed_by_the_given_names(self):
+        ldap = FakeLdap(users=10)
+        found = LdapSearch(ldap).users(["user1", "USER2", "nobody", "user1"], batch_size=2)
+        self.assertEqual(set(found), {"user1", "USER2", "nobody"})
+        self.assertEqual(found["USER2"]["attributes"]["sAMAccountName"], "user2")
+        self.assertIsNone(found["nobody"])
+        # user1, user2 | nobody
+        self.assertEqual(len(ldap.connection.searches), 2)
+        self.assertIn(
+            "(|(sAMAccountName=user1)(sAMAccountName=user2))", ldap.connection.searches[0]
+        )
+
+    async def test_async_emails(self):
+        search = AsyncLdapSearch(lambda: FakeLdap(users=10), max_workers=2)
+        self.addCleanup(search.close)
+        found = await search.emails(["user3@katren.net", "none@katren.net"], batch_size=1)
+        self.assertEqual(found["user3@katren.net"]["attributes"]["sAMAccountName"], "user3")
+        self.assertIsNone(found["none@katren.net"])
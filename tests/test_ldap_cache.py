@@ -0,0 +1,103 @@
+import asyncio
+import unittest
+
+import pytest
+
+from app.services.ldap_cache import LDAP_CACHE_COALESCED, LDAP_CACHE_MISSES, LdapLookupCache
+
+
+class FakeSearch:
+    def __init__(self, known=("alice",)):
+        self.known = set(known)
+        self.calls = 0
+        self.result = {"result": 0}
+
+    async def user(self, username):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        if self.result["result"]:
+            return False, self.result, []
+        response = [{"type": "searchResEntry", "dn": f"CN={username}"}]
+        if username not in self.known:
+            response = []
+        # AD answers a search at the domain root with continuation references too
+        response.append({"type": "searchResRef", "uri": ["ldap://ForestDnsZones.katren.net"]})
+        return True, self.result, response
+
+    email = user
+
+
+@pytest.mark.usefixtures("fake_clock")
+class TestLdapLookupCache(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.search = FakeSearch()
+        self.cache = LdapLookupCache(
+            self.search, ttl=100, negative_ttl=10, refresh_min_hits=2, clock=self.clock
+        )
+
+    async def test_hit_is_case_insensitive(self):
+        await self.cache.user("alice")
+        status, _, _ = await self.cache.user("ALICE")
+        self.assertTrue(status)
+        self.assertEqual(self.search.calls, 1)
+        self.assertEqual(self.cache.hit_ratio, 0.5)
+
+    async def test_negative_result_has_shorter_ttl(self):
+        await self.cache.user("bob")
+        self.clock.now = 9
+        await self.cache.user("bob")
+        self.assertEqual(self.search.calls, 1)
+        self.clock.now = 10
+        await self.cache.user("bob")
+        self.assertEqual(self.search.calls, 2)
+
+    async def test_failed_search_is_not_cached(self):
+        # SAFE_SYNC returns status False and no entries when the server is busy
+        self.search.result = {"result": 51, "description": "busy"}
+        await self.cache.user("alice")
+        self.search.result = {"result": 0}
+        _, search_result, response = await self.cache.user("alice")
+        self.assertEqual(self.search.calls, 2)
+        self.assertEqual((search_result["result"], len(response)), (0, 1))
+
+    async def test_references_are_not_entries(self):
+        _, _, response = await self.cache.user("bob")
+        self.assertEqual(response, [])
+        _, _, response = await self.cache.user("alice")
+        self.assertEqual(response, [{"type": "searchResEntry", "dn": "CN=alice"}])
+
+    async def test_concurrent_misses_are_coalesced(self):
+        await asyncio.gather(*(self.cache.user("alice") for _ in range(5)))
+        self.assertEqual(self.search.calls, 1)
+
+    async def test_only_shared_lookups_are_coalesced(self):
+        def counts():
+            return (
+                LDAP_CACHE_MISSES.labels(lookup="user")._value.get(),
+                LDAP_CACHE_COALESCED.labels(lookup="user")._value.get(),
+            )
+
+        misses, coalesced = counts()
+        await asyncio.gather(
+            self.cache.user("bob"), self.cache.user("alice"), self.cache.user("alice")
+        )
+        # The miss of bob is not counted as coalesced when alice is joined meanwhile
+        self.assertEqual(counts(), (misses + 2, coalesced + 1))
+
+    async def test_hot_key_is_refreshed_before_expiry(self):
+        await self.cache.user("alice")
+        await self.cache.user("alice")
+        await self.cache.user("alice")
+        await self.cache.email("alice")
+        self.assertEqual(await self.cache.refresh(), 0)
+
+        self.clock.now = 85
+        self.assertEqual(await self.cache.refresh(), 1)
+        self.assertEqual(self.search.calls, 3)
+        self.clock.now = 150
+        await self.cache.user("alice")
+        self.assertEqual(self.search.calls, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
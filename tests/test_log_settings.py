@@ -0,0 +1,149 @@
+import io
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import tempfile
+import unittest
+
+from app.core.configs.log_settings import (
+    LOG_SEQUENCE,
+    BatchingQueueListener,
+    BatchStreamHandler,
+    JSONFormatter,
+)
+
+FORMAT = "%(process)d::%(filename)s::%(lineno)s::%(message)s::%(req_id)s"
+
+
+def make_record(msg="hello %s", args=("world",), created=1_700_000_000.25, **extra):
+    record = logging.makeLogRecord({"name": "stdout", "msg": msg, "args": args, **extra})
+    record.created = created
+    record.msecs = (created - int(created)) * 1000
+    return record
+
+
+class TestJSONFormatter(unittest.TestCase):
+    def test_fields_of_the_format(self):
+        formatter = JSONFormatter(FORMAT, encoder=json.dumps)
+        message = json.loads(formatter.format(make_record(req_id="abc")))
+        self.assertEqual(list(message)[-4:], ["message", "filename", "lineno", "req_id"])
+        self.assertEqual(message["message"], "hello world")
+        self.assertEqual(message["req_id"], "abc")
+        self.assertEqual(message["lineno"], 0)
+
+    def test_missing_extra_field_is_none(self):
+        formatter = JSONFormatter("%(message)s::%(user)s", encoder=json.dumps)
+        self.assertIsNone(json.loads(formatter.format(make_record()))["user"])
+
+    def test_time_is_cached_per_second(self):
+        formatter = JSONFormatter(FORMAT)
+        first = formatter.formatTime(make_record(created=1_700_000_000.25))
+        second = formatter.formatTime(make_record(created=1_700_000_000.5))
+        self.assertEqual(first[:-4], second[:-4])
+        self.assertEqual((first[-3:], second[-3:]), ("250", "500"))
+        third = formatter.formatTime(make_record(created=1_700_000_001.0))
+        self.assertNotEqual(first[:-4], third[:-4])
+        self.assertEqual(
+            third, logging.Formatter().formatTime(make_record(created=1_700_000_001.0))
+        )
+
+    def test_exception_stays_in_the_json_line(self):
+        formatter = JSONFormatter(FORMAT)
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            record = make_record(exc_info=sys.exc_info())
+        line = formatter.format(record)
+        self.assertNotIn("\n", line)
+        self.assertIn("ValueError: boom", json.loads(line)["exc_text"])
+
+    def test_encoder_is_pluggable(self):
+        formatter = JSONFormatter(FORMAT, encoder=lambda message: message["app.logger"])
+        self.assertEqual(formatter.format(make_record()), "stdout")
+
+
+class CountingStream(io.StringIO):
+    def __init__(self):
+        super().__init__()
+        self.writes = 0
+
+    def write(self, text):
+        self.writes += 1
+        return super().write(text)
+
+
+class TestBatchingQueueListener(unittest.TestCase):
+    def test_records_are_written_in_batches_in_order(self):
+        stream = CountingStream()
+        handler = BatchStreamHandler(stream)
+        handler.setFormatter(JSONFormatter("%(message)s", encoder=json.dumps))
+        log_queue = queue.Queue()
+        for i in range(100):
+            log_queue.put(logging.makeLogRecord({"name": "test", "msg": "record %s", "args": (i,)}))
+        listener = BatchingQueueListener(log_queue, handler)
+        listener.stop()
+
+        lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual([line["message"] for line in lines], [f"record {i}" for i in range(100)])
+        self.assertEqual(stream.writes, 1)
+        pids, counters = zip(*(line["log_id"].split("-") for line in lines), strict=True)
+        self.assertEqual(set(pids), {str(os.getpid())})
+        self.assertEqual(list(map(int, counters)), sorted(map(int, counters)))
+
+    def test_filtered_records_are_not_written(self):
+        stream = CountingStream()
+        handler = BatchStreamHandler(stream)
+        handler.addFilter(lambda record: record.levelno >= logging.WARNING)
+        log_queue = queue.Queue()
+        for level in (logging.INFO, logging.WARNING):
+            log_queue.put(logging.makeLogRecord({"msg": "message", "levelno": level}))
+        BatchingQueueListener(log_queue, handler).stop()
+        self.assertEqual(stream.getvalue(), "message\n")
+
+    def test_listener_is_restarted_in_a_forked_child(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        stream = open(os.path.join(directory.name, "app.log"), "a")
+        self.addCleanup(stream.close)
+        log_queue = queue.Queue()
+        logger = logging.getLogger("test.fork")
+        logger.propagate = False
+        logger.addHandler(logging.handlers.QueueHandler(log_queue))
+        self.addCleanup(logger.handlers.clear)
+        listener = BatchingQueueListener(log_queue, BatchStreamHandler(stream))
+
+        pid = os.fork()
+        if pid == 0:
+            logger.warning("from the child")
+            listener.stop()
+            os._exit(0)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+        logger.warning("from the parent")
+        listener.stop()
+        with open(stream.name) as written:
+            self.assertEqual(
+                sorted(written.read().splitlines()), ["from the child", "from the parent"]
+            )
+
+
+class TestLogSequence(unittest.TestCase):
+    def test_sequence_is_unique_across_forked_processes(self):
+        next(LOG_SEQUENCE)
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.write(write, next(LOG_SEQUENCE).encode())
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(os.read(read, 100).decode(), f"{pid}-1")
+        os.close(read)
+        os.close(write)
+        self.assertTrue(next(LOG_SEQUENCE).startswith(f"{os.getpid()}-"))
+
+
+if __name__ == "__main__":
+    unittest.main()
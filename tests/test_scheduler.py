@@ -0,0 +1,410 @@
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from datetime import datetime, time as day_time, timedelta
+from pathlib import Path
+
+import pytest
+
+from app.services.scheduler import (
+    CatchUp,
+    Cron,
+    Every,
+    ExecutionMode,
+    Job,
+    Overlap,
+    Scheduler,
+    Time,
+)
+from app.services.scheduler_store import JobState, SqliteStateStore
+
+
+class RecordingJob(Job):
+    def __init__(self, runs, name):
+        self.runs = runs
+        self.name = name
+
+    async def run(self):
+        self.runs.append(self.name)
+
+
+class FailingJob(Job):
+    async def run(self):
+        raise ValueError("boom")
+
+
+class BlockedJob(Job):
+    """Runs until released, counts the concurrent runs"""
+
+    def __init__(self):
+        self.release = asyncio.Event()
+        self.started = 0
+        self.running = 0
+        self.max_running = 0
+
+    async def run(self):
+        self.started += 1
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await self.release.wait()
+        finally:
+            self.running -= 1
+
+
+class SleepingJob(Job):
+    """Blocks its thread with time.sleep"""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.started = 0
+        self.finished = False
+
+    async def run(self):
+        self.started += 1
+        time.sleep(self.seconds)
+        self.finished = True
+
+
+class AsyncSleepingJob(Job):
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.cancelled = False
+
+    async def run(self):
+        try:
+            await asyncio.sleep(self.seconds)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+
+
+class PidJob(Job):
+    async def run(self):
+        return os.getpid()
+
+
+class TestSchedules(unittest.TestCase):
+    def test_every_keeps_the_phase(self):
+        schedule = Every(10)
+        self.assertEqual(schedule.next_run(100, 105, datetime.now()), 110)
+        self.assertEqual(schedule.next_run(100, 135, datetime.now()), 140)
+
+    def test_every_at_time_of_day(self):
+        schedule = Every(Time.DAY, at=day_time(7, 0))
+        self.assertEqual(schedule.next_run(None, 0, datetime(2024, 1, 1, 6, 30)), 1800)
+        self.assertEqual(schedule.next_run(None, 0, datetime(2024, 1, 1, 7, 0)), Time.DAY)
+
+    def test_cron_next_time(self):
+        wall = datetime(2024, 1, 1, 6, 30)  # Monday
+        self.assertEqual(Cron("30 2 * * *").next_time(wall), datetime(2024, 1, 2, 2, 30))
+        self.assertEqual(Cron("*/15 8-18 * * 1-5").next_time(wall), datetime(2024, 1, 1, 8, 0))
+        self.assertEqual(Cron("0 9 * * 0").next_time(wall), datetime(2024, 1, 7, 9, 0))
+        self.assertEqual(Cron("0 0 29 2 *").next_time(wall), datetime(2024, 2, 29, 0, 0))
+
+    def test_cron_invalid(self):
+        with self.assertRaises(ValueError):
+            Cron("60 * * * *")
+        with self.assertRaises(ValueError):
+            Cron("* * *")
+
+
+@pytest.mark.usefixtures("fake_clock")
+class TestScheduler(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.scheduler = Scheduler(clock=self.clock, wall_clock=self.clock.wall)
+        self.runs = []
+
+    async def run_until(self, seconds):
+        """Moves the fake clock from one planned run to the next one"""
+        deadline = self.clock.now + seconds
+        while (delay := self.scheduler.run_pending()) is not None:
+            await asyncio.sleep(0)
+            if self.clock.now + delay > deadline:
+                break
+            self.clock.advance(delay)
+        self.clock.now = deadline
+        self.scheduler.run_pending()
+        await asyncio.sleep(0)
+
+    async def test_jobs_run_in_order_of_their_schedules(self):
+        self.scheduler.add(RecordingJob(self.runs, "fast"), Every(10))
+        self.scheduler.add(RecordingJob(self.runs, "slow"), Every(25))
+        self.scheduler.add(RecordingJob(self.runs, "cron"), Cron("31 6 * * *"))
+        await self.run_until(60)
+        self.assertEqual(
+            self.runs, ["fast", "fast", "slow", "fast", "fast", "slow", "fast", "cron", "fast"]
+        )
+
+    async def test_failed_job_keeps_its_schedule(self):
+        entry = self.scheduler.add(FailingJob(), Every(10), name="failing")
+        await self.run_until(30)
+        self.assertEqual((entry.runs, entry.failures), (3, 3))
+        self.assertEqual(self.scheduler.next_in("failing"), 10)
+
+    async def test_removed_job_does_not_run(self):
+        self.scheduler.add(RecordingJob(self.runs, "job"), Every(10), name="job")
+        await self.run_until(10)
+        self.scheduler.remove("job")
+        await self.run_until(30)
+        self.assertEqual(self.runs, ["job"])
+
+    async def test_loop_does_not_block_the_event_loop(self):
+        scheduler = Scheduler()
+        scheduler.add(RecordingJob(self.runs, "job"), Every(0.01))
+        scheduler.start()
+        ticks = 0
+        for _ in range(10):
+            await asyncio.sleep(0.005)
+            ticks += 1
+        await scheduler.stop()
+        self.assertEqual(ticks, 10)
+        self.assertGreaterEqual(len(self.runs), 3)
+
+
+@pytest.mark.usefixtures("fake_clock")
+class TestExecution(unittest.IsolatedAsyncioTestCase):
+    async def tick(self, scheduler, seconds=10):
+        self.clock.advance(seconds)
+        scheduler.run_pending()
+        for _ in range(5):
+            await asyncio.sleep(0)
+
+    async def test_overlap_skip(self):
+        scheduler = Scheduler(clock=self.clock, wall_clock=self.clock.wall)
+        job = BlockedJob()
+        entry = scheduler.add(job, Every(10), overlap=Overlap.SKIP)
+        for _ in range(3):
+            await self.tick(scheduler)
+        self.assertEqual((job.started, entry.missed), (1, 2))
+        job.release.set()
+        await scheduler.stop()
+
+    async def test_overlap_queue_keeps_one_waiting_run(self):
+        scheduler = Scheduler(clock=self.clock, wall_clock=self.clock.wall)
+        job = BlockedJob()
+        entry = scheduler.add(job, Every(10), overlap=Overlap.QUEUE)
+        for _ in range(3):
+            await self.tick(scheduler)
+        self.assertEqual((job.started, entry.waiting, entry.missed), (1, 1, 1))
+        job.release.set()
+        await scheduler.stop()
+        self.assertEqual((job.started, job.max_running), (2, 1))
+
+    async def test_overlap_allow_up_to_max_instances(self):
+        scheduler = Scheduler(clock=self.clock, wall_clock=self.clock.wall)
+        job = BlockedJob()
+        entry = scheduler.add(job, Every(10), overlap=Overlap.ALLOW, max_instances=2)
+        for _ in range(3):
+            await self.tick(scheduler)
+        self.assertEqual((job.running, entry.missed), (2, 1))
+        job.release.set()
+        await scheduler.stop()
+
+    async def test_global_concurrency_limit(self):
+        scheduler = Scheduler(clock=self.clock, wall_clock=self.clock.wall, max_concurrency=1)
+        first, second = BlockedJob(), BlockedJob()
+        scheduler.add(first, Every(10), name="first")
+        scheduler.add(second, Every(10), name="second")
+        await self.tick(scheduler)
+        self.assertEqual((first.running, second.running), (1, 0))
+        first.release.set()
+        second.release.set()
+        await scheduler.stop()
+        self.assertEqual(second.started, 1)
+
+    async def test_late_runs_are_missed(self):
+        scheduler = Scheduler(clock=self.clock, wall_clock=self.clock.wall)
+        entry = scheduler.add(RecordingJob([], "job"), Every(10), name="job")
+        await self.tick(scheduler, 35)
+        self.assertEqual((entry.runs, entry.missed), (1, 2))
+        self.assertEqual(scheduler.next_in("job"), 5)
+
+    async def test_inline_timeout_cancels_the_run(self):
+        scheduler = Scheduler(clock=self.clock, wall_clock=self.clock.wall)
+        job = AsyncSleepingJob(10)
+        entry = scheduler.add(job, Every(10), timeout=0.01)
+        await self.tick(scheduler)
+        await asyncio.gather(*entry.tasks)
+        self.assertTrue(job.cancelled)
+        self.assertEqual(entry.failures, 1)
+
+    async def test_thread_mode_does_not_block_the_loop(self):
+        scheduler = Scheduler(clock=self.clock, wall_clock=self.clock.wall)
+        job = SleepingJob(0.05)
+        entry = scheduler.add(job, Every(10), mode=ExecutionMode.THREAD)
+        await self.tick(scheduler)
+        self.assertFalse(job.finished)
+        await asyncio.gather(*entry.tasks)
+        self.assertTrue(job.finished)
+        await scheduler.stop()
+
+    async def test_thread_timeout_cancels_the_run(self):
+        scheduler = Scheduler(clock=self.clock, wall_clock=self.clock.wall)
+        job = AsyncSleepingJob(10)
+        entry = scheduler.add(job, Every(10), mode=ExecutionMode.THREAD, timeout=0.05)
+        await self.tick(scheduler)
+        await asyncio.gather(*entry.tasks)
+        await scheduler.stop()
+        self.assertTrue(job.cancelled)
+        self.assertEqual(entry.failures, 1)
+
+    async def test_blocked_thread_keeps_the_slot_after_timeout(self):
+        scheduler = Scheduler(clock=self.clock, wall_clock=self.clock.wall)
+        job = SleepingJob(0.2)
+        entry = scheduler.add(job, Every(10), mode=ExecutionMode.THREAD, timeout=0.01)
+        await self.tick(scheduler)
+        await asyncio.sleep(0.05)
+        await self.tick(scheduler)
+        self.assertEqual((job.started, entry.running, entry.missed), (1, 1, 1))
+        await asyncio.gather(*entry.tasks)
+        await scheduler.stop()
+        self.assertEqual((job.finished, entry.failures), (True, 1))
+
+    async def test_process_keeps_the_slot_after_timeout(self):
+        scheduler = Scheduler(clock=self.clock, wall_clock=self.clock.wall)
+        entry = scheduler.add(SleepingJob(0.5), Every(10), mode=ExecutionMode.PROCESS, timeout=0.05)
+        await self.tick(scheduler)
+        await asyncio.sleep(0.2)
+        await self.tick(scheduler)
+        self.assertEqual((entry.running, entry.missed), (1, 1))
+        await asyncio.gather(*entry.tasks)
+        await scheduler.stop()
+        self.assertEqual((entry.runs, entry.failures), (1, 1))
+
+    async def test_process_mode(self):
+        scheduler = Scheduler(clock=self.clock, wall_clock=self.clock.wall)
+        entry = scheduler.add(PidJob(), Every(10), mode=ExecutionMode.PROCESS)
+        await self.tick(scheduler)
+        await asyncio.gather(*entry.tasks)
+        await scheduler.stop()
+        self.assertEqual((entry.runs, entry.failures), (1, 0))
+
+
+@pytest.mark.usefixtures("fake_clock")
+class TestStateStore(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = Path(self.directory.name) / "scheduler.db"
+        self.runs = []
+
+    async def asyncTearDown(self):
+        self.directory.cleanup()
+
+    async def scheduler(self, catch_up, last_planned=None, **state):
+        store = SqliteStateStore(self.path)
+        if last_planned is not None:
+            await store.save(JobState("job", last_planned=last_planned, **state))
+        scheduler = Scheduler(clock=self.clock, wall_clock=self.clock.wall, store=store)
+        entry = scheduler.add(RecordingJob(self.runs, "job"), Every(600), "job", catch_up=catch_up)
+        await scheduler.restore()
+        return scheduler, store, entry
+
+    async def test_store_round_trip(self):
+        store = SqliteStateStore(self.path)
+        state = JobState("job", self.clock.wall(), self.clock.wall(), None, "success")
+        await store.save(state)
+        await store.close()
+        store = SqliteStateStore(self.path)
+        self.assertEqual(await store.load("job"), state)
+        self.assertIsNone(await store.load("other"))
+        await store.close()
+
+    async def test_run_is_recorded(self):
+        scheduler, store, _ = await self.scheduler(CatchUp.ONCE)
+        self.clock.advance(600)
+        scheduler.run_pending()
+        await scheduler.stop()
+        state = await store.load("job")
+        self.assertEqual(state.last_planned, self.clock.wall())
+        self.assertEqual(state.last_status, "success")
+        await store.close()
+
+    async def test_catch_up_once_keeps_the_phase(self):
+        # 06:30 now, the last run at 05:55: 06:05, 06:15 and 06:25 are missed
+        last = self.clock.wall() - timedelta(minutes=35)
+        scheduler, store, entry = await self.scheduler(CatchUp.ONCE, last)
+        await scheduler.stop()
+        self.assertEqual((self.runs, entry.missed), (["job"], 2))
+        self.assertEqual(scheduler.next_in("job"), 300)
+        self.assertEqual((await store.load("job")).last_planned, last + timedelta(minutes=30))
+        await store.close()
+
+    async def test_catch_up_all(self):
+        last = self.clock.wall() - timedelta(minutes=35)
+        scheduler, store, entry = await self.scheduler(CatchUp.ALL, last)
+        await scheduler.stop()
+        self.assertEqual((self.runs, entry.missed), (["job"] * 3, 0))
+        await store.close()
+
+    async def test_catch_up_skip(self):
+        last = self.clock.wall() - timedelta(minutes=35)
+        scheduler, store, entry = await self.scheduler(CatchUp.SKIP, last)
+        await scheduler.stop()
+        self.assertEqual((self.runs, entry.missed), ([], 3))
+        await store.close()
+
+    async def test_interrupted_run_is_run_again(self):
+        last = self.clock.wall() - timedelta(minutes=5)
+        scheduler, store, entry = await self.scheduler(
+            CatchUp.ONCE, last, last_started=last, last_status="success"
+        )
+        await scheduler.stop()
+        self.assertEqual((self.runs, entry.missed), (["job"], 0))
+        self.assertEqual(scheduler.next_in("job"), 300)
+        state = await store.load("job")
+        self.assertEqual((state.last_planned, state.last_status), (last, "success"))
+        await store.close()
+
+    async def test_cancelled_run_is_run_again(self):
+        last = self.clock.wall() - timedelta(minutes=5)
+        scheduler, store, _ = await self.scheduler(
+            CatchUp.ALL, last, last_started=last, last_finished=last, last_status="cancelled"
+        )
+        await scheduler.stop()
+        self.assertEqual(self.runs, ["job"])
+        await store.close()
+
+    async def test_finished_run_is_not_run_again(self):
+        last = self.clock.wall() - timedelta(minutes=5)
+        finished = last + timedelta(seconds=1)
+        scheduler, store, _ = await self.scheduler(
+            CatchUp.ALL, last, last_started=last, last_finished=finished, last_status="error"
+        )
+        await scheduler.stop()
+        self.assertEqual(self.runs, [])
+        await store.close()
+
+    async def test_interrupted_run_is_missed_with_skip(self):
+        last = self.clock.wall() - timedelta(minutes=5)
+        scheduler, store, entry = await self.scheduler(CatchUp.SKIP, last, last_started=last)
+        await scheduler.stop()
+        self.assertEqual((self.runs, entry.missed), ([], 1))
+        await store.close()
+
+    def test_scheduler_does_not_import_the_database(self):
+        code = (
+            "import sys, app.services.scheduler, app.services.scheduler_store; "
+            "print('app.database' in sys.modules, 'psycopg' in sys.modules)"
+        )
+        env = {key: value for key, value in os.environ.items() if not key.startswith("PG_")}
+        output = subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, text=True, env=env, check=True
+        ).stdout
+        self.assertEqual(output.split(), ["False", "False"])
+
+    def test_cron_catch_up(self):
+        missed, count, next_run = Cron("0 2 * * *").catch_up(
+            datetime(2024, 1, 1, 2, 0), datetime(2024, 1, 4, 6, 30), limit=2
+        )
+        self.assertEqual(count, 3)
+        self.assertEqual(missed, [datetime(2024, 1, 3, 2, 0), datetime(2024, 1, 4, 2, 0)])
+        self.assertEqual(next_run, datetime(2024, 1, 5, 2, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()